@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 import redis as redis
@@ -53,6 +54,8 @@ INSTALLED_APPS = [
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB_DEDUP', 1))
+# Пул соединений redis.asyncio для async-эндпоинта (на процесс uvicorn)
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.getenv('REDIS_ASYNC_MAX_CONNECTIONS', 100))
 
 DEDUPLICATOR_TTL_SECONDS = int(os.getenv('DEDUPLICATOR_TTL_SECONDS', 604800))
 
@@ -65,8 +68,228 @@ DEDUPLICATOR_KEY_FIELDS = [
     'channel_id',
 ]
 
+# --- Политики дедупликации по типам событий (deduplicator/policies.py) ---
+# JSON-объект {"<значение поля>": {"ttl_seconds": 3600, "key_fields": [...], "layout": "string",
+# "bucket_seconds": 600}, ...}. Не заданные параметры берутся из DEDUPLICATOR_TTL_SECONDS,
+# DEDUPLICATOR_KEY_FIELDS, DEDUPLICATOR_STORAGE_LAYOUT и DEDUPLICATOR_BUCKET_SECONDS;
+# события остальных типов дедуплицируются по этим общим настройкам
+DEDUPLICATOR_POLICIES = json.loads(os.getenv('DEDUPLICATOR_POLICIES', '{}'))
+# Поле события, по значению которого выбирается политика
+DEDUPLICATOR_POLICY_FIELD = os.getenv('DEDUPLICATOR_POLICY_FIELD', 'event_name')
+
+# --- Формат отпечатка ---
+# 'sha256-json' - исходный формат (JSON + SHA-256, без тега версии)
+# 'sha256', 'blake2b' - формат v2: каноническая кодировка без JSON, отпечаток с тегом версии
+# Смена формата начинает окно дедупликации заново.
+DEDUPLICATOR_FINGERPRINT_ALGORITHM = os.getenv('DEDUPLICATOR_FINGERPRINT_ALGORITHM', 'sha256-json')
+# Размер дайджеста blake2b в байтах (8..32)
+DEDUPLICATOR_FINGERPRINT_DIGEST_SIZE = int(os.getenv('DEDUPLICATOR_FINGERPRINT_DIGEST_SIZE', 16))
+
+# --- Раскладка отпечатков в Redis ---
+# 'string'   - отдельный ключ event_dedup:<sha256> со своим TTL (исходный вариант)
+# 'bucketed' - усеченные бинарные дайджесты в хэшах по временным корзинам (компактно)
+# 'bloom'    - Bloom-фильтры по временным корзинам (еще компактнее, возможны ложные дубли)
+# 'hybrid'   - Bloom-фильтр перед точным хранилищем DEDUPLICATOR_HYBRID_EXACT_LAYOUT
+DEDUPLICATOR_STORAGE_LAYOUT = os.getenv('DEDUPLICATOR_STORAGE_LAYOUT', 'string')
+# Параметры раскладки 'bucketed': длина корзины, число шардов в корзине, длина хранимого дайджеста
+DEDUPLICATOR_BUCKET_SECONDS = int(os.getenv('DEDUPLICATOR_BUCKET_SECONDS', 86400))
+DEDUPLICATOR_BUCKET_SHARDS = int(os.getenv('DEDUPLICATOR_BUCKET_SHARDS', 65536))
+DEDUPLICATOR_DIGEST_BYTES = int(os.getenv('DEDUPLICATOR_DIGEST_BYTES', 10))
+# Параметры Bloom-фильтра: ожидаемое число событий за корзину и допустимая доля ложных дублей
+DEDUPLICATOR_BLOOM_EXPECTED_ITEMS = int(os.getenv('DEDUPLICATOR_BLOOM_EXPECTED_ITEMS', 10_000_000))
+DEDUPLICATOR_BLOOM_ERROR_RATE = float(os.getenv('DEDUPLICATOR_BLOOM_ERROR_RATE', 0.001))
+# Точное хранилище для 'hybrid': 'string' или 'bucketed'
+DEDUPLICATOR_HYBRID_EXACT_LAYOUT = os.getenv('DEDUPLICATOR_HYBRID_EXACT_LAYOUT', 'string')
+
+# Шардирование отпечатков по нескольким Redis (консистентное хеширование).
+# Список URL через запятую: redis://redis-1:6379/1,redis://redis-2:6379/1.
+# Пусто - все отпечатки в REDIS_HOST:REDIS_PORT/REDIS_DB_DEDUP
+DEDUPLICATOR_REDIS_NODES = [url.strip() for url in os.getenv('DEDUPLICATOR_REDIS_NODES', '').split(',') if url.strip()]
+# Точек на кольце на один узел: больше - равномернее распределение
+DEDUPLICATOR_HASH_RING_VNODES = int(os.getenv('DEDUPLICATOR_HASH_RING_VNODES', 160))
+
+from deduplicator.fingerprint import fingerprint_digest_size
+
+DEDUPLICATOR_STORAGE_OPTIONS = {
+    'bucket_seconds': DEDUPLICATOR_BUCKET_SECONDS,
+    'shards': DEDUPLICATOR_BUCKET_SHARDS,
+    'digest_bytes': DEDUPLICATOR_DIGEST_BYTES,
+    # Сколько байт дайджеста есть у отпечатка: digest_bytes не может быть больше остатка после шарда
+    'fingerprint_digest_size': fingerprint_digest_size(DEDUPLICATOR_FINGERPRINT_ALGORITHM,
+                                                       DEDUPLICATOR_FINGERPRINT_DIGEST_SIZE),
+    'bloom_expected_items': DEDUPLICATOR_BLOOM_EXPECTED_ITEMS,
+    'bloom_error_rate': DEDUPLICATOR_BLOOM_ERROR_RATE,
+    'exact_layout': DEDUPLICATOR_HYBRID_EXACT_LAYOUT,
+    'async_max_connections': REDIS_ASYNC_MAX_CONNECTIONS,
+}
+
+# --- L1-кэш отпечатков в памяти процесса (перед Redis) ---
+# Размер кэша в отпечатках; 0 - кэш выключен
+DEDUPLICATOR_L1_CACHE_SIZE = int(os.getenv('DEDUPLICATOR_L1_CACHE_SIZE', 0))
+# Сколько секунд отпечаток живет в кэше (не больше DEDUPLICATOR_TTL_SECONDS)
+DEDUPLICATOR_L1_CACHE_TTL_SECONDS = int(os.getenv('DEDUPLICATOR_L1_CACHE_TTL_SECONDS', 60))
+
+# --- Поиск почти-дублей (deduplicator/similarity.py) ---
+# Поля ключа, которые сравниваются приблизительно (MinHash по n-граммам слов, LSH в Redis), через запятую.
+# Остальные поля ключа должны совпасть точно. Событие, новое для точной проверки, но похожее на
+# виденное за окно дедупликации, считается дублем. Пусто - поиск выключен
+DEDUPLICATOR_NEAR_FIELDS = [field.strip() for field in os.getenv('DEDUPLICATOR_NEAR_FIELDS', '').split(',') if field.strip()]
+# Порог сходства (оценка коэффициента Жаккара множеств n-грамм), с которого событие - почти-дубль
+DEDUPLICATOR_NEAR_THRESHOLD = float(os.getenv('DEDUPLICATOR_NEAR_THRESHOLD', 0.7))
+# Длина сигнатуры MinHash (степень двойки) и число полос LSH (делитель длины сигнатуры)
+DEDUPLICATOR_NEAR_NUM_HASHES = int(os.getenv('DEDUPLICATOR_NEAR_NUM_HASHES', 64))
+DEDUPLICATOR_NEAR_BANDS = int(os.getenv('DEDUPLICATOR_NEAR_BANDS', 16))
+# Длина n-граммы (байт слова в рамке '#'); 2 различает версии коротких идентификаторов лучше 3
+DEDUPLICATOR_NEAR_NGRAM = int(os.getenv('DEDUPLICATOR_NEAR_NGRAM', 2))
+# Сколько последних событий помнит корзина полосы и сколько кандидатов сравнивается на событие
+DEDUPLICATOR_NEAR_BUCKET_SIZE = int(os.getenv('DEDUPLICATOR_NEAR_BUCKET_SIZE', 32))
+DEDUPLICATOR_NEAR_MAX_CANDIDATES = int(os.getenv('DEDUPLICATOR_NEAR_MAX_CANDIDATES', 64))
+
+# --- Учет повторов событий (deduplicator/hits.py) ---
+# Считать дубли: число повторов и время последнего копятся в Redis и переносятся в
+# UniqueEvent.duplicate_count и last_seen_at задачей beat flush_duplicate_hits, без записи в БД на каждый дубль
+DEDUPLICATOR_DUPLICATE_HITS = os.getenv('DEDUPLICATOR_DUPLICATE_HITS', '0') == '1'
+# Скользящее окно: каждый дубль продлевает окно дедупликации отпечатка на TTL его политики
+DEDUPLICATOR_SLIDING_WINDOW = os.getenv('DEDUPLICATOR_SLIDING_WINDOW', '0') == '1'
+# Хэши Redis со счетчиками (<ключ>) и временем последнего повтора (<ключ>:last)
+DEDUPLICATOR_DUPLICATE_HITS_KEY = os.getenv('DEDUPLICATOR_DUPLICATE_HITS_KEY', 'event_dedup:hits')
+# Как часто процесс сбрасывает накопленные повторы в Redis (и продлевает окна), секунды
+DEDUPLICATOR_DUPLICATE_HITS_FLUSH_INTERVAL = float(os.getenv('DEDUPLICATOR_DUPLICATE_HITS_FLUSH_INTERVAL', 5.0))
+# Как часто beat переносит счетчики из Redis в БД, секунды
+DEDUPLICATOR_DUPLICATE_HITS_DB_INTERVAL = float(os.getenv('DEDUPLICATOR_DUPLICATE_HITS_DB_INTERVAL', 60.0))
+# Сколько секунд повторы ждут строку события, которой еще нет в БД (событие в очереди или
+# в буфере записи); потом они отбрасываются
+DEDUPLICATOR_DUPLICATE_HITS_GRACE_SECONDS = int(os.getenv('DEDUPLICATOR_DUPLICATE_HITS_GRACE_SECONDS', 3600))
+
+# --- Пакетный приём событий (POST массива в /api/v1/check_event/) ---
+# Максимальное количество событий в одном запросе
+DEDUPLICATOR_BATCH_MAX_ITEMS = int(os.getenv('DEDUPLICATOR_BATCH_MAX_ITEMS', 5000))
+# Размер чанка: одна задача Celery на каждый чанк
+DEDUPLICATOR_BATCH_CHUNK_SIZE = int(os.getenv('DEDUPLICATOR_BATCH_CHUNK_SIZE', 500))
+# Максимальный размер тела запроса в байтах
+DEDUPLICATOR_BATCH_MAX_BODY_BYTES = int(os.getenv('DEDUPLICATOR_BATCH_MAX_BODY_BYTES', 10 * 1024 * 1024))
+
+# --- Чтение сохраненных событий (GET /api/v1/events/) ---
+# Размер страницы по умолчанию и максимальный (параметр limit)
+DEDUPLICATOR_EVENTS_PAGE_SIZE = int(os.getenv('DEDUPLICATOR_EVENTS_PAGE_SIZE', 100))
+DEDUPLICATOR_EVENTS_PAGE_MAX = int(os.getenv('DEDUPLICATOR_EVENTS_PAGE_MAX', 1000))
+
+# --- Пакетная запись уникальных событий в БД (воркер) ---
+# Не больше стольких событий конкурентных задач в одном INSERT
+DEDUPLICATOR_WRITER_BATCH_SIZE = int(os.getenv('DEDUPLICATOR_WRITER_BATCH_SIZE', 500))
+# Сколько секунд первая задача ждет, пока наберется пачка, прежде чем писать (0 - писать сразу).
+# Имеет смысл под eventlet с конкурентностью больше единицы; под prefork держите 0
+DEDUPLICATOR_WRITER_LINGER = float(os.getenv('DEDUPLICATOR_WRITER_LINGER', 0.0))
+# Задача, чьи события ждут чужого сброса дольше стольких секунд, сбрасывает буфер сама
+DEDUPLICATOR_WRITER_FLUSH_INTERVAL = float(os.getenv('DEDUPLICATOR_WRITER_FLUSH_INTERVAL', 1.0))
+# Пока БД недоступна, незаписанные события повторяются через столько секунд (задача persist_unique_events)...
+DEDUPLICATOR_WRITER_RETRY_DELAY = float(os.getenv('DEDUPLICATOR_WRITER_RETRY_DELAY', 5.0))
+# ...не больше стольких раз, затем их отпечатки удаляются из Redis
+DEDUPLICATOR_WRITER_RETRY_MAX = int(os.getenv('DEDUPLICATOR_WRITER_RETRY_MAX', 5))
+# Уникальность fingerprint в БД - в пределах дневной секции. События, которые могли быть
+# записаны раньше (повторная доставка, повтор после сбоя), проверяются по всем секциям
+# за столько секунд (не меньше самого длинного TTL политик)
+DEDUPLICATOR_DB_RECHECK_WINDOW_SECONDS = int(os.getenv('DEDUPLICATOR_DB_RECHECK_WINDOW_SECONDS', DEDUPLICATOR_TTL_SECONDS))
+
+# --- Транспорт событий от API до обработчика ---
+# 'celery' - задача Celery на событие/чанк; 'stream' - Redis Stream + команда consume_events
+DEDUPLICATOR_TRANSPORT = os.getenv('DEDUPLICATOR_TRANSPORT', 'celery')
+DEDUPLICATOR_STREAM_KEY = os.getenv('DEDUPLICATOR_STREAM_KEY', 'event_dedup:stream')
+DEDUPLICATOR_STREAM_GROUP = os.getenv('DEDUPLICATOR_STREAM_GROUP', 'deduplicator')
+# Приблизительный предел длины потока; при отставании потребителей старые записи теряются
+DEDUPLICATOR_STREAM_MAXLEN = int(os.getenv('DEDUPLICATOR_STREAM_MAXLEN', 1_000_000))
+# Сколько записей потребитель читает за раз и сколько ждет новых (мс)
+DEDUPLICATOR_STREAM_BATCH_SIZE = int(os.getenv('DEDUPLICATOR_STREAM_BATCH_SIZE', 500))
+DEDUPLICATOR_STREAM_BLOCK_MS = int(os.getenv('DEDUPLICATOR_STREAM_BLOCK_MS', 1000))
+# Через сколько мс без подтверждения запись упавшего потребителя забирает другой
+DEDUPLICATOR_STREAM_CLAIM_IDLE_MS = int(os.getenv('DEDUPLICATOR_STREAM_CLAIM_IDLE_MS', 60_000))
+# Проверка на дубли прямо в API: в очередь уходят только новые события.
+# С транспортом 'stream' и раскладкой 'string' проверка и постановка атомарны (Lua)
+DEDUPLICATOR_INGEST_DEDUP = os.getenv('DEDUPLICATOR_INGEST_DEDUP', '0') == '1'
+# Синхронный эндпоинт с транспортом 'celery': не больше стольких уникальных событий в одной
+# задаче persist_unique_events (пачка копится, пока отправляется предыдущая)
+DEDUPLICATOR_INLINE_PERSIST_BATCH_SIZE = int(os.getenv('DEDUPLICATOR_INLINE_PERSIST_BATCH_SIZE', 500))
+
+# --- Сериализация событий (deduplicator/serialization.py) ---
+# Разбор и вывод JSON в API через orjson (если установлен). Событие-объект из тела запроса
+# несет исходный текст, и в Redis Stream и в БД пишется он, без повторной сериализации
+DEDUPLICATOR_FAST_JSON = os.getenv('DEDUPLICATOR_FAST_JSON', '0') == '1'
+# Сериализатор сообщений Celery: 'json', 'orjson' или 'msgpack'. Воркеры принимают и 'json', поэтому
+# при переходе сначала перезапускаются воркеры, затем API; сообщения в очереди не теряются
+DEDUPLICATOR_CELERY_SERIALIZER = os.getenv('DEDUPLICATOR_CELERY_SERIALIZER', 'json')
+# Сжатие задач с чанками событий пакетного приема: 'zlib', 'gzip', 'bzip2', 'lzma'; пусто - без сжатия
+DEDUPLICATOR_CELERY_BATCH_COMPRESSION = os.getenv('DEDUPLICATOR_CELERY_BATCH_COMPRESSION', '') or None
+
+# --- Секционирование таблицы UniqueEvent по дням (см. deduplicator/partitions.py) ---
+# На сколько дней вперед создавать секции
+DEDUPLICATOR_PARTITION_DAYS_AHEAD = int(os.getenv('DEDUPLICATOR_PARTITION_DAYS_AHEAD', 7))
+
+# --- Недоступность Redis в пути дедупликации (см. deduplicator/circuit.py) ---
+# Таймауты клиентов хранилища отпечатков, секунды (0 - без таймаута):
+# зависший Redis должен давать ошибку, а не держать воркер
+DEDUPLICATOR_REDIS_SOCKET_TIMEOUT = float(os.getenv('DEDUPLICATOR_REDIS_SOCKET_TIMEOUT', 1.0)) or None
+DEDUPLICATOR_REDIS_CONNECT_TIMEOUT = float(os.getenv('DEDUPLICATOR_REDIS_CONNECT_TIMEOUT', 1.0)) or None
+# Предохранитель размыкается после стольких ошибок соединения подряд (0 - без предохранителя)
+DEDUPLICATOR_BREAKER_FAILURE_THRESHOLD = int(os.getenv('DEDUPLICATOR_BREAKER_FAILURE_THRESHOLD', 5))
+# Сколько секунд проверки не идут в Redis, прежде чем пропустить пробные
+DEDUPLICATOR_BREAKER_RESET_TIMEOUT = float(os.getenv('DEDUPLICATOR_BREAKER_RESET_TIMEOUT', 5.0))
+DEDUPLICATOR_BREAKER_HALF_OPEN_CALLS = int(os.getenv('DEDUPLICATOR_BREAKER_HALF_OPEN_CALLS', 1))
+# Что делать с событиями, пока Redis недоступен:
+# 'db'    - считать новыми, как без предохранителя (по умолчанию); повторы отсечет только уникальный
+#           индекс дневной секции (ON CONFLICT DO NOTHING), то есть дубль события, сохраненного в
+#           другие сутки, будет записан еще раз
+# 'retry' - не сохранять без проверки, а отложить ее до восстановления Redis. Включение меняет поведение:
+#           задачи Celery повторяются до DEDUPLICATOR_DEGRADED_RETRY_MAX раз, синхронный эндпоинт
+#           отвечает 503 с Retry-After, проверка при приеме отправляет события в очередь непроверенными,
+#           consume_events ждет Redis, не подтверждая пачку
+DEDUPLICATOR_DEGRADED_MODE = os.getenv('DEDUPLICATOR_DEGRADED_MODE', 'db')
+# Сколько раз в режиме 'retry' откладывать задачу Celery, прежде чем сохранить события как в 'db'
+DEDUPLICATOR_DEGRADED_RETRY_MAX = int(os.getenv('DEDUPLICATOR_DEGRADED_RETRY_MAX', 60))
+
+# --- Метрики конвейера (deduplicator/metrics.py, эндпоинт /metrics в формате Prometheus) ---
+DEDUPLICATOR_METRICS_ENABLED = os.getenv('DEDUPLICATOR_METRICS_ENABLED', '1') == '1'
+# Хэш Redis, в который процессы складывают свои метрики
+DEDUPLICATOR_METRICS_KEY = os.getenv('DEDUPLICATOR_METRICS_KEY', 'event_dedup:metrics')
+# Как часто каждый процесс сбрасывает накопленное в Redis, секунды
+DEDUPLICATOR_METRICS_FLUSH_INTERVAL = float(os.getenv('DEDUPLICATOR_METRICS_FLUSH_INTERVAL', 5.0))
+
+# --- Контроль приема в API (deduplicator/admission.py) ---
+# Глубина очереди, с которой API отвечает 503 (0 - без порога, по умолчанию): для 'celery' -
+# задачи в очереди брокера (задача пакетного запроса несет чанк событий), для 'stream' -
+# непрочитанные и неподтвержденные записи группы (нужен Redis 7+, на старых порог не применяется)
+DEDUPLICATOR_ADMISSION_HIGH_WATERMARK = int(os.getenv('DEDUPLICATOR_ADMISSION_HIGH_WATERMARK', 0))
+# Прием возобновляется, когда глубина опустится до этого значения
+DEDUPLICATOR_ADMISSION_LOW_WATERMARK = int(os.getenv('DEDUPLICATOR_ADMISSION_LOW_WATERMARK',
+                                                     DEDUPLICATOR_ADMISSION_HIGH_WATERMARK * 4 // 5))
+# Как часто процесс API перечитывает глубину очереди, секунды
+DEDUPLICATOR_ADMISSION_DEPTH_INTERVAL = float(os.getenv('DEDUPLICATOR_ADMISSION_DEPTH_INTERVAL', 0.5))
+# Retry-After ответа 503, секунды
+DEDUPLICATOR_ADMISSION_RETRY_AFTER = float(os.getenv('DEDUPLICATOR_ADMISSION_RETRY_AFTER', 5.0))
+# Событий в секунду на один client_id (0 - без ограничения) и запас корзины токенов
+DEDUPLICATOR_RATE_LIMIT = float(os.getenv('DEDUPLICATOR_RATE_LIMIT', 0))
+DEDUPLICATOR_RATE_LIMIT_BURST = int(os.getenv('DEDUPLICATOR_RATE_LIMIT_BURST', max(1, int(DEDUPLICATOR_RATE_LIMIT))))
+
+# --- Логирование (deduplicator/eventlog.py) ---
+# 'verbose' - строка лога на каждое событие, вывод синхронный (отладка);
+# 'production' - по событиям пишется только выборка, остальное - периодическая сводка счетчиков,
+# вывод в stderr через очередь и отдельный поток
+DEDUPLICATOR_LOG_MODE = os.getenv('DEDUPLICATOR_LOG_MODE', 'verbose')
+# Уровень логгера deduplicator (по умолчанию DEBUG в 'verbose' и INFO в 'production')
+DEDUPLICATOR_LOG_LEVEL = os.getenv('DEDUPLICATOR_LOG_LEVEL', 'DEBUG' if DEDUPLICATOR_LOG_MODE == 'verbose' else 'INFO')
+# Доля событий, для которых в 'production' пишутся строки лога на событие
+DEDUPLICATOR_LOG_SAMPLE_RATE = float(os.getenv('DEDUPLICATOR_LOG_SAMPLE_RATE', 0.001))
+# Как часто в 'production' выводится сводка счетчиков, секунды
+DEDUPLICATOR_LOG_SUMMARY_INTERVAL = float(os.getenv('DEDUPLICATOR_LOG_SUMMARY_INTERVAL', 60.0))
+# Сколько записей ждет вывода в очереди; при переполнении записи отбрасываются, а не блокируют обработку
+DEDUPLICATOR_LOG_QUEUE_SIZE = int(os.getenv('DEDUPLICATOR_LOG_QUEUE_SIZE', 10000))
+
+# Лимит Django для тела с Content-Length (request.body, формы). Тело JSON API без Content-Length
+# (chunked) ограничивают парсеры deduplicator/parsers.py: они читают не больше этого размера
+DATA_UPLOAD_MAX_MEMORY_SIZE = DEDUPLICATOR_BATCH_MAX_BODY_BYTES
+
 REDIS_INSTANCE = None
 EVENT_DEDUPLICATOR_INSTANCE = None
+EVENT_STREAM_INSTANCE = None
 
 try:
     # <--- Создаем клиент ---
@@ -76,14 +299,120 @@ try:
 
     # Импортируем класс дедупликатора
     from deduplicator.logic import EventDeduplicator
+    from deduplicator.cache import FingerprintCache
+    from deduplicator.circuit import DEGRADED_MODES, CircuitBreaker
+    from deduplicator.hits import DuplicateHits
+    from deduplicator.similarity import MinHasher, NearDuplicateIndex
+    from deduplicator.policies import build_policies
+    from deduplicator.storage import build_sharded_storage, build_storage
+    from deduplicator.transport import TRANSPORTS, EventStream
+
+    # Клиенты хранилища отпечатков - с таймаутами (у REDIS_INSTANCE их нет из-за блокирующего XREADGROUP)
+    dedup_redis_options = {
+        'socket_timeout': DEDUPLICATOR_REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': DEDUPLICATOR_REDIS_CONNECT_TIMEOUT,
+    }
+
+    # Хранилища всех политик делят эти клиенты (и их пулы соединений)
+    dedup_node_clients = {
+        url: redis.Redis.from_url(url, decode_responses=True, **dedup_redis_options)
+        for url in DEDUPLICATOR_REDIS_NODES
+    }
+    dedup_redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                                     **dedup_redis_options)
+
+    def build_dedup_storage(layout, ttl_seconds, prefix='event_dedup', **overrides):
+        options = {**DEDUPLICATOR_STORAGE_OPTIONS, **overrides}
+        if DEDUPLICATOR_REDIS_NODES:
+            return build_sharded_storage(
+                layout,
+                DEDUPLICATOR_REDIS_NODES,
+                ttl_seconds,
+                vnodes=DEDUPLICATOR_HASH_RING_VNODES,
+                clients=dedup_node_clients,
+                prefix=prefix,
+                **options
+            )
+        return build_storage(layout, dedup_redis_client, ttl_seconds, prefix=prefix, **options)
 
     try:
+        dedup_storage = build_dedup_storage(DEDUPLICATOR_STORAGE_LAYOUT, DEDUPLICATOR_TTL_SECONDS)
+        if DEDUPLICATOR_REDIS_NODES:
+            print(f"Отпечатки шардируются по {len(DEDUPLICATOR_REDIS_NODES)} узлам Redis.")
+
+        dedup_policies = build_policies(
+            DEDUPLICATOR_POLICIES,
+            field=DEDUPLICATOR_POLICY_FIELD,
+            default_key_fields=DEDUPLICATOR_KEY_FIELDS,
+            default_ttl=DEDUPLICATOR_TTL_SECONDS,
+            default_layout=DEDUPLICATOR_STORAGE_LAYOUT,
+            storage_factory=build_dedup_storage,
+            fingerprint_algorithm=DEDUPLICATOR_FINGERPRINT_ALGORITHM,
+            digest_size=DEDUPLICATOR_FINGERPRINT_DIGEST_SIZE,
+        )
+
+        near_duplicate_index = None
+        if DEDUPLICATOR_NEAR_FIELDS:
+            unknown_near_fields = set(DEDUPLICATOR_NEAR_FIELDS) - set(DEDUPLICATOR_KEY_FIELDS)
+            if unknown_near_fields:
+                raise ValueError(f"Поля почти-дублей не входят в DEDUPLICATOR_KEY_FIELDS: "
+                                 f"{', '.join(sorted(unknown_near_fields))}")
+            # Индекс - в REDIS_HOST:REDIS_PORT/REDIS_DB_DEDUP, без шардирования по DEDUPLICATOR_REDIS_NODES
+            near_duplicate_index = NearDuplicateIndex(
+                dedup_redis_client,
+                MinHasher(DEDUPLICATOR_NEAR_FIELDS, num_hashes=DEDUPLICATOR_NEAR_NUM_HASHES,
+                          ngram=DEDUPLICATOR_NEAR_NGRAM),
+                bands=DEDUPLICATOR_NEAR_BANDS,
+                threshold=DEDUPLICATOR_NEAR_THRESHOLD,
+                bucket_size=DEDUPLICATOR_NEAR_BUCKET_SIZE,
+                max_candidates=DEDUPLICATOR_NEAR_MAX_CANDIDATES,
+            )
+            near_duplicate_index.async_max_connections = REDIS_ASYNC_MAX_CONNECTIONS
+
         EVENT_DEDUPLICATOR_INSTANCE = EventDeduplicator(
             redis_client=REDIS_INSTANCE,
             ttl_seconds=DEDUPLICATOR_TTL_SECONDS,
-            key_fields=DEDUPLICATOR_KEY_FIELDS
+            key_fields=DEDUPLICATOR_KEY_FIELDS,
+            local_cache=FingerprintCache(
+                max_size=DEDUPLICATOR_L1_CACHE_SIZE,
+                ttl_seconds=DEDUPLICATOR_L1_CACHE_TTL_SECONDS,
+            ) if DEDUPLICATOR_L1_CACHE_SIZE > 0 else None,
+            storage=dedup_storage,
+            fingerprint_algorithm=DEDUPLICATOR_FINGERPRINT_ALGORITHM,
+            digest_size=DEDUPLICATOR_FINGERPRINT_DIGEST_SIZE,
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=DEDUPLICATOR_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=DEDUPLICATOR_BREAKER_RESET_TIMEOUT,
+                half_open_max_calls=DEDUPLICATOR_BREAKER_HALF_OPEN_CALLS,
+            ) if DEDUPLICATOR_BREAKER_FAILURE_THRESHOLD > 0 else None,
+            policies=dedup_policies,
+            policy_field=DEDUPLICATOR_POLICY_FIELD,
+            duplicate_hits=DuplicateHits(
+                dedup_redis_client,
+                key=DEDUPLICATOR_DUPLICATE_HITS_KEY,
+                interval=DEDUPLICATOR_DUPLICATE_HITS_FLUSH_INTERVAL,
+                count=DEDUPLICATOR_DUPLICATE_HITS,
+                sliding=DEDUPLICATOR_SLIDING_WINDOW,
+            ) if DEDUPLICATOR_DUPLICATE_HITS or DEDUPLICATOR_SLIDING_WINDOW else None,
+            near_duplicates=near_duplicate_index,
         )
         print("Инстанс EventDeduplicator успешно создан (с синхронный Redis клиентом).")
+        for policy in dedup_policies:
+            print(f"Политика дедупликации {policy.name}: TTL {policy.ttl} с, "
+                  f"поля {', '.join(policy.key_fields)}, {type(policy.storage).__name__}")
+
+        if DEDUPLICATOR_TRANSPORT not in TRANSPORTS:
+            raise ValueError(f"Неизвестный транспорт: {DEDUPLICATOR_TRANSPORT!r} (допустимы {', '.join(TRANSPORTS)})")
+        if DEDUPLICATOR_DEGRADED_MODE not in DEGRADED_MODES:
+            raise ValueError(f"Неизвестный режим деградации: {DEDUPLICATOR_DEGRADED_MODE!r} "
+                             f"(допустимы {', '.join(DEGRADED_MODES)})")
+        EVENT_STREAM_INSTANCE = EventStream(
+            REDIS_INSTANCE,
+            key=DEDUPLICATOR_STREAM_KEY,
+            group=DEDUPLICATOR_STREAM_GROUP,
+            maxlen=DEDUPLICATOR_STREAM_MAXLEN,
+        )
+        EVENT_STREAM_INSTANCE.async_max_connections = REDIS_ASYNC_MAX_CONNECTIONS
     except ValueError as e:
          print(f"Ошибка конфигурации EventDeduplicator: {e}")
 
@@ -92,6 +421,7 @@ except (redis.RedisError, ImportError, Exception) as e:
     print(f"Ошибка при настройке Redis или Deduplicator: {e}")
     REDIS_INSTANCE = None
     EVENT_DEDUPLICATOR_INSTANCE = None
+    EVENT_STREAM_INSTANCE = None
 
 MIDDLEWARE = [
      'django.middleware.security.SecurityMiddleware',
@@ -181,15 +511,93 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+REST_FRAMEWORK = {
+    'DEFAULT_PARSER_CLASSES': [
+        'deduplicator.parsers.FastJSONParser' if DEDUPLICATOR_FAST_JSON else 'deduplicator.parsers.BoundedJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'deduplicator.renderers.FastJSONRenderer' if DEDUPLICATOR_FAST_JSON else 'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/1'
 CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/1'
 
-CELERY_ACCEPT_CONTENT = ['json']
-CELERY_TASK_SERIALIZER = 'json'
+from deduplicator.serialization import check_compression, register_celery_serializer
+
+register_celery_serializer(DEDUPLICATOR_CELERY_SERIALIZER)
+if DEDUPLICATOR_CELERY_BATCH_COMPRESSION:
+    check_compression(DEDUPLICATOR_CELERY_BATCH_COMPRESSION)
+
+CELERY_ACCEPT_CONTENT = sorted({'json', DEDUPLICATOR_CELERY_SERIALIZER})
+CELERY_TASK_SERIALIZER = DEDUPLICATOR_CELERY_SERIALIZER
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
 CELERY_RESULT_EXPIRES = 3600
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+
+ADMISSION_CONTROLLER = None
+
+if REDIS_INSTANCE is not None:
+    from deduplicator.admission import (AdmissionController, QueueDepthProbe, TokenBucketLimiter,
+                                        celery_queue_depth, stream_depth)
+
+    # Контроль приема не должен держать запрос дольше таймаута: клиенты - с таймаутами
+    admission_redis_options = {
+        'decode_responses': True,
+        'socket_timeout': DEDUPLICATOR_REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': DEDUPLICATOR_REDIS_CONNECT_TIMEOUT,
+    }
+    admission_redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, **admission_redis_options)
+    try:
+        if DEDUPLICATOR_TRANSPORT == 'stream':
+            read_queue_depth = stream_depth(admission_redis_client, DEDUPLICATOR_STREAM_KEY, DEDUPLICATOR_STREAM_GROUP)
+        else:
+            read_queue_depth = celery_queue_depth(
+                redis.Redis.from_url(CELERY_BROKER_URL, **admission_redis_options),
+                CELERY_TASK_DEFAULT_QUEUE,
+            )
+        ADMISSION_CONTROLLER = AdmissionController(
+            depth_probe=QueueDepthProbe(
+                read_queue_depth,
+                DEDUPLICATOR_ADMISSION_DEPTH_INTERVAL,
+            ) if DEDUPLICATOR_ADMISSION_HIGH_WATERMARK > 0 else None,
+            high_watermark=DEDUPLICATOR_ADMISSION_HIGH_WATERMARK,
+            low_watermark=DEDUPLICATOR_ADMISSION_LOW_WATERMARK,
+            retry_after=DEDUPLICATOR_ADMISSION_RETRY_AFTER,
+            limiter=TokenBucketLimiter(
+                admission_redis_client,
+                rate=DEDUPLICATOR_RATE_LIMIT,
+                burst=DEDUPLICATOR_RATE_LIMIT_BURST,
+            ) if DEDUPLICATOR_RATE_LIMIT > 0 else None,
+        )
+    except ValueError as e:
+        print(f"Ошибка конфигурации контроля приема: {e}")
+
+# Периодические задачи (celery -A KN_practice beat)
+CELERY_BEAT_SCHEDULE = {
+    # Дневные секции UniqueEvent на DEDUPLICATOR_PARTITION_DAYS_AHEAD дней вперед
+    'maintain-event-partitions': {
+        'task': 'deduplicator.tasks.maintain_event_partitions',
+        'schedule': 6 * 3600,
+    },
+}
+
+if DEDUPLICATOR_DUPLICATE_HITS:
+    # Счетчики повторов из Redis - в UniqueEvent.duplicate_count и last_seen_at
+    CELERY_BEAT_SCHEDULE['flush-duplicate-hits'] = {
+        'task': 'deduplicator.tasks.flush_duplicate_hits',
+        'schedule': DEDUPLICATOR_DUPLICATE_HITS_DB_INTERVAL,
+    }
+
+from deduplicator.eventlog import LOG_MODES
+
+if DEDUPLICATOR_LOG_MODE not in LOG_MODES:
+    raise ValueError(f"Неизвестный режим логирования: {DEDUPLICATOR_LOG_MODE!r} (допустимы {', '.join(LOG_MODES)})")
 
 LOGGING = {
     'version': 1,
@@ -224,7 +632,7 @@ LOGGING = {
         },
         'deduplicator': { # НАШ логгер (для приложения deduplicator)
             'handlers': ['console'],
-            'level': 'DEBUG', # Выводим ВСЕ сообщения (DEBUG, INFO, WARNING, ERROR, CRITICAL) от нашего приложения
+            'level': DEDUPLICATOR_LOG_LEVEL, # В 'verbose' по умолчанию выводим ВСЕ сообщения нашего приложения
             'propagate': False, # Не передавать сообщения выше по иерархии
         },
          # Можно добавить логгер для celery, если нужно видеть его логи в том же формате
@@ -239,4 +647,14 @@ LOGGING = {
     #     'handlers': ['console'],
     #     'level': 'WARNING',
     # }
-}
\ No newline at end of file
+}
+
+if DEDUPLICATOR_LOG_MODE == 'production':
+    # Тоже stderr, но через очередь и отдельный поток: логирующий поток не ждет вывода
+    LOGGING['handlers']['console_queue'] = {
+        'level': 'DEBUG',
+        'class': 'deduplicator.eventlog.NonBlockingHandler',
+        'queue_size': DEDUPLICATOR_LOG_QUEUE_SIZE,
+        'formatter': 'verbose',
+    }
+    LOGGING['loggers']['deduplicator']['handlers'] = ['console_queue']
@@ -0,0 +1,83 @@
+"""
+Точность и пропускная способность Bloom-хранилища против точных раскладок.
+
+    python -m benchmarks.bench_bloom --redis-url redis://127.0.0.1:6379/15 --fingerprints 1000000 --error-rate 0.001
+
+Вставляет N разных отпечатков (все - новые), затем повторяет первые
+--repeat из них (все - дубли). Для каждой раскладки печатает:
+  * долю ложных дублей среди новых отпечатков (для точных раскладок - 0);
+  * долю пропущенных дублей (у всех раскладок должна быть 0);
+  * отпечатков в секунду и прирост used_memory.
+Нужна отдельная пустая БД Redis: она очищается между вариантами (FLUSHDB).
+"""
+
+import argparse
+import hashlib
+import time
+
+import redis
+
+from deduplicator.storage import build_storage
+
+TTL_SECONDS = 7 * 24 * 3600
+
+
+def fingerprints(count, seed):
+    return [hashlib.sha256(f"{seed}:{i}".encode()).hexdigest() for i in range(count)]
+
+
+def run_batches(storage, items, batch_size):
+    results = []
+    for start in range(0, len(items), batch_size):
+        results.extend(storage.add_many(items[start:start + batch_size]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/15')
+    parser.add_argument('--fingerprints', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=100_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    parser.add_argument('--expected-items', type=int, default=None,
+                        help='Емкость фильтра на корзину (по умолчанию = --fingerprints).')
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url)
+    if client.dbsize():
+        parser.error(f"БД {args.redis_url} не пуста - укажите отдельную БД для замера.")
+
+    options = {
+        'bloom_expected_items': args.expected_items or args.fingerprints,
+        'bloom_error_rate': args.error_rate,
+        'exact_layout': 'string',
+    }
+    new_items = fingerprints(args.fingerprints, seed='bench_bloom')
+    repeated = new_items[:args.repeat]
+
+    print(f"{args.fingerprints} new + {len(repeated)} repeated fingerprints, target error rate {args.error_rate}\n")
+    print(f"{'layout':<10} {'false dup rate':>15} {'missed dups':>12} {'fp/s':>12} {'memory MiB':>11}")
+    try:
+        for layout in ('string', 'bucketed', 'bloom', 'hybrid'):
+            client.flushdb()
+            storage = build_storage(layout, client, TTL_SECONDS, **options)
+            memory_before = client.info('memory')['used_memory']
+
+            started = time.perf_counter()
+            first_pass = run_batches(storage, new_items, args.batch_size)
+            second_pass = run_batches(storage, repeated, args.batch_size)
+            elapsed = time.perf_counter() - started
+
+            memory = client.info('memory')['used_memory'] - memory_before
+            false_duplicates = first_pass.count(False)
+            missed_duplicates = second_pass.count(True)
+            rate = (len(new_items) + len(repeated)) / elapsed
+            print(f"{layout:<10} {false_duplicates / len(new_items):>15.6f} {missed_duplicates:>12} "
+                  f"{rate:>12,.0f} {memory / 2 ** 20:>11.1f}")
+    finally:
+        client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
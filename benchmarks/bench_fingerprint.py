@@ -0,0 +1,89 @@
+"""
+Микробенчмарк генерации отпечатков: исходная реализация
+(_generate_fingerprint до прекомпиляции) против функций build_fingerprinter.
+
+    python -m benchmarks.bench_fingerprint --events 200000
+
+Не требует Redis, PostgreSQL и Django.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import time
+
+from deduplicator.fingerprint import build_fingerprinter
+
+KEY_FIELDS = ['event_name', 'userId', 'client_id', 'product_id', 'content_id', 'channel_id']
+
+
+def original_fingerprinter(key_fields):
+    # Исходный код EventDeduplicator._generate_fingerprint
+    key_fields = sorted(key_fields)
+
+    def fingerprint(event_data):
+        key_data = {field: event_data.get(field) for field in key_fields}
+        canonical_string = json.dumps(key_data, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical_string.encode('utf-8')).hexdigest()
+
+    return fingerprint
+
+
+def make_events(count, seed=42):
+    rnd = random.Random(seed)
+    events = []
+    for i in range(count):
+        events.append({
+            'event_name': rnd.choice(['page_view', 'add_to_cart', 'purchase', 'play']),
+            'userId': f"user-{rnd.randrange(1_000_000)}",
+            'client_id': rnd.randrange(10_000),
+            'product_id': f"p{rnd.randrange(50_000)}",
+            'content_id': rnd.choice([None, f"c{rnd.randrange(100_000)}"]),
+            'channel_id': rnd.choice(['web', 'ios', 'android']),
+            'timestamp': 1_700_000_000 + i,
+            'payload': {'ref': 'bench', 'n': i},
+        })
+    return events
+
+
+def bench(fingerprint, events, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for event in events:
+            fingerprint(event)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200_000)
+    parser.add_argument('--rounds', type=int, default=3, help='Берется лучший из N прогонов.')
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    variants = [
+        ("original json.dumps + sha256", original_fingerprinter(KEY_FIELDS)),
+        ("sha256-json (precompiled)", build_fingerprinter(KEY_FIELDS, 'sha256-json')),
+        ("v2 sha256", build_fingerprinter(KEY_FIELDS, 'sha256')),
+        ("v2 blake2b digest=32", build_fingerprinter(KEY_FIELDS, 'blake2b', 32)),
+        ("v2 blake2b digest=16", build_fingerprinter(KEY_FIELDS, 'blake2b', 16)),
+        ("v2 blake2b digest=8", build_fingerprinter(KEY_FIELDS, 'blake2b', 8)),
+    ]
+
+    # Прекомпилированный исходный формат обязан давать те же отпечатки
+    original, legacy = variants[0][1], variants[1][1]
+    assert all(original(event) == legacy(event) for event in events[:1000]), "sha256-json разошелся с исходным форматом"
+
+    baseline = None
+    for name, fingerprint in variants:
+        seconds = bench(fingerprint, events, args.rounds)
+        rate = len(events) / seconds
+        baseline = baseline or rate
+        print(f"{name:<32} {rate:>12,.0f} events/s  x{rate / baseline:.2f}")
+
+
+if __name__ == '__main__':
+    main()
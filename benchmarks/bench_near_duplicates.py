@@ -0,0 +1,249 @@
+"""
+Точность, полнота и пропускная способность поиска почти-дублей
+(deduplicator/similarity.py) на синтетическом потоке.
+
+    python -m benchmarks.bench_near_duplicates --redis-url redis://127.0.0.1:6379/15 --events 20000
+
+Поток: события одного пользователя (userId - точное поле ключа, блок LSH)
+с полями content_id вида "movie-48213-v2" и title из 4-8 слов; почти-дубли
+(content_id, title - поля MinHash). Доля --near-ratio событий - искажение
+одного из уже выданных:
+  variant  другая версия content_id ("-v2" -> "-v3");
+  reorder  слова title переставлены;
+  typo     в одном слове title переставлены две соседние буквы;
+  drop     из title выброшено одно слово.
+Остальные события - новые. Доля --hard-ratio из них - трудные негативы:
+тот же пользователь и title, что у выданного события, но другой номер
+content_id (другая серия того же шоу) - их находить нельзя.
+
+Печатает:
+  * точность (найденное похожее событие - из той же группы искажений) и
+    полноту (доля найденных искажений) для точного SHA-256 и для сетки
+    --ngrams x --thresholds, полноту - и по видам искажений;
+  * мкс на сигнатуру, событий в секунду через Redis (пакеты по --batch-size)
+    и used_memory, когда в индексе уже лежат --fill событий других
+    пользователей: стоимость проверки не должна расти с размером индекса.
+Нужна отдельная пустая БД Redis: она очищается между вариантами (FLUSHDB).
+"""
+
+import argparse
+import random
+import string
+import time
+
+import redis
+
+from deduplicator.fingerprint import build_fingerprinter
+from deduplicator.policies import DedupPolicy
+from deduplicator.similarity import MinHasher, NearDuplicateIndex
+from deduplicator.storage import build_storage
+
+KEY_FIELDS = ['event_name', 'userId', 'content_id', 'title']
+NEAR_FIELDS = ['content_id', 'title']
+MUTATIONS = ('variant', 'reorder', 'typo', 'drop')
+TTL_SECONDS = 7 * 24 * 3600
+
+
+class Stream:
+    """Поток событий с разметкой: (событие, группа, искажение или None, трудный ли негатив)."""
+
+    def __init__(self, seed, users, vocabulary=5000):
+        self.rnd = random.Random(seed)
+        self.users = users
+        self.words = [
+            ''.join(self.rnd.choices(string.ascii_lowercase, k=self.rnd.randint(3, 9))) for _ in range(vocabulary)
+        ]
+        self.groups = []
+
+    def original(self, user=None, title=None):
+        rnd = self.rnd
+        return {
+            'event_name': 'content_view',
+            'userId': user if user is not None else f"user-{rnd.randrange(self.users)}",
+            'content_id': f"{rnd.choice(('movie', 'series', 'clip'))}-{rnd.randrange(100000)}-v{rnd.randint(1, 5)}",
+            'title': title or ' '.join(rnd.choices(self.words, k=rnd.randint(4, 8))),
+        }
+
+    def mutate(self, event, mutation):
+        rnd = self.rnd
+        event = dict(event)
+        words = event['title'].split()
+        if mutation == 'variant':
+            head, version = event['content_id'].rsplit('-v', 1)
+            event['content_id'] = f"{head}-v{int(version) % 9 + 1}"
+        elif mutation == 'reorder':
+            shuffled = words[:]
+            while shuffled == words:
+                rnd.shuffle(shuffled)
+            event['title'] = ' '.join(shuffled)
+        elif mutation == 'typo':
+            index = rnd.randrange(len(words))
+            word = words[index]
+            position = rnd.randrange(len(word) - 1)
+            words[index] = word[:position] + word[position + 1] + word[position] + word[position + 2:]
+            event['title'] = ' '.join(words)
+        else:
+            del words[rnd.randrange(len(words))]
+            event['title'] = ' '.join(words)
+        return event
+
+    def events(self, count, near_ratio, hard_ratio):
+        rnd = self.rnd
+        result = []
+        for _ in range(count):
+            if self.groups and rnd.random() < near_ratio:
+                group = rnd.randrange(len(self.groups))
+                mutation = rnd.choice(MUTATIONS)
+                event = self.mutate(self.groups[group], mutation)
+                if event == self.groups[group]:
+                    # typo в слове из двух одинаковых букв ничего не меняет
+                    mutation = 'reorder' if len(event['title'].split()) > 1 else 'variant'
+                    event = self.mutate(event, mutation)
+                result.append((event, group, mutation, False))
+                continue
+            hard = bool(self.groups) and rnd.random() < hard_ratio
+            if hard:
+                source = self.groups[rnd.randrange(len(self.groups))]
+                event = self.original(user=source['userId'], title=source['title'])
+            else:
+                event = self.original()
+            self.groups.append(event)
+            result.append((event, len(self.groups) - 1, None, hard))
+        return result
+
+
+def quality(found, labeled, group_of):
+    """Точность, полнота, полнота по видам искажений, доля найденных трудных негативов."""
+    true_positive = false_positive = hard_found = hard_total = 0
+    by_mutation = {mutation: [0, 0] for mutation in MUTATIONS}
+    for match, (_, group, mutation, hard) in zip(found, labeled):
+        hard_total += hard
+        if mutation is not None:
+            by_mutation[mutation][1] += 1
+        if match is None:
+            continue
+        if mutation is not None and group_of.get(match) == group:
+            true_positive += 1
+            by_mutation[mutation][0] += 1
+        else:
+            false_positive += 1
+            hard_found += hard
+    positives = sum(total for _, total in by_mutation.values())
+    return (
+        true_positive / (true_positive + false_positive) if true_positive + false_positive else 1.0,
+        true_positive / positives if positives else 0.0,
+        {mutation: hit / total if total else 0.0 for mutation, (hit, total) in by_mutation.items()},
+        hard_found / hard_total if hard_total else 0.0,
+    )
+
+
+def run_index(index, policy, fingerprint, labeled, batch_size):
+    """Пропускает поток через индекс; ответы и секунды на Redis (без сигнатур)."""
+    probes = [index.probe(event, fingerprint(event), policy) for event, _, _, _ in labeled]
+    found = []
+    started = time.perf_counter()
+    for start in range(0, len(probes), batch_size):
+        found.extend(index.find_or_add_many(probes[start:start + batch_size]))
+    return found, time.perf_counter() - started
+
+
+def fill_index(index, policy, fingerprint, count, batch_size, seed):
+    # События других пользователей: в блоки потока не попадают, только занимают память
+    filler = Stream(seed, users=1_000_000)
+    for start in range(0, count, batch_size):
+        events = [filler.original() for _ in range(min(batch_size, count - start))]
+        index.find_or_add_many([index.probe(event, fingerprint(event), policy) for event in events])
+
+
+def best_of(rounds, func, items):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/15')
+    parser.add_argument('--events', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=500, help='Distinct userId values (LSH blocks) in the stream.')
+    parser.add_argument('--near-ratio', type=float, default=0.3, help='Share of events that distort an earlier one.')
+    parser.add_argument('--hard-ratio', type=float, default=0.1,
+                        help='Share of new events reusing an earlier title with another content_id.')
+    parser.add_argument('--num-hashes', type=int, default=64)
+    parser.add_argument('--bands', type=int, default=16)
+    parser.add_argument('--ngrams', default='2,3', help='Comma-separated n-gram sizes to compare.')
+    parser.add_argument('--thresholds', default='0.5,0.6,0.7,0.8', help='Comma-separated thresholds to compare.')
+    parser.add_argument('--ngram', type=int, default=2, help='N-gram size for the throughput table.')
+    parser.add_argument('--threshold', type=float, default=0.7, help='Threshold for the throughput table.')
+    parser.add_argument('--bucket-size', type=int, default=32)
+    parser.add_argument('--max-candidates', type=int, default=64)
+    parser.add_argument('--fill', default='0,100000,500000', help='Comma-separated index sizes before the stream.')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    if client.dbsize():
+        parser.error(f"БД {args.redis_url} не пуста - укажите отдельную БД для замера.")
+
+    labeled = Stream(args.seed, args.users).events(args.events, args.near_ratio, args.hard_ratio)
+    events = [event for event, _, _, _ in labeled]
+    fingerprint = build_fingerprinter(KEY_FIELDS)
+    group_of = {fingerprint(event): group for event, group, _, _ in labeled}
+    policy = DedupPolicy('bench_near', KEY_FIELDS, TTL_SECONDS,
+                         build_storage('string', client, TTL_SECONDS, prefix='bench_near'), fingerprint)
+
+    positives = sum(mutation is not None for _, _, mutation, _ in labeled)
+    hard = sum(hard for _, _, _, hard in labeled)
+    print(f"{len(labeled)} events: {positives} near duplicates, {hard} hard negatives, {args.users} users, "
+          f"{args.num_hashes} hashes in {args.bands} bands\n")
+
+    seen = set()
+    exact = []
+    for event in events:
+        key = fingerprint(event)
+        exact.append(key if key in seen else None)
+        seen.add(key)
+    precision, recall, _, _ = quality(exact, labeled, group_of)
+    print(f"{'method':<22} {'precision':>9} {'recall':>7} {'hard neg':>9}  "
+          + ' '.join(f"{mutation:>7}" for mutation in MUTATIONS))
+    print(f"{'exact sha256':<22} {precision:>9.3f} {recall:>7.3f} {0:>9.3f}  "
+          + ' '.join(f"{0:>7.3f}" for _ in MUTATIONS))
+
+    for ngram in (int(value) for value in args.ngrams.split(',')):
+        hasher = MinHasher(NEAR_FIELDS, num_hashes=args.num_hashes, ngram=ngram)
+        for threshold in (float(value) for value in args.thresholds.split(',')):
+            client.flushdb()
+            index = NearDuplicateIndex(client, hasher, bands=args.bands, threshold=threshold,
+                                       bucket_size=args.bucket_size, max_candidates=args.max_candidates)
+            found, _ = run_index(index, policy, fingerprint, labeled, args.batch_size)
+            precision, recall, by_mutation, hard_found = quality(found, labeled, group_of)
+            print(f"{f'minhash n={ngram} t={threshold}':<22} {precision:>9.3f} {recall:>7.3f} {hard_found:>9.3f}  "
+                  + ' '.join(f"{by_mutation[mutation]:>7.3f}" for mutation in MUTATIONS))
+
+    hasher = MinHasher(NEAR_FIELDS, num_hashes=args.num_hashes, ngram=args.ngram)
+    index = NearDuplicateIndex(client, hasher, bands=args.bands, threshold=args.threshold,
+                               bucket_size=args.bucket_size, max_candidates=args.max_candidates)
+    signature = best_of(3, hasher.signature, events) / len(events) * 1e6
+    probe = best_of(3, lambda event: index.probe(event, 'x' * 32, policy), events) / len(events) * 1e6
+    print(f"\nn={args.ngram} t={args.threshold}: signature {signature:.1f} us/event, "
+          f"signature + band keys {probe:.1f} us/event")
+    print(f"{'indexed before':>14} {'events/s':>10} {'us/event':>9} {'memory MiB':>11} {'recall':>7}")
+    for size in (int(value) for value in args.fill.split(',')):
+        client.flushdb()
+        fill_index(index, policy, fingerprint, size, args.batch_size, args.seed + 1)
+        memory = client.info('memory')['used_memory']
+        found, seconds = run_index(index, policy, fingerprint, labeled, args.batch_size)
+        memory = client.info('memory')['used_memory'] - memory
+        _, recall, _, _ = quality(found, labeled, group_of)
+        print(f"{size:>14} {len(labeled) / seconds:>10,.0f} {seconds / len(labeled) * 1e6:>9.1f} "
+              f"{memory / 2 ** 20:>11.1f} {recall:>7.3f}")
+    client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""
+Воспроизводимый бенчмарк конвейера: отдельные стадии и весь путь целиком
+на локальных Redis и PostgreSQL. Результат - JSON для сравнения версий.
+
+    python -m benchmarks.bench_pipeline --events 20000 --output results.json
+    python -m benchmarks.bench_pipeline --scenarios dedup,dedup-batch --duplicate-ratio 0.5 --baseline results.json
+    python -m benchmarks.bench_pipeline --scenarios http --url http://127.0.0.1:8000/api/v1/check_event/
+
+Сценарии:
+  dedup        EventDeduplicator.check_duplication, задержка - на событие;
+  dedup-batch  EventDeduplicator.check_duplication_many пакетами --batch-size;
+  task         задача process_event, вызванная в процессе: дедупликация,
+               буфер записи и сброс в PostgreSQL;
+  api          check_event_api через тестовый клиент Django: разбор запроса
+               и постановка задачи в брокер (во временную очередь, которая
+               удаляется в конце - воркеры ее не читают);
+  e2e          check_event_api с task_always_eager: API, дедупликация и запись
+               в PostgreSQL в одном процессе;
+  http         запросы к запущенному серверу (--url) с воркерами; время - до
+               появления в БД всех уникальных событий.
+
+Генератор событий - benchmarks/generator.py. Для task, e2e и http
+проверяется, что в БД попало ровно столько строк, сколько уникальных
+событий; строки бенчмарка удаляются после каждого сценария.
+
+Отпечатки пишутся в отдельную БД Redis (--redis-db, по умолчанию 15),
+которая очищается (FLUSHDB) перед каждым сценарием; по разнице
+used_memory считается память на миллион отпечатков. Сценарий http
+работает с Redis сервера, память для него не считается.
+
+Логи уровня INFO на время замера отключаются (--with-logs - оставить).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from benchmarks.common import percentile, setup_django
+from benchmarks.generator import EventGenerator, unique_count
+
+SCENARIOS = ('dedup', 'dedup-batch', 'task', 'api', 'e2e', 'http')
+DEFAULT_SCENARIOS = ('dedup', 'dedup-batch', 'task', 'api', 'e2e')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(name, events, seconds, latencies, latency_unit, **extra):
+    latencies = sorted(latencies)
+    ms = 1000
+    result = {
+        'scenario': name,
+        'events': len(events),
+        'unique_events': unique_count(events),
+        'seconds': round(seconds, 4),
+        'events_per_sec': round(len(events) / seconds, 1) if seconds else None,
+        'latency_unit': latency_unit,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * ms, 4),
+            'p99': round(percentile(latencies, 0.99) * ms, 4),
+            'max': round(latencies[-1] * ms, 4),
+        } if latencies else None,
+    }
+    result.update(extra)
+    return result
+
+
+class RedisMemory:
+    """Замер памяти БД Redis с отпечатками."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def reset(self):
+        self.client.flushdb()
+        self.before = self.client.info('memory')['used_memory']
+
+    def usage(self, fingerprints):
+        used = self.client.info('memory')['used_memory'] - self.before
+        return {
+            'redis_keys': self.client.dbsize(),
+            'redis_bytes_per_million_fingerprints': round(used / fingerprints * 1_000_000) if fingerprints else None,
+        }
+
+
+def stored_rows(run_id):
+    from deduplicator.models import UniqueEvent
+    return UniqueEvent.objects.filter(event_data__bench_run=run_id).count()
+
+
+def cleanup_rows(run_id):
+    from deduplicator.models import UniqueEvent
+    UniqueEvent.objects.filter(event_data__bench_run=run_id).delete()
+
+
+def bench_dedup(deduplicator, events, redis_memory):
+    redis_memory.reset()
+    latencies, duplicates = [], 0
+    started = time.perf_counter()
+    for event in events:
+        call_started = time.perf_counter()
+        is_duplicate, _ = deduplicator.check_duplication(event)
+        latencies.append(time.perf_counter() - call_started)
+        duplicates += is_duplicate
+    elapsed = time.perf_counter() - started
+    return summarize('dedup', events, elapsed, latencies, 'event', duplicates_detected=duplicates,
+                     **redis_memory.usage(unique_count(events)))
+
+
+def bench_dedup_batch(deduplicator, events, batch_size, redis_memory):
+    redis_memory.reset()
+    latencies, duplicates = [], 0
+    started = time.perf_counter()
+    for start in range(0, len(events), batch_size):
+        call_started = time.perf_counter()
+        results = deduplicator.check_duplication_many(events[start:start + batch_size])
+        latencies.append(time.perf_counter() - call_started)
+        duplicates += sum(is_duplicate for is_duplicate, _ in results)
+    elapsed = time.perf_counter() - started
+    return summarize('dedup-batch', events, elapsed, latencies, f'batch of {batch_size}',
+                     duplicates_detected=duplicates, **redis_memory.usage(unique_count(events)))
+
+
+def bench_task(events, run_id, redis_memory):
+    from deduplicator.tasks import process_event, unique_event_writer
+
+    redis_memory.reset()
+    latencies = []
+    started = time.perf_counter()
+    for event in events:
+        call_started = time.perf_counter()
+        process_event(event_data=event)
+        latencies.append(time.perf_counter() - call_started)
+    # Время включает сброс буфера: все уникальные события должны оказаться в БД
+    unique_event_writer.flush()
+    elapsed = time.perf_counter() - started
+    return summarize('task', events, elapsed, latencies, 'event', rows_stored=stored_rows(run_id),
+                     **redis_memory.usage(unique_count(events)))
+
+
+def post_events(client, events):
+    latencies, statuses = [], {}
+    for event in events:
+        call_started = time.perf_counter()
+        response = client.post('/api/v1/check_event/', data=json.dumps(event), content_type='application/json')
+        latencies.append(time.perf_counter() - call_started)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return latencies, statuses
+
+
+def bench_api(events, run_id, redis_memory):
+    from django.test import Client
+    from KN_practice.celery import app
+
+    queue = f"bench_{run_id}"
+    # Конфигурация Celery загружена с namespace 'CELERY': ключ CELERY_TASK_DEFAULT_QUEUE из
+    # settings.py перекрывает task_default_queue, подменять нужно его
+    default_queue = app.conf.CELERY_TASK_DEFAULT_QUEUE
+    app.conf.CELERY_TASK_DEFAULT_QUEUE = queue
+    redis_memory.reset()
+    try:
+        started = time.perf_counter()
+        latencies, statuses = post_events(Client(HTTP_HOST='localhost'), events)
+        elapsed = time.perf_counter() - started
+    finally:
+        app.conf.CELERY_TASK_DEFAULT_QUEUE = default_queue
+        # Брокер - Redis: очередь - список, привязка к обменнику - множество _kombu.binding.<обменник>
+        with app.connection_for_write() as connection:
+            connection.default_channel.client.delete(queue, f"_kombu.binding.{queue}")
+    return summarize('api', events, elapsed, latencies, 'request', statuses=statuses)
+
+
+def bench_e2e(events, run_id, redis_memory):
+    from django.test import Client
+    from KN_practice.celery import app
+    from deduplicator.tasks import unique_event_writer
+
+    app.conf.task_always_eager = True
+    redis_memory.reset()
+    try:
+        started = time.perf_counter()
+        latencies, statuses = post_events(Client(HTTP_HOST='localhost'), events)
+        unique_event_writer.flush()
+        elapsed = time.perf_counter() - started
+    finally:
+        app.conf.task_always_eager = False
+    return summarize('e2e', events, elapsed, latencies, 'request', statuses=statuses, rows_stored=stored_rows(run_id),
+                     **redis_memory.usage(unique_count(events)))
+
+
+def bench_http(events, run_id, url, concurrency, drain_timeout):
+    from benchmarks.load_inline_endpoint import connection_worker
+
+    async def send():
+        parts = urlsplit(url)
+        queue = asyncio.Queue()
+        for event in events:
+            queue.put_nowait(json.dumps(event).encode('utf-8'))
+        latencies, statuses = [], {}
+        await asyncio.gather(*[
+            connection_worker(parts.hostname, parts.port or 80, parts.path, queue, latencies, statuses)
+            for _ in range(concurrency)
+        ])
+        return latencies, statuses
+
+    expected = unique_count(events)
+    started = time.perf_counter()
+    latencies, statuses = asyncio.run(send())
+    accepted_in = time.perf_counter() - started
+
+    # Конец сквозного замера - все уникальные события в БД
+    rows = stored_rows(run_id)
+    while rows < expected and time.perf_counter() - started < drain_timeout:
+        time.sleep(0.2)
+        rows = stored_rows(run_id)
+    elapsed = time.perf_counter() - started
+    return summarize('http', events, elapsed, latencies, 'request', statuses=statuses, rows_stored=rows,
+                     api_seconds=round(accepted_in, 4), drained=rows >= expected)
+
+
+def check(result):
+    """Пометки о несовпадении с ожидаемым результатом (дубли не отсеяны, строки потеряны)."""
+    problems = []
+    expected_duplicates = result['events'] - result['unique_events']
+    if 'duplicates_detected' in result and result['duplicates_detected'] != expected_duplicates:
+        problems.append(f"duplicates detected {result['duplicates_detected']}, expected {expected_duplicates}")
+    if 'rows_stored' in result and result['rows_stored'] != result['unique_events']:
+        problems.append(f"rows stored {result['rows_stored']}, expected {result['unique_events']}")
+    return problems
+
+
+def print_result(result, baseline=None):
+    latency = result['latency_ms'] or {}
+    line = (f"{result['scenario']:<12} {result['events']:>8} events {result['seconds']:>9.3f} s "
+            f"{result['events_per_sec'] or 0:>11,.0f} ev/s   p50 {latency.get('p50', 0):>8.3f} ms  "
+            f"p99 {latency.get('p99', 0):>8.3f} ms / {result['latency_unit']}")
+    if result.get('redis_bytes_per_million_fingerprints'):
+        line += f"   redis {result['redis_bytes_per_million_fingerprints'] / 2 ** 20:,.1f} MiB/1M fp"
+    print(line)
+    if baseline:
+        throughput = _change(baseline.get('events_per_sec'), result['events_per_sec'])
+        p99 = _change((baseline.get('latency_ms') or {}).get('p99'), latency.get('p99'))
+        print(f"{'':<12} vs baseline: throughput {throughput}, p99 {p99}")
+    for problem in result.get('problems', []):
+        print(f"{'':<12} !! {problem}")
+
+
+def _change(old, new):
+    if not old or new is None:
+        return 'n/a'
+    return f"{(new - old) / old:+.1%}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"Comma separated: {', '.join(SCENARIOS)} (default: all but http).")
+    parser.add_argument('--events', type=int, default=20_000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3)
+    parser.add_argument('--key-cardinality', type=int, default=1000)
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=500, help='Batch size for dedup-batch.')
+    parser.add_argument('--redis-db', type=int, default=15, help='Scratch Redis DB for fingerprints (flushed!).')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/api/v1/check_event/', help='Target of the http scenario.')
+    parser.add_argument('--concurrency', type=int, default=32, help='Connections used by the http scenario.')
+    parser.add_argument('--drain-timeout', type=float, default=300.0,
+                        help='How long the http scenario waits for all unique events to reach the DB, s.')
+    parser.add_argument('--output', help='Write JSON results to this file ("-" for stdout).')
+    parser.add_argument('--baseline', help='Previous JSON results to compare against.')
+    parser.add_argument('--with-logs', action='store_true', help='Keep INFO logging enabled while measuring.')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Отпечатки - в отдельную БД Redis: переменная читается настройками при setup
+    os.environ['REDIS_DB_DEDUP'] = str(args.redis_db)
+    setup_django()
+    from django.conf import settings
+
+    if f"/{args.redis_db}" == urlsplit(settings.CELERY_BROKER_URL).path:
+        parser.error("--redis-db must not be the Celery broker DB: it is flushed before every scenario.")
+    deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+    if deduplicator is None:
+        parser.error("Event deduplicator is not configured (is Redis running?).")
+    if not args.with_logs:
+        logging.disable(logging.INFO)
+
+    generator = EventGenerator(args.duplicate_ratio, args.key_cardinality, args.payload_bytes, args.seed)
+    redis_memory = RedisMemory(settings.REDIS_INSTANCE)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'generator': generator.params(),
+            'settings': {
+                'storage_layout': settings.DEDUPLICATOR_STORAGE_LAYOUT,
+                'fingerprint_algorithm': settings.DEDUPLICATOR_FINGERPRINT_ALGORITHM,
+                'transport': settings.DEDUPLICATOR_TRANSPORT,
+                'ingest_dedup': settings.DEDUPLICATOR_INGEST_DEDUP,
+                'l1_cache_size': settings.DEDUPLICATOR_L1_CACHE_SIZE,
+                'writer_batch_size': settings.DEDUPLICATOR_WRITER_BATCH_SIZE,
+            },
+        },
+        'results': [],
+    }
+
+    print(f"run {generator.run_id}: {args.events} events per scenario, {generator.params()}")
+    for name in scenarios:
+        # У каждого сценария свои уникальные события
+        events = generator.events(args.events, prefix=f"{name}-")
+        try:
+            if name == 'dedup':
+                result = bench_dedup(deduplicator, events, redis_memory)
+            elif name == 'dedup-batch':
+                result = bench_dedup_batch(deduplicator, events, args.batch_size, redis_memory)
+            elif name == 'task':
+                result = bench_task(events, generator.run_id, redis_memory)
+            elif name == 'api':
+                result = bench_api(events, generator.run_id, redis_memory)
+            elif name == 'e2e':
+                result = bench_e2e(events, generator.run_id, redis_memory)
+            else:
+                result = bench_http(events, generator.run_id, args.url, args.concurrency, args.drain_timeout)
+        finally:
+            cleanup_rows(generator.run_id)
+        problems = check(result)
+        if problems:
+            result['problems'] = problems
+        report['results'].append(result)
+        print_result(result, baseline.get(name))
+    redis_memory.client.flushdb()
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
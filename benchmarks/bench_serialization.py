@@ -0,0 +1,260 @@
+"""
+Сериализация события на пути API -> брокер -> воркер -> БД: байты
+сообщения и процессорное время на событие для текущей схемы (JSONParser
+DRF, сериализатор Celery 'json', json.dumps в JSONField) и быстрых
+вариантов (deduplicator/serialization.py).
+
+    python -m benchmarks.bench_serialization --events 20000
+
+Стадии (мкс на событие, лучший из --rounds прогонов; publish - один прогон):
+  parse   разбор тела запроса с одним событием парсером DRF;
+  celery  кодирование и разбор тела сообщения задачи (args, kwargs, embed)
+          сериализатором kombu, для пакета - со сжатием;
+  db      кодирование event_data для JSONField (то, что делает Jsonb.dumps);
+  stream  текст события для XADD и его разбор потребителем;
+  publish отправка задачи в Redis-брокер целиком (apply_async), как раньше
+          и через transport.send_task.
+
+Байты на проводе - реальные сообщения брокера: задачи отправляются во
+временную очередь, берется длина элементов списка (конверт kombu с телом
+в base64 и заголовками Celery), затем очередь удаляется. У каждого
+события свой случайный payload, иначе сжатие пакета нереально хорошее.
+"""
+
+import argparse
+import io
+import json
+import random
+import string
+import time
+import uuid
+
+from kombu import compression
+from kombu.serialization import dumps as kombu_dumps, loads as kombu_loads
+
+from benchmarks.common import setup_django
+from benchmarks.generator import EventGenerator
+
+EMBED = {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}
+COMPRESSIONS = (None, 'zlib', 'bzip2', 'lzma')
+
+
+def best_of(rounds, func, items):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def usec(seconds, count):
+    return seconds / count * 1e6
+
+
+def encode_message(serializer, method, payload):
+    content_type, content_encoding, body = kombu_dumps(((), payload, EMBED), serializer=serializer)
+    if method:
+        body, _ = compression.compress(body, method)
+    return content_type, content_encoding, body
+
+
+def decode_message(content_type, content_encoding, body, method):
+    if method:
+        body = compression.decompress(body, compression.get_encoder(method)[1])
+    return kombu_loads(body, content_type, content_encoding, accept={content_type})
+
+
+def bench_parse(bodies, rounds):
+    from rest_framework.parsers import JSONParser
+    from deduplicator.parsers import FastJSONParser
+
+    results = {}
+    for name, parser in (('JSONParser (current)', JSONParser()), ('FastJSONParser', FastJSONParser())):
+        seconds = best_of(rounds, lambda body: parser.parse(io.BytesIO(body), 'application/json', {}), bodies)
+        results[name] = usec(seconds, len(bodies))
+    return results
+
+
+def bench_celery(payloads, serializers, methods, rounds, per_payload):
+    """(сериализатор, сжатие) -> (мкс кодирования, мкс разбора, байт тела) на событие."""
+    results = {}
+    for serializer in serializers:
+        for method in methods:
+            encoded = [encode_message(serializer, method, payload) for payload in payloads]
+            encode = best_of(rounds, lambda payload: encode_message(serializer, method, payload), payloads)
+            decode = best_of(rounds, lambda message: decode_message(*message, method), encoded)
+            count = len(payloads) * per_payload
+            results[(serializer, method)] = (
+                usec(encode, count),
+                usec(decode, count),
+                sum(len(body) for _, _, body in encoded) / count,
+            )
+    return results
+
+
+def bench_db(events, raw_events, rounds):
+    from deduplicator.serialization import EventJSONEncoder
+
+    return {
+        'json.dumps (current)': usec(best_of(rounds, json.dumps, events), len(events)),
+        'EventJSONEncoder, dict': usec(best_of(rounds, lambda e: json.dumps(e, cls=EventJSONEncoder), events),
+                                       len(events)),
+        'EventJSONEncoder, EventJSON': usec(best_of(rounds, lambda e: json.dumps(e, cls=EventJSONEncoder), raw_events),
+                                            len(raw_events)),
+    }
+
+
+def bench_stream(events, raw_events, rounds):
+    from deduplicator.serialization import EventJSON, event_json, loads
+
+    texts = [json.dumps(event) for event in events]
+    return {
+        'json.dumps + json.loads (current)': usec(
+            best_of(rounds, json.dumps, events) + best_of(rounds, json.loads, texts), len(events)
+        ),
+        'raw text + loads -> EventJSON': usec(
+            best_of(rounds, event_json, raw_events) + best_of(rounds, lambda text: EventJSON(loads(text), text), texts),
+            len(events)
+        ),
+    }
+
+
+def bench_publish(events, chunk_size, serializers, methods, sample):
+    """
+    Отправка задач в Redis-брокер (apply_async: сериализация, заголовки и
+    LPUSH): метка -> (мкс на событие по часам, мкс процессорного времени
+    на событие, байт сообщения на событие).
+    'celery default' - apply_async как раньше (kwargsrepr - saferepr
+    аргументов), остальное - transport.send_task.
+    """
+    from KN_practice.celery import app
+    from deduplicator.tasks import process_event, process_events_batch
+    from deduplicator.transport import send_task
+
+    queue = f"bench_serialization_{uuid.uuid4().hex[:8]}"
+    singles = events[:sample]
+    chunks = [events[i:i + chunk_size] for i in range(0, min(len(events), chunk_size * 8), chunk_size)]
+    results = {}
+    with app.connection_for_write() as connection:
+        client = connection.default_channel.client
+
+        def measure(label, publish, items, per_item):
+            started, cpu_started = time.perf_counter(), time.process_time()
+            for item in items:
+                publish(item)
+            elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+            count = len(items) * per_item
+            results[label] = (usec(elapsed, count), usec(cpu, count),
+                              sum(len(m) for m in client.lrange(queue, 0, -1)) / count)
+            client.delete(queue)
+
+        try:
+            for serializer in serializers:
+                measure(f"{serializer}, single event, celery default",
+                        lambda event: process_event.apply_async(kwargs={'event_data': event}, queue=queue,
+                                                                serializer=serializer),
+                        singles, 1)
+                measure(f"{serializer}, single event",
+                        lambda event: send_task(process_event, {'event_data': event}, queue=queue,
+                                                serializer=serializer),
+                        singles, 1)
+                for method in methods:
+                    measure(f"{serializer}, chunk of {chunk_size}" + (f", {method}" if method else ''),
+                            lambda chunk: send_task(process_events_batch, {'events': chunk}, compression=method,
+                                                    queue=queue, serializer=serializer),
+                            chunks, chunk_size)
+        finally:
+            client.delete(queue, f"_kombu.binding.{queue}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20_000)
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=500, help='Events per batch task (DEDUPLICATOR_BATCH_CHUNK_SIZE).')
+    parser.add_argument('--rounds', type=int, default=3, help='Best of N runs.')
+    parser.add_argument('--publish-sample', type=int, default=2000, help='Single-event tasks published to the broker.')
+    parser.add_argument('--no-broker', action='store_true', help='Skip publishing to the broker (no Redis needed).')
+    args = parser.parse_args()
+
+    setup_django()
+    from deduplicator.serialization import EventJSON, orjson, register_celery_serializer
+
+    serializers = ['json']
+    for name in ('orjson', 'msgpack'):
+        try:
+            register_celery_serializer(name)
+            serializers.append(name)
+        except ValueError as e:
+            print(f"skip {name}: {e}")
+    if orjson is None:
+        print("orjson is not installed: fast variants fall back to json")
+
+    events = EventGenerator(duplicate_ratio=0, payload_bytes=args.payload_bytes).events(args.events)
+    # У генератора payload один на поток - сжатие пакета было бы нереально хорошим
+    rnd = random.Random(1)
+    for event in events:
+        event['payload'] = ''.join(rnd.choices(string.ascii_letters + string.digits, k=args.payload_bytes))
+    bodies = [json.dumps(event).encode() for event in events]
+    raw_events = [EventJSON(event, body.decode()) for event, body in zip(events, bodies)]
+    print(f"{len(events)} events, request body {sum(map(len, bodies)) / len(bodies):.0f} bytes/event\n")
+
+    parse = bench_parse(bodies, args.rounds)
+    print("Request parsing, single-event body")
+    for name, value in parse.items():
+        print(f"  {name:<40} {value:>8.2f} us/event")
+
+    single = bench_celery([{'event_data': event} for event in events], serializers, [None], args.rounds, 1)
+    chunks = [{'events': events[i:i + args.chunk_size]} for i in range(0, len(events), args.chunk_size)]
+    batch = bench_celery(chunks, serializers, COMPRESSIONS, args.rounds, args.chunk_size)
+    print("\nCelery message body: encode / decode us/event, body bytes/event")
+    for (serializer, method), (encode, decode, size) in single.items():
+        print(f"  {serializer + ', single event':<40} {encode:>8.2f} {decode:>8.2f} {size:>9.0f}")
+    for (serializer, method), (encode, decode, size) in batch.items():
+        label = f"{serializer}, chunk of {args.chunk_size}" + (f", {method}" if method else '')
+        print(f"  {label:<40} {encode:>8.2f} {decode:>8.2f} {size:>9.0f}")
+
+    db = bench_db(events, raw_events, args.rounds)
+    print("\nJSONField encoding (event_data)")
+    for name, value in db.items():
+        print(f"  {name:<40} {value:>8.2f} us/event")
+
+    stream = bench_stream(events, raw_events, args.rounds)
+    print("\nRedis Stream entry: encode for XADD + decode in consume_events")
+    for name, value in stream.items():
+        print(f"  {name:<40} {value:>8.2f} us/event")
+
+    publish = None
+    if not args.no_broker:
+        publish = bench_publish(events, args.chunk_size, serializers, COMPRESSIONS, min(args.publish_sample, len(events)))
+        print("\nPublish to the Redis broker: wall / CPU us/event, message bytes/event as stored in the queue list")
+        for label, (wall, cpu, size) in publish.items():
+            print(f"  {label:<40} {wall:>8.2f} {cpu:>8.2f} {size:>9.0f}")
+
+    parse_current, parse_fast = parse['JSONParser (current)'], parse['FastJSONParser']
+    print("\nSingle event through Celery, CPU: parse + publish (or body encode) + body decode + JSONField encode")
+    if publish:
+        current = parse_current + publish['json, single event, celery default'][1] + single[('json', None)][1] \
+            + db['json.dumps (current)']
+    else:
+        current = parse_current + sum(single[('json', None)][:2]) + db['json.dumps (current)']
+    print(f"  {'current (JSONParser, json, json.dumps)':<40} {current:>8.2f} us/event")
+    for serializer in serializers:
+        if publish:
+            fast = parse_fast + publish[f"{serializer}, single event"][1] + single[(serializer, None)][1] \
+                + db['EventJSONEncoder, dict']
+        else:
+            fast = parse_fast + sum(single[(serializer, None)][:2]) + db['EventJSONEncoder, dict']
+        print(f"  {'fast parser, ' + serializer:<40} {fast:>8.2f} us/event  x{current / fast:.2f}")
+    print("Single event through Redis Stream: parse + entry encode/decode + JSONField encode")
+    current = parse_current + stream['json.dumps + json.loads (current)'] + db['json.dumps (current)']
+    fast = parse_fast + stream['raw text + loads -> EventJSON'] + db['EventJSONEncoder, EventJSON']
+    print(f"  {'current':<40} {current:>8.2f} us/event")
+    print(f"  {'fast (raw passthrough)':<40} {fast:>8.2f} us/event  x{current / fast:.2f}")
+
+
+if __name__ == '__main__':
+    main()
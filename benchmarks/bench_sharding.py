@@ -0,0 +1,137 @@
+"""
+Шардирование отпечатков по нескольким Redis (ShardedStorage).
+
+    python -m benchmarks.bench_sharding --spawn 3 --fingerprints 200000
+    python -m benchmarks.bench_sharding --nodes redis://10.0.0.1:6379/15,redis://10.0.0.2:6379/15
+
+--spawn N сам запускает N временных redis-server (нужен redis-server в
+PATH или --redis-server) на свободных портах и останавливает их в конце.
+Печатает:
+  * распределение отпечатков по узлам;
+  * долю отпечатков, которые переедут при добавлении еще одного узла
+    (в идеале 1/(N+1));
+  * корректность: первый проход - все новые, второй - все дубли;
+  * пропускную способность одного узла и шардированного хранилища.
+Узлы из --nodes должны быть пустыми БД: они очищаются (FLUSHDB).
+"""
+
+import argparse
+import hashlib
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+import redis
+
+from deduplicator.storage import HashRing, build_sharded_storage, build_storage
+
+TTL_SECONDS = 7 * 24 * 3600
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_nodes(count, binary):
+    processes, urls = [], []
+    workdir = tempfile.mkdtemp(prefix='bench_sharding_')
+    for _ in range(count):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [binary, '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', workdir],
+            stdout=subprocess.DEVNULL,
+        ))
+        urls.append(f"redis://127.0.0.1:{port}/0")
+    for url in urls:
+        client = redis.Redis.from_url(url)
+        for _ in range(50):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.1)
+    return processes, urls, workdir
+
+
+def fingerprints(count, seed):
+    return [hashlib.sha256(f"{seed}:{i}".encode()).hexdigest() for i in range(count)]
+
+
+def run_batches(storage, items, batch_size):
+    results = []
+    for start in range(0, len(items), batch_size):
+        results.extend(storage.add_many(items[start:start + batch_size]))
+    return results
+
+
+def timed(storage, items, batch_size):
+    started = time.perf_counter()
+    first = run_batches(storage, items, batch_size)
+    second = run_batches(storage, items, batch_size)
+    elapsed = time.perf_counter() - started
+    assert all(first), "первый проход: все отпечатки должны быть новыми"
+    assert not any(second), "второй проход: все отпечатки должны быть дублями"
+    return 2 * len(items) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', default='', help='Redis URLs, comma separated.')
+    parser.add_argument('--spawn', type=int, default=0, help='Start this many local redis-server processes.')
+    parser.add_argument('--redis-server', default=shutil.which('redis-server') or 'redis-server')
+    parser.add_argument('--layout', default='string')
+    parser.add_argument('--fingerprints', type=int, default=200_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--vnodes', type=int, default=160)
+    args = parser.parse_args()
+
+    processes, workdir = [], None
+    if args.spawn:
+        processes, urls, workdir = spawn_nodes(args.spawn, args.redis_server)
+    else:
+        urls = [url.strip() for url in args.nodes.split(',') if url.strip()]
+    if len(urls) < 2:
+        parser.error("Нужно минимум два узла: --nodes или --spawn.")
+
+    clients = [redis.Redis.from_url(url) for url in urls]
+    try:
+        for client in clients:
+            client.flushdb()
+
+        items = fingerprints(args.fingerprints, seed='bench_sharding')
+        ring = HashRing(urls, vnodes=args.vnodes)
+        owners = [ring.node_for(fingerprint) for fingerprint in items]
+        counts = Counter(owners)
+        print(f"{len(urls)} nodes, {args.vnodes} vnodes each, {len(items)} fingerprints\n")
+        for url in urls:
+            print(f"  {url:<32} {counts[url] / len(items):7.2%}")
+
+        grown = HashRing(urls + ['redis://new-node:6379/0'], vnodes=args.vnodes)
+        moved = sum(1 for fingerprint, owner in zip(items, owners) if grown.node_for(fingerprint) != owner)
+        print(f"\nadding a node moves {moved / len(items):.2%} of fingerprints (ideal {1 / (len(urls) + 1):.2%})\n")
+
+        single = build_storage(args.layout, redis.Redis.from_url(urls[0], decode_responses=True), TTL_SECONDS)
+        print(f"{'single node':<16} {timed(single, items, args.batch_size):>12,.0f} fp/s")
+        clients[0].flushdb()
+
+        sharded = build_sharded_storage(args.layout, urls, TTL_SECONDS, vnodes=args.vnodes)
+        print(f"{'sharded':<16} {timed(sharded, items, args.batch_size):>12,.0f} fp/s")
+        keys = [client.dbsize() for client in clients]
+        print(f"keys per node: {keys}")
+    finally:
+        for client in clients:
+            client.flushdb()
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Сравнение памяти Redis на миллион отпечатков для раскладок хранилища:
+'string' (ключ на событие) против 'bucketed' (хэши по корзинам).
+
+    python -m benchmarks.bench_storage_memory --redis-url redis://127.0.0.1:6379/15 --fingerprints 1000000
+
+Нужна отдельная пустая БД Redis: замер - это разница used_memory до и
+после вставки, а БД очищается между вариантами (FLUSHDB).
+Для 'bucketed' результат сильно зависит от hash-max-ziplist-entries
+(hash-max-listpack-entries в Redis 7) - он печатается вместе с результатом.
+"""
+
+import argparse
+import hashlib
+import time
+
+import redis
+
+from deduplicator.storage import BucketedHashStorage, StringKeyStorage
+
+TTL_SECONDS = 7 * 24 * 3600
+
+
+def fingerprints(count, seed):
+    for i in range(count):
+        yield hashlib.sha256(f"{seed}:{i}".encode()).hexdigest()
+
+
+def used_memory(client):
+    return client.info('memory')['used_memory']
+
+
+def measure(client, storage, count, batch_size, seed):
+    client.flushdb()
+    before = used_memory(client)
+    started = time.perf_counter()
+    batch = []
+    for fingerprint in fingerprints(count, seed):
+        batch.append(fingerprint)
+        if len(batch) >= batch_size:
+            storage.add_many(batch)
+            batch = []
+    if batch:
+        storage.add_many(batch)
+    elapsed = time.perf_counter() - started
+    return used_memory(client) - before, elapsed, client.dbsize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/15')
+    parser.add_argument('--fingerprints', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--shards', type=int, action='append',
+                        help='Число шардов для bucketed (можно несколько раз; по умолчанию 1024, 8192, 65536).')
+    parser.add_argument('--digest-bytes', type=int, default=10)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url)
+    if client.dbsize():
+        parser.error(f"БД {args.redis_url} не пуста - укажите отдельную БД для замера.")
+
+    config = client.config_get('hash-max-*-entries')
+    print(f"Redis {client.info('server')['redis_version']}, {config}")
+    print(f"{args.fingerprints} fingerprints per variant\n")
+
+    variants = [("string", StringKeyStorage(client, TTL_SECONDS))]
+    for shards in args.shards or [1024, 8192, 65536]:
+        variants.append((
+            f"bucketed shards={shards} digest={args.digest_bytes}B",
+            BucketedHashStorage(client, TTL_SECONDS, shards=shards, digest_bytes=args.digest_bytes),
+        ))
+
+    try:
+        for name, storage in variants:
+            memory, elapsed, keys = measure(client, storage, args.fingerprints, args.batch_size, seed=name)
+            per_million = memory / args.fingerprints * 1_000_000
+            print(f"{name:<40} {per_million / 2 ** 20:>9.1f} MiB per 1M  "
+                  f"{memory / args.fingerprints:>7.1f} B/fp  {keys:>9} keys  {args.fingerprints / elapsed:>10,.0f} fp/s")
+    finally:
+        client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Бенчмарк записи уникальных событий в PostgreSQL:
+UniqueEvent.objects.create на каждое событие против UniqueEventWriter.
+
+    python -m benchmarks.bench_writer --events 20000 --concurrency 1 --concurrency 50 --linger 0.005
+
+Оба варианта нагружаются так же, как в воркере Celery с -P eventlet:
+N green threads, каждое событие - отдельная "задача" (одно событие на
+вызов create() или write(), перед ним close_old_connections, как у Celery
+с CONN_MAX_AGE = 0). Для каждой конкурентности печатает события в секунду
+и средний размер INSERT для каждого linger. Пишет в настоящую таблицу
+deduplicator_uniqueevent и удаляет свои строки после замера.
+"""
+
+import argparse
+import hashlib
+import time
+import uuid
+
+from benchmarks.common import print_row, setup_django
+
+
+def make_events(run_id, count):
+    for i in range(count):
+        fingerprint = hashlib.sha256(f"{run_id}:{i}".encode()).hexdigest()
+        yield fingerprint, {"event_name": "bench_writer", "bench_run": run_id, "seq": i}
+
+
+def run_tasks(concurrency, events, task):
+    """Выполняет task(event) в concurrency green threads; секунды."""
+    import eventlet
+    from django.db import close_old_connections, connection
+
+    def task_loop():
+        try:
+            for event in events:
+                close_old_connections()
+                task(event)
+        finally:
+            connection.close()
+
+    pool = eventlet.GreenPool(concurrency)
+    started = time.perf_counter()
+    for _ in range(concurrency):
+        pool.spawn(task_loop)
+    pool.waitall()
+    return time.perf_counter() - started
+
+
+def bench_create(run_id, count, concurrency):
+    from deduplicator.models import UniqueEvent
+
+    def task(event):
+        fingerprint, event_data = event
+        UniqueEvent.objects.create(fingerprint=fingerprint, event_data=event_data)
+
+    return run_tasks(concurrency, make_events(run_id, count), task)
+
+
+def bench_writer(run_id, count, batch_size, concurrency, linger):
+    """Секунды и число INSERT; как process_event, каждая задача пишет одно событие."""
+    from deduplicator import writer as writer_module
+
+    inserts = 0
+    write_unique_events = writer_module.write_unique_events
+
+    def counting_write(batch, recheck=False):
+        nonlocal inserts
+        inserts += 1
+        return write_unique_events(batch, recheck)
+
+    writer = writer_module.UniqueEventWriter(batch_size=batch_size, flush_interval=60, linger=linger)
+    writer_module.write_unique_events = counting_write
+    try:
+        seconds = run_tasks(concurrency, make_events(run_id, count), lambda event: writer.write([event]))
+        return seconds, inserts
+    finally:
+        writer_module.write_unique_events = write_unique_events
+
+
+def cleanup(run_id):
+    from deduplicator.models import UniqueEvent
+    UniqueEvent.objects.filter(event_data__bench_run=run_id).delete()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='Green threads writing concurrently; repeatable (default: 1, 10, 50).')
+    parser.add_argument('--linger', type=float, action='append',
+                        help='UniqueEventWriter linger in seconds; repeatable (default: 0, 0.005).')
+    args = parser.parse_args()
+
+    # Как в воркере -P eventlet: патчим до импорта Django и psycopg2
+    import eventlet
+    eventlet.monkey_patch()
+    setup_django()
+
+    print(f"Inserting {args.events} unique events per variant, writer batch size {args.batch_size}")
+    for concurrency in args.concurrency or [1, 10, 50]:
+        print(f"\n{concurrency} concurrent green thread(s)")
+        run_id = uuid.uuid4().hex
+        try:
+            print_row("create() per event", args.events, bench_create(run_id, args.events, concurrency))
+        finally:
+            cleanup(run_id)
+        for linger in args.linger or [0.0, 0.005]:
+            run_id = uuid.uuid4().hex
+            try:
+                seconds, inserts = bench_writer(run_id, args.events, args.batch_size, concurrency, linger)
+            finally:
+                cleanup(run_id)
+            print_row(f"writer linger={linger * 1000:g}ms", args.events, seconds)
+            print(f"{'':<32} {inserts:>10} INSERTs, {args.events / inserts:.1f} events per INSERT")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+Общие помощники для бенчмарков.
+
+Бенчмарки запускаются из корня проекта как модули, например:
+    python -m benchmarks.bench_writer --events 20000
+и используют те же настройки (.env), что и приложение.
+"""
+
+import os
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KN_practice.settings')
+    import django
+    django.setup()
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def print_row(name, count, seconds):
+    rate = count / seconds if seconds else float('inf')
+    print(f"{name:<32} {count:>10} events  {seconds:>8.3f} s  {rate:>12,.0f} events/s")
@@ -0,0 +1,77 @@
+"""
+Генератор синтетических событий для бенчмарков.
+
+Поток событий задается четырьмя параметрами:
+  * duplicate_ratio - доля событий, повторяющих одно из уже выданных;
+  * key_cardinality - сколько разных значений у полей client_id,
+    product_id, content_id и channel_id (userId у каждого нового события
+    свой, поэтому новые события всегда уникальны);
+  * payload_bytes - размер поля payload, не входящего в ключ;
+  * seed - при одинаковых параметрах поток воспроизводится.
+
+Все события несут bench_run: по нему бенчмарк находит и удаляет свои
+строки в PostgreSQL, а разные запуски не считаются дублями друг друга.
+"""
+
+import random
+import string
+import uuid
+from typing import Any, Dict, List, Optional
+
+
+class EventGenerator:
+    def __init__(self, duplicate_ratio: float = 0.3, key_cardinality: int = 1000, payload_bytes: int = 256,
+                 seed: int = 1, run_id: Optional[str] = None):
+        if not 0 <= duplicate_ratio < 1:
+            raise ValueError("duplicate_ratio должен быть в [0, 1)")
+        if key_cardinality <= 0:
+            raise ValueError("key_cardinality должен быть положительным")
+        if payload_bytes < 0:
+            raise ValueError("payload_bytes не может быть отрицательным")
+
+        self.duplicate_ratio = duplicate_ratio
+        self.key_cardinality = key_cardinality
+        self.payload_bytes = payload_bytes
+        self.seed = seed
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            'duplicate_ratio': self.duplicate_ratio,
+            'key_cardinality': self.key_cardinality,
+            'payload_bytes': self.payload_bytes,
+            'seed': self.seed,
+        }
+
+    def events(self, count: int, prefix: str = '') -> List[Dict[str, Any]]:
+        """
+        count событий. prefix разводит потоки одного запуска (у каждого
+        сценария свои уникальные события). Дубль - тот же объект, что и
+        оригинал: для дедупликации важны только значения полей.
+        """
+        rnd = random.Random(f"{self.seed}:{prefix}")
+        payload = ''.join(rnd.choices(string.ascii_letters + string.digits, k=self.payload_bytes))
+        events: List[Dict[str, Any]] = []
+        originals: List[Dict[str, Any]] = []
+        for index in range(count):
+            if originals and rnd.random() < self.duplicate_ratio:
+                events.append(rnd.choice(originals))
+                continue
+            event = {
+                'event_name': 'bench',
+                'bench_run': self.run_id,
+                'userId': f"{self.run_id}-{prefix}{index}",
+                'client_id': rnd.randrange(self.key_cardinality),
+                'product_id': f"p{rnd.randrange(self.key_cardinality)}",
+                'content_id': f"c{rnd.randrange(self.key_cardinality)}",
+                'channel_id': rnd.randrange(self.key_cardinality),
+                'payload': payload,
+            }
+            originals.append(event)
+            events.append(event)
+        return events
+
+
+def unique_count(events: List[Dict[str, Any]]) -> int:
+    """Сколько разных событий в потоке (дубли - это те же объекты)."""
+    return len({id(event) for event in events})
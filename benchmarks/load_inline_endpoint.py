@@ -0,0 +1,119 @@
+"""
+Нагрузочный тест синхронного async-эндпоинта /api/v1/check_event/inline/.
+
+    uvicorn KN_practice.asgi:application --port 8000 --workers 4 --no-access-log
+    python -m benchmarks.load_inline_endpoint --url http://127.0.0.1:8000/api/v1/check_event/inline/ \\
+        --requests 50000 --concurrency 64 --duplicate-ratio 0.5
+
+Держит --concurrency keep-alive соединений, каждое шлет запросы
+последовательно. Печатает RPS, p50/p90/p99/max задержки и долю дублей
+в ответах. Свой минимальный HTTP/1.1-клиент на asyncio - без внешних
+зависимостей.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from benchmarks.common import percentile
+
+
+def make_bodies(count, duplicate_ratio, seed=1):
+    rnd = random.Random(seed)
+    run_id = uuid.uuid4().hex[:8]
+    sent = []
+    bodies = []
+    for i in range(count):
+        if sent and rnd.random() < duplicate_ratio:
+            event = rnd.choice(sent)
+        else:
+            event = {
+                'event_name': 'load_test',
+                'userId': f"{run_id}-{i}",
+                'client_id': rnd.randrange(1000),
+                'product_id': f"p{rnd.randrange(10_000)}",
+            }
+            sent.append(event)
+        bodies.append(json.dumps(event).encode('utf-8'))
+    return bodies
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Сервер закрыл соединение")
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value.strip())
+    body = await reader.readexactly(length) if length else b''
+    return status, body
+
+
+async def connection_worker(host, port, path, queue, latencies, stats):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            try:
+                body = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            request = (
+                f"POST {path} HTTP/1.1\r\nHost: {host}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+            ).encode('latin-1') + body
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, response = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            stats[status] = stats.get(status, 0) + 1
+            if status == 200 and json.loads(response).get('is_duplicate'):
+                stats['duplicates'] = stats.get('duplicates', 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    queue = asyncio.Queue()
+    for body in make_bodies(args.requests, args.duplicate_ratio):
+        queue.put_nowait(body)
+
+    latencies, stats = [], {}
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        connection_worker(url.hostname, url.port or 80, url.path, queue, latencies, stats)
+        for _ in range(args.concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = 1000
+    print(f"requests {len(latencies)}  concurrency {args.concurrency}  {len(latencies) / elapsed:,.0f} req/s")
+    print(f"latency ms: p50 {percentile(latencies, 0.50) * ms:.2f}  p90 {percentile(latencies, 0.90) * ms:.2f}  "
+          f"p99 {percentile(latencies, 0.99) * ms:.2f}  max {latencies[-1] * ms:.2f}")
+    print(f"responses: {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000/api/v1/check_event/inline/')
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import redis
+import redis.asyncio
+
+from . import metrics
+from .eventlog import event_log
+from .storage import make_async_client
+
+
+logger = logging.getLogger(__name__)
+
+# Разделитель имени очереди и приоритета в ключах брокера kombu на Redis
+_KOMBU_PRIORITY_SEP = '\x06\x16'
+_KOMBU_PRIORITY_STEPS = (3, 6, 9)
+
+
+def celery_queue_depth(broker_client: redis.Redis, queue: str) -> Callable[[], Optional[int]]:
+    """
+    Глубина очереди Celery на брокере Redis: задачи лежат в списке с именем
+    очереди (и в списках приоритетов <очередь>\\x06\\x16<n>). LLEN - O(1),
+    все четыре - одним pipeline. Единица - задачи, а не события (задача
+    пакетного запроса несет чанк событий).
+    """
+    keys = [queue] + [f"{queue}{_KOMBU_PRIORITY_SEP}{step}" for step in _KOMBU_PRIORITY_STEPS]
+
+    def read() -> int:
+        pipe = broker_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.llen(key)
+        return sum(pipe.execute())
+
+    return read
+
+
+def stream_depth(redis_client: redis.Redis, key: str, group: str) -> Callable[[], Optional[int]]:
+    """
+    Глубина Redis Stream для группы: еще не выданные потребителям записи
+    (lag) плюс выданные, но не подтвержденные (pending). lag есть в XINFO
+    GROUPS с Redis 7; без него глубина неизвестна (None) - XLEN не годится,
+    в нем и обработанные записи, которые поток хранит до MAXLEN.
+    """
+    def read() -> Optional[int]:
+        try:
+            groups = redis_client.xinfo_groups(key)
+        except redis.ResponseError:
+            # Потока еще нет
+            return 0
+        for info in groups:
+            if info['name'] == group:
+                lag = info.get('lag')
+                return None if lag is None else int(lag) + int(info['pending'])
+        return 0
+
+    return read
+
+
+class QueueDepthProbe:
+    """
+    Глубина очереди транспорта, прочитанная не чаще раза в interval секунд
+    на процесс: запросы между чтениями берут последнее значение, не
+    обращаясь к Redis. Если прочитать не удалось (или глубина неизвестна),
+    depth() - None, и порог очереди не применяется.
+    """
+
+    def __init__(self, read: Callable[[], Optional[int]], interval: float):
+        if interval <= 0:
+            raise ValueError("interval должен быть положительным числом")
+        self.read = read
+        self.interval = interval
+        self._depth: Optional[int] = None
+        self._read_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def depth(self) -> Optional[int]:
+        if self._is_stale():
+            self._refresh()
+        return self._depth
+
+    async def depth_async(self) -> Optional[int]:
+        # Чтение синхронным клиентом - в пуле потоков, чтобы не блокировать event loop
+        if self._is_stale():
+            await asyncio.to_thread(self._refresh)
+        return self._depth
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._read_at >= self.interval
+
+    def _refresh(self) -> None:
+        # Читает один поток, остальные берут прежнее значение, а не ждут
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if not self._is_stale():
+                return
+            try:
+                self._depth = self.read()
+            except redis.RedisError as e:
+                logger.warning("Не удалось прочитать глубину очереди, порог очереди не применяется: %s", e)
+                self._depth = None
+            self._read_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+
+class TokenBucketLimiter:
+    """
+    Ограничение частоты событий по client_id: корзина токенов на клиента
+    в хэше Redis (tokens, ts). Токены пополняются со скоростью rate в
+    секунду до burst; событие расходует один токен. Все корзины запроса
+    проверяются и списываются одним Lua-скриптом (атомарно, один обход
+    сети); время берется у Redis (TIME), поэтому часы процессов API не
+    должны совпадать. Корзина, к которой не обращались burst / rate
+    секунд, полна и удаляется по TTL.
+    """
+
+    # KEYS: корзины. ARGV[1]: rate, ARGV[2]: burst, ARGV[3]: TTL корзины, далее - число событий
+    # по каждой корзине. Ответ - по паре на корзину: сколько событий принято и через сколько
+    # секунд (строкой: Redis отбрасывает дробную часть чисел Lua) накопятся токены на остальные.
+    SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local result = {}
+for i = 1, #KEYS do
+    local cost = tonumber(ARGV[3 + i])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local admitted = math.min(cost, math.floor(tokens))
+    tokens = tokens - admitted
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], ttl)
+    result[2 * i - 1] = admitted
+    if admitted < cost then
+        result[2 * i] = tostring((math.min(cost - admitted, burst) - tokens) / rate)
+    else
+        result[2 * i] = '0'
+    end
+end
+return result
+"""
+
+    # Размер пула соединений асинхронного клиента (см. async_redis)
+    async_max_connections = 100
+
+    def __init__(self, redis_client: redis.Redis, rate: float, burst: int, prefix: str = 'event_dedup:ratelimit'):
+        if rate <= 0:
+            raise ValueError("rate должен быть положительным числом")
+        if not isinstance(burst, int) or burst <= 0:
+            raise ValueError("burst должен быть положительным целым числом")
+        self.redis = redis_client
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self.bucket_ttl = int(burst / rate) + 1
+        self._script_sha = hashlib.sha1(self.SCRIPT.encode('utf-8')).hexdigest()
+        self._async_redis: Optional[redis.asyncio.Redis] = None
+
+    @property
+    def async_redis(self) -> redis.asyncio.Redis:
+        if self._async_redis is None:
+            self._async_redis = make_async_client(self.redis, self.async_max_connections)
+        return self._async_redis
+
+    def acquire(self, costs: Dict[str, int]) -> Dict[str, Any]:
+        """
+        Списывает токены по клиентам (client_id -> число событий). Возвращает
+        client_id -> (принято событий, секунд до токенов на остальные).
+        """
+        keys, args = self._script_args(costs)
+        try:
+            replies = self.redis.evalsha(self._script_sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            self.redis.script_load(self.SCRIPT)
+            replies = self.redis.evalsha(self._script_sha, len(keys), *keys, *args)
+        return self._parse(costs, replies)
+
+    async def acquire_async(self, costs: Dict[str, int]) -> Dict[str, Any]:
+        keys, args = self._script_args(costs)
+        try:
+            replies = await self.async_redis.evalsha(self._script_sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            await self.async_redis.script_load(self.SCRIPT)
+            replies = await self.async_redis.evalsha(self._script_sha, len(keys), *keys, *args)
+        return self._parse(costs, replies)
+
+    def _script_args(self, costs: Dict[str, int]):
+        keys = [f"{self.prefix}:{client}" for client in costs]
+        return keys, [self.rate, self.burst, self.bucket_ttl, *costs.values()]
+
+    @staticmethod
+    def _parse(costs: Dict[str, int], replies: List[Any]) -> Dict[str, Any]:
+        return {
+            client: (int(replies[2 * index]), float(replies[2 * index + 1]))
+            for index, client in enumerate(costs)
+        }
+
+
+class AdmissionController:
+    """
+    Контроль приема событий в API, до постановки в очередь.
+
+    Порог очереди с гистерезисом: прием останавливается (queue_full), когда
+    глубина очереди достигает high_watermark, и возобновляется, только когда
+    она опустится до low_watermark, - чтобы не переключаться на каждом
+    запросе около одного порога. Решение принимает каждый процесс API по
+    своему последнему чтению глубины (QueueDepthProbe).
+
+    Ограничение частоты (admit) - по client_id события: события клиента
+    сверх его токенов отклоняются, остальные принимаются. События без
+    client_id делят одну корзину.
+
+    Ошибки Redis в самом контроле не мешают приему (fail-open): очередь
+    и дедупликация сообщат о недоступности Redis сами.
+    """
+
+    def __init__(self, depth_probe: Optional[QueueDepthProbe] = None, high_watermark: int = 0,
+                 low_watermark: Optional[int] = None, retry_after: float = 5.0,
+                 limiter: Optional[TokenBucketLimiter] = None, client_field: str = 'client_id'):
+        if depth_probe is not None and high_watermark <= 0:
+            raise ValueError("high_watermark должен быть положительным числом")
+        low_watermark = high_watermark if low_watermark is None else low_watermark
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("low_watermark должен быть в [0, high_watermark]")
+        if retry_after <= 0:
+            raise ValueError("retry_after должен быть положительным числом")
+
+        self.depth_probe = depth_probe
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.retry_after = retry_after
+        self.limiter = limiter
+        self.client_field = client_field
+        self._shedding = False
+
+    def queue_full(self) -> bool:
+        if self.depth_probe is None:
+            return False
+        return self._update_shedding(self.depth_probe.depth())
+
+    async def queue_full_async(self) -> bool:
+        if self.depth_probe is None:
+            return False
+        return self._update_shedding(await self.depth_probe.depth_async())
+
+    def shed(self, amount: int) -> None:
+        """Учитывает события, отклоненные из-за очереди (весь запрос)."""
+        _count_shed('queue_full', amount)
+
+    def admit(self, events: Sequence[Dict[str, Any]]) -> List[float]:
+        """
+        Ограничение частоты для событий запроса. По каждому событию - 0.0,
+        если оно принято, иначе через сколько секунд клиенту повторить.
+        """
+        if self.limiter is None or not events:
+            return [0.0] * len(events)
+        clients = self._clients(events)
+        try:
+            granted = self.limiter.acquire(Counter(clients))
+        except redis.RedisError as e:
+            logger.warning("Ограничение частоты недоступно, %d событий приняты без проверки: %s", len(events), e)
+            return [0.0] * len(events)
+        return self._assign(clients, granted)
+
+    async def admit_async(self, events: Sequence[Dict[str, Any]]) -> List[float]:
+        if self.limiter is None or not events:
+            return [0.0] * len(events)
+        clients = self._clients(events)
+        try:
+            granted = await self.limiter.acquire_async(Counter(clients))
+        except redis.RedisError as e:
+            logger.warning("Ограничение частоты недоступно, %d событий приняты без проверки: %s", len(events), e)
+            return [0.0] * len(events)
+        return self._assign(clients, granted)
+
+    def _update_shedding(self, depth: Optional[int]) -> bool:
+        if depth is None:
+            return False
+        if self._shedding and depth <= self.low_watermark:
+            self._shedding = False
+            logger.warning("Глубина очереди %s опустилась до %s, прием возобновлен", depth, self.low_watermark)
+        elif not self._shedding and depth >= self.high_watermark:
+            self._shedding = True
+            logger.warning("Глубина очереди %s достигла %s, прием остановлен", depth, self.high_watermark)
+        return self._shedding
+
+    def _clients(self, events: Sequence[Dict[str, Any]]) -> List[str]:
+        # Имя корзины - как значение колонки client_id. Модели импортируются здесь:
+        # контроллер создается в settings.py, до загрузки приложений
+        from .models import promoted_value
+        return [promoted_value(event.get(self.client_field)) or '' for event in events]
+
+    @staticmethod
+    def _assign(clients: List[str], granted: Dict[str, Any]) -> List[float]:
+        # Первые принятые события клиента - по порядку в запросе
+        left = {client: admitted for client, (admitted, _) in granted.items()}
+        waits = []
+        for client in clients:
+            if left[client] > 0:
+                left[client] -= 1
+                waits.append(0.0)
+            else:
+                waits.append(max(granted[client][1], 0.001))
+        _count_shed('rate_limit', sum(1 for wait in waits if wait))
+        return waits
+
+
+# Причины отказа в приеме (метка метрики dedup_admission_shed_total):
+#   'queue_full' - очередь транспорта выше порога, запрос отклоняется целиком (503)
+#   'rate_limit' - у client_id кончились токены, отклоняются его события (429)
+def _count_shed(reason: str, amount: int) -> None:
+    if amount:
+        metrics.ADMISSION_SHED.inc(amount, reason)
+        event_log.count(f"admission.{reason}", amount)
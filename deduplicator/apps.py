@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class DeduplicatorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'deduplicator'
+
+    def ready(self):
+        from django.conf import settings
+        if settings.DEDUPLICATOR_LOG_MODE == 'production':
+            # Строки лога на событие - только для выборки, остальное - в периодической сводке
+            from . import eventlog
+            eventlog.configure(settings.DEDUPLICATOR_LOG_SAMPLE_RATE, settings.DEDUPLICATOR_LOG_SUMMARY_INTERVAL)
+        # Каждый процесс (API, воркер, команды) сбрасывает свои метрики в общий хэш Redis
+        if settings.DEDUPLICATOR_METRICS_ENABLED and settings.REDIS_INSTANCE is not None:
+            from . import metrics
+            metrics.start_flusher(
+                settings.REDIS_INSTANCE,
+                settings.DEDUPLICATOR_METRICS_KEY,
+                settings.DEDUPLICATOR_METRICS_FLUSH_INTERVAL,
+            )
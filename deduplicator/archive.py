@@ -0,0 +1,108 @@
+
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, List, Sequence, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+# Сжатие -> расширение файла
+ARCHIVE_COMPRESSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+# Строка архива: (id, fingerprint, event_data, received_at). event_data - JSON-текст
+# (так его отдает psycopg2 для jsonb в Django) или уже разобранный объект.
+ArchiveRow = Tuple[int, str, Any, datetime]
+
+
+def archive_line(row: ArchiveRow) -> bytes:
+    event_id, fingerprint, event_data, received_at = row
+    if not isinstance(event_data, str):
+        event_data = json.dumps(event_data, separators=(',', ':'))
+    # event_data вставляется как есть, без разбора и повторной сериализации
+    return (
+        f'{{"id":{event_id},"fingerprint":{json.dumps(fingerprint)},'
+        f'"received_at":"{received_at.isoformat()}","event_data":{event_data}}}\n'
+    ).encode('utf-8')
+
+
+class ArchiveWriter:
+    """
+    Пишет строки архива в сжатые JSONL-файлы с ротацией по числу строк.
+
+    Каждый чанк сжимается отдельным кадром (gzip member / zstd frame) и
+    дописывается в конец файла, после чего файл синхронизируется на диск
+    (fsync); каталог - при создании каждого нового файла. Склеенные кадры - корректный файл для zcat/zstdcat.
+    Когда write_chunk вернул управление, чанк уже на диске, и его строки
+    можно удалять из БД. Если процесс упадет посреди записи, в файле
+    останутся только целиком записанные кадры и, возможно, обрезанный
+    последний, строки которого из БД еще не удалены.
+    """
+
+    def __init__(self, directory: str, source: str, compression: str = 'gzip', rows_per_file: int = 1_000_000):
+        if compression not in ARCHIVE_COMPRESSIONS:
+            raise ValueError(f"Неизвестное сжатие: {compression!r} (допустимы {', '.join(ARCHIVE_COMPRESSIONS)})")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("Для сжатия zstd нужен пакет zstandard (pip install zstandard)")
+        if not isinstance(rows_per_file, int) or rows_per_file <= 0:
+            raise ValueError("rows_per_file должен быть положительным целым числом")
+
+        self.directory = directory
+        self.source = source
+        self.compression = compression
+        self.rows_per_file = rows_per_file
+        self.run_id = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%S')
+        self.files: List[str] = []
+
+        self._file = None
+        self._file_rows = 0
+        self._zstd = zstandard.ZstdCompressor(level=3) if compression == 'zstd' else None
+        os.makedirs(directory, exist_ok=True)
+
+    def write_chunk(self, rows: Sequence[ArchiveRow]) -> None:
+        if not rows:
+            return
+        if self._file is None or self._file_rows >= self.rows_per_file:
+            self._rotate()
+
+        payload = b''.join(archive_line(row) for row in rows)
+        if self._zstd is not None:
+            frame = self._zstd.compress(payload)
+        else:
+            frame = gzip.compress(payload, compresslevel=6)
+        self._file.write(frame)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file_rows += len(rows)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self) -> None:
+        self.close()
+        path = os.path.join(
+            self.directory,
+            f"{self.source}-{self.run_id}-{len(self.files) + 1:04d}{ARCHIVE_COMPRESSIONS[self.compression]}",
+        )
+        self._file = open(path, 'xb')
+        self._file_rows = 0
+        self.files.append(path)
+        self._fsync_directory()
+        logger.info("Новый файл архива: %s", path)
+
+    def _fsync_directory(self) -> None:
+        # Запись о новом файле в каталоге тоже должна пережить сбой питания
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,67 @@
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class FingerprintCache:
+    """
+    Ограниченный in-process кэш недавно виденных отпечатков (L1 перед Redis).
+
+    Хранит не больше max_size отпечатков, каждый живет ttl_seconds, при
+    переполнении вытесняется давно не использованный (LRU). Попадание
+    означает, что отпечаток уже был записан в Redis этим процессом, то есть
+    событие - дубль. Промах ничего не значит: решение принимает Redis.
+
+    Все операции идут под одной блокировкой и не делают I/O, поэтому кэш
+    безопасен и для обычных потоков, и для green threads eventlet
+    (threading.Lock пропатчен eventlet'ом в green-вариант). Попадания,
+    промахи и вытеснения считает вызывающий (метрики dedup_l1_cache_*).
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        if not isinstance(max_size, int) or max_size <= 0:
+            raise ValueError("max_size должен быть положительным целым числом")
+        if ttl_seconds <= 0:
+            raise ValueError("ttl_seconds должен быть положительным числом")
+
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        # отпечаток -> момент истечения (time.monotonic), от старых к свежим
+        self._items: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def contains(self, fingerprint: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._items.get(fingerprint)
+            if expires_at is None:
+                return False
+            if expires_at <= now:
+                del self._items[fingerprint]
+                return False
+            self._items.move_to_end(fingerprint)
+            return True
+
+    def add(self, fingerprint: str) -> int:
+        """Добавляет отпечаток. Возвращает, сколько отпечатков вытеснено (LRU)."""
+        expires_at = time.monotonic() + self.ttl
+        evicted = 0
+        with self._lock:
+            self._items[fingerprint] = expires_at
+            self._items.move_to_end(fingerprint)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def discard(self, fingerprint: str) -> None:
+        with self._lock:
+            self._items.pop(fingerprint, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
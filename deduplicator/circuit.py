@@ -0,0 +1,171 @@
+
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, TypeVar
+
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Что делать с событиями, проверку которых Redis не принял (DEDUPLICATOR_DEGRADED_MODE):
+#   'db'    - считать новыми (fail-open, по умолчанию); повторы отсечет только уникальный
+#             индекс fingerprint дневной секции (ON CONFLICT DO NOTHING), то есть в пределах суток
+#   'retry' - не сохранять без проверки, а отложить ее до восстановления Redis
+DEGRADED_MODES = ('db', 'retry')
+
+
+class CircuitOpenError(redis.ConnectionError):
+    """
+    Вызов отклонен предохранителем, не дойдя до Redis. Наследует
+    redis.ConnectionError, поэтому обработчики ошибок Redis (fail-open)
+    обрабатывают его так же, как настоящий обрыв соединения - только без
+    ожидания таймаута.
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель вокруг вызовов Redis в пути дедупликации.
+
+      closed    - вызовы идут в Redis; failure_threshold ошибок соединения
+                  или таймаутов подряд размыкают предохранитель;
+      open      - вызовы сразу отклоняются (CircuitOpenError) в течение
+                  reset_timeout секунд;
+      half_open - затем пропускается не больше half_open_max_calls пробных
+                  вызовов одновременно: успех замыкает предохранитель,
+                  ошибка снова размыкает его на reset_timeout.
+
+    Ошибкой считаются только redis.ConnectionError и redis.TimeoutError.
+    Один предохранитель на процесс и хранилище; состояние - под threading.Lock.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, half_open_max_calls: int = 1,
+                 name: str = 'redis'):
+        if not isinstance(failure_threshold, int) or failure_threshold <= 0:
+            raise ValueError("failure_threshold должен быть положительным целым числом")
+        if reset_timeout <= 0:
+            raise ValueError("reset_timeout должен быть положительным числом")
+        if not isinstance(half_open_max_calls, int) or half_open_max_calls <= 0:
+            raise ValueError("half_open_max_calls должен быть положительным целым числом")
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.name = name
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+        # Сколько вызовов отклонено и сколько раз предохранитель размыкался
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def retry_after(self) -> float:
+        """Через сколько секунд предохранитель начнет пропускать пробные вызовы (0 - уже пропускает)."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """
+        Можно ли сейчас обратиться к Redis. Разрешение в полуоткрытом
+        состоянии занимает слот пробного вызова: после allow() == True
+        обязателен record_success, record_failure или release.
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._state = self.HALF_OPEN
+                self._probes = 0
+                logger.info("Предохранитель %s: пробуем восстановить соединение", self.name)
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                logger.warning("Предохранитель %s замкнут: Redis снова доступен", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._trip(f"пробный вызов не удался, следующая попытка через {self.reset_timeout} с")
+                return
+            self._failures += 1
+            if self._state == self.CLOSED and self._failures >= self.failure_threshold:
+                self._trip(f"{self._failures} ошибок подряд, вызовы отклоняются {self.reset_timeout} с")
+
+    def release(self) -> None:
+        """Освобождает слот пробного вызова, не меняя состояния (вызов упал не из-за Redis)."""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def call(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Вызывает func через предохранитель. Когда он разомкнут - CircuitOpenError без обращения к Redis."""
+        if not self.allow():
+            raise CircuitOpenError(f"Предохранитель {self.name} разомкнут")
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._record_error(e)
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, func: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any) -> T:
+        """То же, что call, для корутин."""
+        if not self.allow():
+            raise CircuitOpenError(f"Предохранитель {self.name} разомкнут")
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._record_error(e)
+            raise
+        self.record_success()
+        return result
+
+    def _record_error(self, error: BaseException) -> None:
+        if isinstance(error, (redis.ConnectionError, redis.TimeoutError)):
+            self.record_failure()
+        elif isinstance(error, redis.RedisError):
+            self.record_success()
+        else:
+            self.release()
+
+    def _trip(self, reason: str) -> None:
+        # Вызывается под self._lock
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._failures = 0
+        self._probes = 0
+        self.trips += 1
+        logger.error("Предохранитель %s разомкнут: %s", self.name, reason)
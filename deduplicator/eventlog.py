@@ -0,0 +1,187 @@
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Режимы логирования (DEDUPLICATOR_LOG_MODE):
+#   'verbose'    - каждое событие пишется в лог, вывод синхронный (отладка)
+#   'production' - по событиям пишется только выборка (DEDUPLICATOR_LOG_SAMPLE_RATE),
+#                  остальное - периодическая сводка счетчиков; вывод через очередь
+LOG_MODES = ('verbose', 'production')
+
+
+class NonBlockingHandler(logging.handlers.QueueHandler):
+    """
+    Обработчик для LOGGING: записи кладутся в ограниченную очередь, а
+    форматирует и пишет их в stderr отдельный поток (QueueListener).
+    Поток, который логирует, не ждет ни форматтера, ни записи в поток
+    вывода. Если очередь переполнена, запись отбрасывается (логирование не
+    должно тормозить обработку событий); число потерянных записей
+    сообщается следующей записью, которая в очередь поместилась.
+
+    Форматтер из LOGGING применяется в потоке вывода. Поток не переживает
+    fork (воркеры Celery prefork), поэтому в дочернем процессе
+    перезапускается вместе с новой очередью.
+    """
+
+    def __init__(self, queue_size: int = 10000, stream=None):
+        if queue_size <= 0:
+            raise ValueError("queue_size должен быть положительным числом")
+        self.queue_size = queue_size
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        super().__init__(queue.Queue(queue_size))
+        self._start()
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt: Optional[logging.Formatter]) -> None:
+        # Сообщение (msg % args) собирается в вызывающем потоке, а полный формат - в потоке вывода
+        self.target.setFormatter(fmt)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lost = logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Очередь лога переполнена, потеряно записей: {dropped}",
+            })
+            try:
+                self.queue.put_nowait(lost)
+            except queue.Full:
+                self.dropped += dropped
+
+    def close(self) -> None:
+        # Дописываем то, что осталось в очереди
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+        self.target.close()
+        super().close()
+
+    def _start(self) -> None:
+        self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self._listener.start()
+
+    def _restart_after_fork(self) -> None:
+        # Записи родителя в очереди дочернему процессу не нужны
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        self._start()
+
+
+class EventLog:
+    """
+    Логирование на горячем пути (одна запись на событие).
+
+    event() пишет запись только для доли sample_rate вызовов, и только если
+    уровень включен у логгера: иначе ни запись, ни аргументы не создаются и
+    не форматируются. Сообщение - в %-стиле с аргументами (как у logging),
+    чтобы форматирование откладывалось до вывода.
+
+    count() копит счетчики исходов, которые раз в summary_interval секунд
+    выводятся одной строкой сводки (0 - без сводки). В режиме 'production'
+    это заменяет строку лога на каждое событие.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, summary_interval: float = 0.0,
+                 summary_logger: Optional[logging.Logger] = None):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.summary_logger = summary_logger or logger
+        self.configure(sample_rate, summary_interval)
+
+    def configure(self, sample_rate: float, summary_interval: float) -> None:
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate должен быть в [0, 1]")
+        if summary_interval < 0:
+            raise ValueError("summary_interval не может быть отрицательным")
+        self.sample_rate = sample_rate
+        self.summary_interval = summary_interval
+
+    def event(self, log: logging.Logger, level: int, msg: str, *args: Any) -> None:
+        if not log.isEnabledFor(level):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        # stacklevel: в записи - модуль и строка вызывающего кода, а не eventlog
+        log.log(level, msg, *args, stacklevel=2)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        if self.summary_interval and amount:
+            with self._lock:
+                self._counts[name] += amount
+
+    def drain(self) -> Dict[str, int]:
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(int)
+        return dict(counts)
+
+    def log_summary(self) -> None:
+        counts = self.drain()
+        if counts:
+            details = ', '.join(f"{name}={value}" for name, value in sorted(counts.items()))
+            self.summary_logger.info("Сводка за %s с: %s", _format_interval(self.summary_interval), details)
+
+    def start(self) -> None:
+        if not self.summary_interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="event-log-summary", daemon=True)
+        self._thread.start()
+
+    def restart_after_fork(self) -> None:
+        # Счетчики родителя в дочернем процессе не нужны
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.log_summary()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.summary_interval):
+            try:
+                self.log_summary()
+            except Exception as e:
+                logger.exception("Ошибка вывода сводки лога: %s", e)
+
+
+def _format_interval(seconds: float) -> str:
+    return str(int(seconds)) if float(seconds).is_integer() else str(seconds)
+
+
+# До configure() (например, в скриптах без Django) пишется каждое событие, сводки нет
+event_log = EventLog()
+_started = False
+
+
+def configure(sample_rate: float, summary_interval: float) -> EventLog:
+    """Настраивает выборку и сводку процесса и запускает поток сводки (один раз, в т.ч. после fork)."""
+    global _started
+    event_log.configure(sample_rate, summary_interval)
+    if not _started:
+        _started = True
+        os.register_at_fork(after_in_child=event_log.restart_after_fork)
+        atexit.register(event_log.stop)
+    event_log.start()
+    return event_log
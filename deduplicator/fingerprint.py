@@ -0,0 +1,96 @@
+
+import hashlib
+import json
+from typing import Any, Callable, Dict, List
+
+# Алгоритм -> описание:
+#   'sha256-json' - v1: SHA-256 от JSON с сортировкой ключей, без тега (исходный формат)
+#   'sha256'      - v2: SHA-256 от канонической кодировки, тег "v2-sha256:"
+#   'blake2b'     - v2: BLAKE2b с размером дайджеста digest_size, тег "v2-b2b<digest_size>:"
+FINGERPRINT_ALGORITHMS = ('sha256-json', 'sha256', 'blake2b')
+
+FINGERPRINT_VERSION = 2
+
+Fingerprinter = Callable[[Dict[str, Any]], str]
+
+_canonical_json = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
+
+def _encode_value(value: Any) -> str:
+    """
+    Каноническая кодировка значения ключевого поля (v2).
+    Тип кодируется префиксом, строки - с длиной, поэтому разные наборы
+    значений не дают одинаковую строку ("a" + "bc" != "ab" + "c").
+    """
+    value_type = type(value)
+    if value_type is str:
+        return f"s{len(value)}:{value}"
+    if value is None:
+        return "n"
+    if value_type is int:
+        return f"i{value};"
+    if value_type is bool:
+        return "t" if value else "f"
+    if value_type is float:
+        return f"d{value!r};"
+    # Вложенные структуры (dict/list) - редкость для ключевых полей, кодируем JSON'ом
+    dumped = _canonical_json(value)
+    return f"j{len(dumped)}:{dumped}"
+
+
+def fingerprint_tag(algorithm: str, digest_size: int) -> str:
+    """Префикс версии отпечатка ('' для исходного формата v1)."""
+    if algorithm == 'sha256-json':
+        return ''
+    if algorithm == 'sha256':
+        return f"v{FINGERPRINT_VERSION}-sha256:"
+    return f"v{FINGERPRINT_VERSION}-b2b{digest_size}:"
+
+
+def fingerprint_digest_size(algorithm: str, digest_size: int) -> int:
+    """Длина бинарного дайджеста отпечатка в байтах (32 для SHA-256)."""
+    return digest_size if algorithm == 'blake2b' else hashlib.sha256().digest_size
+
+
+def build_fingerprinter(key_fields: List[str], algorithm: str = 'sha256-json', digest_size: int = 16) -> Fingerprinter:
+    """
+    Собирает функцию event_data -> отпечаток один раз для заданных полей.
+
+    Отпечатки v2 начинаются с тега версии и алгоритма, поэтому отпечатки
+    разных форматов никогда не совпадут. При смене формата окно
+    дедупликации начинается заново: события, виденные в старом формате,
+    новым не распознаются как дубли.
+    """
+    if algorithm not in FINGERPRINT_ALGORITHMS:
+        raise ValueError(f"Неизвестный алгоритм отпечатка: {algorithm!r} (допустимы {', '.join(FINGERPRINT_ALGORITHMS)})")
+    if algorithm == 'blake2b' and not (isinstance(digest_size, int) and 8 <= digest_size <= 32):
+        raise ValueError("digest_size для blake2b должен быть целым числом от 8 до 32")
+
+    fields = tuple(sorted(key_fields))
+
+    if algorithm == 'sha256-json':
+        sha256 = hashlib.sha256
+
+        def legacy_fingerprint(event_data: Dict[str, Any]) -> str:
+            get = event_data.get
+            key_data = {field: get(field) for field in fields}
+            return sha256(_canonical_json(key_data).encode('utf-8')).hexdigest()
+
+        return legacy_fingerprint
+
+    if algorithm == 'sha256':
+        base = hashlib.sha256()
+    else:
+        base = hashlib.blake2b(digest_size=digest_size)
+    # Имена полей хешируются один раз; на событие копируется уже "заправленный" хешер
+    base.update(_canonical_json(fields).encode('utf-8'))
+    tag = fingerprint_tag(algorithm, digest_size)
+    encode = _encode_value
+
+    def fingerprint(event_data: Dict[str, Any]) -> str:
+        get = event_data.get
+        hasher = base.copy()
+        hasher.update("".join([encode(get(field)) for field in fields]).encode('utf-8'))
+        return tag + hasher.hexdigest()
+
+    return fingerprint
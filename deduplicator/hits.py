@@ -0,0 +1,242 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import redis
+
+from .storage import DedupStorage
+
+
+logger = logging.getLogger(__name__)
+
+# Повтор отпечатка, ожидающий переноса: (отпечаток, число повторов, unix time последнего)
+Hit = Tuple[str, int, float]
+
+# Сколько отпечатков уходит в Redis одним вызовом скрипта
+SCRIPT_CHUNK = 500
+
+
+class DuplicateHits:
+    """
+    Учет повторов событий без записи в БД на каждый дубль.
+
+    record() копит число повторов и время последнего в памяти процесса,
+    фоновый поток раз в interval секунд сбрасывает их в хэши Redis
+    <key> (счетчики) и <key>:last (время); в БД их переносит задача
+    flush_duplicate_hits. sliding - окно дедупликации отсчитывается от
+    последнего повтора (DedupStorage.touch_many), count=False - без счетчиков.
+    Пока Redis недоступен, повторы копятся до следующего сброса.
+    """
+
+    # KEYS: счетчики, время последнего повтора. ARGV: тройки отпечаток, повторы, время
+    RECORD_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    local last = redis.call('HGET', KEYS[2], ARGV[i])
+    if not last or tonumber(last) < tonumber(ARGV[i + 2]) then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+return #ARGV / 3
+"""
+
+    # KEYS: счетчики, время, их снимки. Снимок берется, только если предыдущий
+    # разобран полностью: иначе продолжается разбор недоразобранного
+    CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[3])
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('RENAME', KEYS[2], KEYS[4])
+    end
+end
+return redis.call('HLEN', KEYS[3])
+"""
+
+    def __init__(self, redis_client: redis.Redis, key: str = "event_dedup:hits", interval: float = 5.0,
+                 count: bool = True, sliding: bool = False):
+        if interval <= 0:
+            raise ValueError("interval должен быть положительным числом")
+        if not count and not sliding:
+            raise ValueError("Нужен хотя бы один режим: count или sliding")
+        self.redis = redis_client
+        self.key = key
+        self.last_key = f"{key}:last"
+        self.interval = interval
+        self.count = count
+        self.sliding = sliding
+        self._record_script = redis_client.register_script(self.RECORD_SCRIPT)
+        self._claim_script = redis_client.register_script(self.CLAIM_SCRIPT)
+
+        # отпечаток -> [число повторов, время последнего]
+        self._hits: Dict[str, List] = {}
+        # хранилище политики -> отпечатки, чье окно нужно продлить
+        self._touches: Dict[DedupStorage, Set[str]] = defaultdict(set)
+        # _lock защищает накопленное, _flush_lock гарантирует один сброс за раз
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._hooks_registered = False
+
+    @property
+    def snapshot_key(self) -> str:
+        return f"{self.key}:flushing"
+
+    @property
+    def snapshot_last_key(self) -> str:
+        return f"{self.last_key}:flushing"
+
+    def record(self, fingerprint: str, storage: Optional[DedupStorage] = None) -> None:
+        self.record_many([(fingerprint, storage)])
+
+    def record_many(self, items: Sequence[Tuple[str, Optional[DedupStorage]]]) -> None:
+        """Повторы (отпечаток, хранилище его политики) - без I/O, только память процесса."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            for fingerprint, storage in items:
+                if self.count:
+                    hit = self._hits.get(fingerprint)
+                    if hit is None:
+                        self._hits[fingerprint] = [1, now]
+                    else:
+                        hit[0] += 1
+                        hit[1] = now
+                if self.sliding and storage is not None:
+                    self._touches[storage].add(fingerprint)
+        self._ensure_flusher()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._hits) + sum(len(fingerprints) for fingerprints in self._touches.values())
+
+    def flush(self) -> None:
+        """Сбрасывает накопленное в Redis; неотправленное остается до следующего сброса."""
+        with self._flush_lock:
+            with self._lock:
+                hits, self._hits = self._hits, {}
+                touches, self._touches = self._touches, defaultdict(set)
+
+            items = [(fingerprint, count, last_seen) for fingerprint, (count, last_seen) in hits.items()]
+            sent = 0
+            try:
+                for sent in range(0, len(items), SCRIPT_CHUNK):
+                    self.add(items[sent:sent + SCRIPT_CHUNK])
+                sent = len(items)
+            except redis.RedisError as e:
+                logger.warning("Не удалось сбросить повторы в Redis (%d отпечатков), повторим позже: %s",
+                               len(items) - sent, e)
+                self._return_hits(items[sent:])
+
+            for storage, fingerprints in touches.items():
+                try:
+                    storage.touch_many(list(fingerprints))
+                except redis.RedisError as e:
+                    logger.warning("Не удалось продлить окно %d отпечатков, повторим позже: %s", len(fingerprints), e)
+                    with self._lock:
+                        self._touches[storage].update(fingerprints)
+
+    def add(self, items: Sequence[Hit], client: Optional[redis.Redis] = None) -> None:
+        """Складывает повторы в хэши Redis (client - например, pipeline)."""
+        args = []
+        for fingerprint, count, last_seen in items:
+            args += [fingerprint, count, f"{last_seen:.3f}"]
+        self._record_script(keys=[self.key, self.last_key], args=args, client=client)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+    # --- Перенос в БД (задача beat flush_duplicate_hits) ---
+
+    def claim(self) -> int:
+        """
+        Переименовывает хэши в снимок (новые повторы пишутся в новые хэши)
+        и возвращает число отпечатков в снимке. Недоразобранный снимок
+        (перенос прервался) не заменяется, а разбирается дальше.
+        """
+        return self._claim_script(keys=[self.key, self.last_key, self.snapshot_key, self.snapshot_last_key])
+
+    def claimed(self, size: int) -> Iterator[List[Hit]]:
+        """
+        Пачки повторов из снимка. В снимок никто не пишет, но HSCAN может
+        вернуть поле дважды (если хэш перестраивается после ack) - такие
+        повторно не выдаются.
+        """
+        seen: Set[str] = set()
+        cursor = 0
+        while True:
+            cursor, counts = self.redis.hscan(self.snapshot_key, cursor, count=size)
+            fingerprints = [fingerprint for fingerprint in counts if fingerprint not in seen]
+            for start in range(0, len(fingerprints), size):
+                chunk = fingerprints[start:start + size]
+                seen.update(chunk)
+                last_seen = self.redis.hmget(self.snapshot_last_key, chunk)
+                yield [
+                    (fingerprint, int(counts[fingerprint]), float(last or 0))
+                    for fingerprint, last in zip(chunk, last_seen)
+                ]
+            if not cursor:
+                return
+
+    def ack(self, fingerprints: Sequence[str], requeue: Sequence[Hit] = ()) -> None:
+        """
+        Убирает перенесенные отпечатки из снимка; requeue возвращаются в
+        текущие хэши (до следующего переноса). Одна транзакция MULTI.
+        """
+        pipe = self.redis.pipeline()
+        if requeue:
+            self.add(requeue, client=pipe)
+        if fingerprints:
+            pipe.hdel(self.snapshot_key, *fingerprints)
+            pipe.hdel(self.snapshot_last_key, *fingerprints)
+        pipe.execute()
+
+    def release(self) -> None:
+        """Удаляет разобранный снимок."""
+        self.redis.delete(self.snapshot_key, self.snapshot_last_key)
+
+    def _return_hits(self, items: Sequence[Hit]) -> None:
+        with self._lock:
+            for fingerprint, count, last_seen in items:
+                hit = self._hits.get(fingerprint)
+                if hit is None:
+                    self._hits[fingerprint] = [count, last_seen]
+                else:
+                    hit[0] += count
+                    hit[1] = max(hit[1], last_seen)
+
+    def _ensure_flusher(self) -> None:
+        # Поток запускается лениво, уже в рабочем процессе (после fork воркера)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if not self._hooks_registered:
+                self._hooks_registered = True
+                os.register_at_fork(after_in_child=self._restart_after_fork)
+                atexit.register(self.stop)
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="duplicate-hits-flusher", daemon=True)
+            self._thread.start()
+
+    def _restart_after_fork(self) -> None:
+        # Потоки не переживают fork; повторы родителя сбросит сам родитель
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._hits = {}
+        self._touches = defaultdict(set)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Ошибка фонового сброса повторов: %s", e)
@@ -1,16 +1,31 @@
 
-import hashlib
-import json
-from typing import Dict, Any, Optional, List, Tuple
+from collections import defaultdict
+from typing import Dict, Any, Optional, List, Sequence, Tuple
 import redis
 import logging
+import time
+
+from . import metrics
+from .cache import FingerprintCache
+from .circuit import CircuitBreaker, CircuitOpenError
+from .fingerprint import build_fingerprinter
+from .hits import DuplicateHits
+from .policies import DEFAULT_POLICY, DedupPolicy, PolicyRegistry
+from .similarity import NearDuplicateIndex
+from .storage import DedupStorage, StringKeyStorage
 
 
 logger = logging.getLogger(__name__)
 
 class EventDeduplicator:
     # Принимаем синхронный redis.Redis
-    def __init__(self, redis_client: redis.Redis, ttl_seconds: int, key_fields: List[str]):
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int, key_fields: List[str],
+                 local_cache: Optional[FingerprintCache] = None, storage: Optional[DedupStorage] = None,
+                 fingerprint_algorithm: str = 'sha256-json', digest_size: int = 16,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 policies: Sequence[DedupPolicy] = (), policy_field: str = 'event_name',
+                 duplicate_hits: Optional[DuplicateHits] = None,
+                 near_duplicates: Optional[NearDuplicateIndex] = None):
 
         # --- ПРОСТАЯ ПРОВЕРКА НА ТИП ---
         if not isinstance(redis_client, redis.Redis):
@@ -27,46 +42,451 @@ class EventDeduplicator:
         self.redis = redis_client
         self.ttl = ttl_seconds
         self.key_fields = sorted(key_fields)
+        # Функция отпечатка собирается один раз под key_fields (см. deduplicator/fingerprint.py)
+        self._fingerprint = build_fingerprinter(self.key_fields, fingerprint_algorithm, digest_size)
+
+        # Раскладка отпечатков в Redis; по умолчанию - строковый ключ на событие
+        self.storage = storage if storage is not None else StringKeyStorage(redis_client, ttl_seconds)
+
+        # Политики по типам событий (см. deduplicator/policies.py): свои поля ключа, TTL и
+        # хранилище. Остальные события идут по политике по умолчанию - key_fields, ttl_seconds, storage
+        self.policies = PolicyRegistry(
+            DedupPolicy(DEFAULT_POLICY, self.key_fields, ttl_seconds, self.storage, self._fingerprint),
+            policies,
+            field=policy_field,
+        )
+
+        # Необязательный L1-кэш отпечатков в памяти процесса (см. FingerprintCache).
+        # Кэш общий для всех политик, поэтому его TTL не больше самого короткого TTL политик
+        if local_cache is not None and local_cache.ttl > self.policies.min_ttl:
+            raise ValueError("TTL локального кэша не может быть больше ttl_seconds (и TTL политик)")
+        self.local_cache = local_cache
+
+        # Все ли политики хранят отпечатки строковыми ключами (см. check_and_stream_many)
+        self.string_keys_only = all(isinstance(policy.storage, StringKeyStorage) for policy in self.policies)
+
+        # Необязательный предохранитель: пока Redis недоступен, проверки не ждут
+        # таймаута на каждом событии, а сразу получают CircuitOpenError
+        self.circuit_breaker = circuit_breaker
+
+        # Необязательный учет повторов (и скользящее окно): дубли считаются в Redis,
+        # в БД переносятся пачками (см. deduplicator/hits.py)
+        self.duplicate_hits = duplicate_hits
+
+        # Необязательный поиск почти-дублей (MinHash + LSH, см. deduplicator/similarity.py):
+        # события, новые для точной проверки, сравниваются с похожими по полям индекса
+        self.near_duplicates = near_duplicates
+
+    def _redis_call(self, func, *args):
+        started = time.perf_counter()
+        try:
+            if self.circuit_breaker is None:
+                result = func(*args)
+            else:
+                result = self.circuit_breaker.call(func, *args)
+        except redis.RedisError as e:
+            _record_redis_error(e, started)
+            raise
+        metrics.REDIS_CHECK_SECONDS.observe(time.perf_counter() - started)
+        return result
+
+    async def _redis_call_async(self, func, *args):
+        started = time.perf_counter()
+        try:
+            if self.circuit_breaker is None:
+                result = await func(*args)
+            else:
+                result = await self.circuit_breaker.call_async(func, *args)
+        except redis.RedisError as e:
+            _record_redis_error(e, started)
+            raise
+        metrics.REDIS_CHECK_SECONDS.observe(time.perf_counter() - started)
+        return result
+
+    def redis_retry_after(self, default: float) -> float:
+        """Через сколько секунд имеет смысл повторить проверку, отклоненную из-за недоступности Redis."""
+        if self.circuit_breaker is None:
+            return default
+        return max(self.circuit_breaker.retry_after(), 1.0)
+
+    def _log_redis_error(self, message: str, error: redis.RedisError) -> None:
+        # Пока предохранитель разомкнут, отказ - ожидаемое состояние, а не новая ошибка
+        if isinstance(error, CircuitOpenError):
+            logger.debug("%s: %s", message, error)
+        else:
+            logger.error("%s: %s", message, error)
 
+    def _cached(self, fingerprint: str) -> bool:
+        """Есть ли отпечаток в L1-кэше (попадание - событие уже записано в Redis этим процессом)."""
+        if self.local_cache is None:
+            return False
+        if self.local_cache.contains(fingerprint):
+            metrics.L1_CACHE_HITS.inc()
+            return True
+        metrics.L1_CACHE_MISSES.inc()
+        return False
 
-    def _generate_fingerprint(self, event_data: Dict[str, Any]) -> Optional[str]:
+    def _cache(self, fingerprint: str) -> None:
+        if self.local_cache is not None:
+            evicted = self.local_cache.add(fingerprint)
+            if evicted:
+                metrics.L1_CACHE_EVICTIONS.inc(evicted)
+
+    def _generate_fingerprint(self, event_data: Dict[str, Any], policy: DedupPolicy) -> Optional[str]:
         try:
-            key_data = {field: event_data.get(field) for field in self.key_fields}
-            canonical_string = json.dumps(key_data, sort_keys=True, separators=(',', ':'))
-            fingerprint = hashlib.sha256(canonical_string.encode('utf-8')).hexdigest()
-            return fingerprint
+            return policy.fingerprint(event_data)
         except Exception as e:
-            logger.error(f"Ошибка генерации отпечатка для события {event_data}: {e}")
+            logger.error("Ошибка генерации отпечатка для события %s: %s", event_data, e)
             return None
 
     # --- синхронный метод ---
-    def check_duplication(self, event_data: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    def check_duplication(self, event_data: Dict[str, Any], fail_open: bool = True) -> Tuple[bool, Optional[str]]:
+        """
+        Проверка-и-запись отпечатка события. Возвращает (is_duplicate, fingerprint).
+        Если Redis недоступен (или разомкнут предохранитель), при fail_open
+        событие считается новым, иначе ошибка Redis пробрасывается.
+        """
         if not isinstance(event_data, dict):
             logger.warning("Получены невалидные данные события (не словарь)")
             return False, None
 
-        fingerprint = self._generate_fingerprint(event_data)
+        started = time.perf_counter()
+        policy = self.policies.resolve(event_data)
+        fingerprint = self._generate_fingerprint(event_data, policy)
+        metrics.FINGERPRINT_SECONDS.observe(time.perf_counter() - started)
 
         if fingerprint is None:
-            logger.warning(f"Не удалось сгенерировать отпечаток для: {event_data}")
+            logger.warning("Не удалось сгенерировать отпечаток для: %s", event_data)
             return False, None
 
-        redis_key = f"event_dedup:{fingerprint}"
+        # Попадание в L1-кэш: отпечаток уже записан в Redis, идти туда не нужно
+        if self._cached(fingerprint):
+            logger.debug("Обнаружен дубль события (L1-кэш): %s", fingerprint)
+            metrics.EVENTS_CHECKED.inc(label_value='duplicate')
+            self._record_duplicate(fingerprint, policy)
+            return True, fingerprint
 
         try:
-            # --- СИНХРОННЫЙ ВЫЗОВ redis.set ---
-            is_new = self.redis.set(redis_key, "1", ex=self.ttl, nx=True)
+            # --- СИНХРОННАЯ ПРОВЕРКА-И-ЗАПИСЬ В REDIS ---
+            is_new = self._redis_call(policy.storage.add, fingerprint)
+
+            self._cache(fingerprint)
 
+            if is_new and self.near_duplicates is not None:
+                similar = self._find_near_duplicates([(0, event_data, fingerprint, policy)])
+                if similar:
+                    return self._near_duplicate(fingerprint, similar[0])
+
+            metrics.EVENTS_CHECKED.inc(label_value='unique' if is_new else 'duplicate')
             if is_new:
-                logger.debug(f"Новое событие зарегистрировано: {fingerprint}")
+                logger.debug("Новое событие зарегистрировано: %s", fingerprint)
                 return False, fingerprint
             else:
-                logger.debug(f"Обнаружен дубль события: {fingerprint}")
+                logger.debug("Обнаружен дубль события: %s", fingerprint)
+                self._record_duplicate(fingerprint, policy)
                 return True, fingerprint
         # Ловим ошибку синхронного клиента
         except redis.RedisError as e:
-            logger.error(f"Ошибка Redis при проверке дубликации ({fingerprint}): {e}")
+            if not fail_open:
+                raise
+            self._log_redis_error(f"Ошибка Redis при проверке дубликации ({fingerprint})", e)
+            metrics.EVENTS_CHECKED.inc(label_value='unchecked')
+            return False, fingerprint
+        except Exception as e:
+            logger.exception("Неожиданная ошибка в check_duplication (%s): %s", fingerprint, e)
+            return False, fingerprint
+
+    # --- асинхронный метод (для ASGI-эндпоинта) ---
+    async def check_duplication_async(self, event_data: Dict[str, Any],
+                                      fail_open: bool = True) -> Tuple[bool, Optional[str]]:
+        """
+        То же, что check_duplication, но через redis.asyncio (пул соединений
+        хранилища, см. DedupStorage.async_redis). Не блокирует event loop.
+        """
+        if not isinstance(event_data, dict):
+            logger.warning("Получены невалидные данные события (не словарь)")
+            return False, None
+
+        started = time.perf_counter()
+        policy = self.policies.resolve(event_data)
+        fingerprint = self._generate_fingerprint(event_data, policy)
+        metrics.FINGERPRINT_SECONDS.observe(time.perf_counter() - started)
+
+        if fingerprint is None:
+            logger.warning("Не удалось сгенерировать отпечаток для: %s", event_data)
+            return False, None
+
+        if self._cached(fingerprint):
+            logger.debug("Обнаружен дубль события (L1-кэш): %s", fingerprint)
+            metrics.EVENTS_CHECKED.inc(label_value='duplicate')
+            self._record_duplicate(fingerprint, policy)
+            return True, fingerprint
+
+        try:
+            is_new, = await self._redis_call_async(policy.storage.add_many_async, [fingerprint])
+
+            self._cache(fingerprint)
+
+            if is_new and self.near_duplicates is not None:
+                similar = await self._find_near_duplicates_async([(0, event_data, fingerprint, policy)])
+                if similar:
+                    return self._near_duplicate(fingerprint, similar[0])
+
+            logger.debug("%s: %s", 'Новое событие зарегистрировано' if is_new else 'Обнаружен дубль события', fingerprint)
+            metrics.EVENTS_CHECKED.inc(label_value='unique' if is_new else 'duplicate')
+            if not is_new:
+                self._record_duplicate(fingerprint, policy)
+            return not is_new, fingerprint
+        except redis.RedisError as e:
+            if not fail_open:
+                raise
+            self._log_redis_error(f"Ошибка Redis при проверке дубликации ({fingerprint})", e)
+            metrics.EVENTS_CHECKED.inc(label_value='unchecked')
             return False, fingerprint
         except Exception as e:
-            logger.exception(f"Неожиданная ошибка в check_duplication ({fingerprint}): {e}")
-            return False, fingerprint
\ No newline at end of file
+            logger.exception("Неожиданная ошибка в check_duplication_async (%s): %s", fingerprint, e)
+            return False, fingerprint
+
+    # --- синхронный пакетный метод ---
+    def check_duplication_many(self, events: List[Dict[str, Any]],
+                               fail_open: bool = True) -> List[Tuple[bool, Optional[str]]]:
+        """
+        Пакетная версия check_duplication: проверки уходят в Redis одним
+        pipeline на хранилище политики. Возвращает (is_duplicate, fingerprint)
+        в порядке событий; повторы внутри пакета - дубли, невалидные события -
+        (False, None). При ошибке Redis первые вхождения получают
+        is_duplicate=False; с fail_open=False ошибка пробрасывается.
+        """
+        results, first_seen = self._prepare_batch(events)
+
+        if not first_seen:
+            _count_checked(results)
+            self._record_duplicates(events, results)
+            return results
+
+        try:
+            replies = self._add_many(first_seen)
+        except redis.RedisError as e:
+            if not fail_open:
+                raise
+            self._log_redis_error(f"Ошибка Redis при пакетной проверке дубликации ({len(first_seen)} отпечатков)", e)
+            _count_checked(results, new_label='unchecked')
+            self._record_duplicates(events, results)
+            return results
+        except Exception as e:
+            logger.exception("Неожиданная ошибка в check_duplication_many (%d отпечатков): %s", len(first_seen), e)
+            return results
+
+        fresh = []
+        for (fingerprint, (index, policy)), is_new in zip(first_seen.items(), replies):
+            results[index] = (not is_new, fingerprint)
+            self._cache(fingerprint)
+            if is_new:
+                fresh.append((index, events[index], fingerprint, policy))
+
+        similar = self._find_near_duplicates(fresh) if self.near_duplicates is not None and fresh else {}
+        for index in similar:
+            results[index] = (True, results[index][1])
+        _count_checked(results, near=len(similar))
+        self._record_duplicates(events, results, similar)
+
+        logger.debug("Пакет проверен: %d событий, %d уникальных отпечатков в пакете.", len(events), len(first_seen))
+        return results
+
+    def check_and_stream_many(self, events: List[Dict[str, Any]], stream: Any) -> List[Tuple[bool, Optional[str]]]:
+        """
+        Проверка при приеме: новые события атомарно (одним Lua-скриптом)
+        записываются в Redis и добавляются в stream (EventStream), дубли
+        дальше не идут. Результат - как у check_duplication_many.
+
+        Работает только со строковой раскладкой (StringKeyStorage) у всех
+        политик: скрипт сам делает SET NX EX их ключей, каждый со своим TTL.
+        Ошибки Redis пробрасываются - в этом случае ни одно событие пакета
+        не поставлено в поток.
+        """
+        if not self.string_keys_only:
+            raise ValueError("Атомарная проверка при приеме поддерживается только для строковой раскладки")
+        if self.near_duplicates is not None:
+            raise ValueError("Атомарная проверка при приеме не ищет почти-дубли")
+
+        results, first_seen = self._prepare_batch(events)
+        if not first_seen:
+            _count_checked(results)
+            self._record_duplicates(events, results)
+            return results
+
+        replies = self._redis_call(
+            stream.append_new,
+            [(policy.storage.key(fingerprint), fingerprint, events[index], policy.ttl)
+             for fingerprint, (index, policy) in first_seen.items()],
+        )
+        for (fingerprint, (index, _)), is_new in zip(first_seen.items(), replies):
+            results[index] = (not is_new, fingerprint)
+            self._cache(fingerprint)
+        _count_checked(results)
+        self._record_duplicates(events, results)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Пакет проверен при приеме: %d событий, %d поставлено в поток.", len(events), sum(replies))
+        return results
+
+    def forget_many(self, rows: Sequence[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Забывает отпечатки событий, которые не удалось сохранить в БД
+        (rows - пары fingerprint, event_data): следующая копия снова будет
+        новой. Ошибки Redis пробрасываются.
+        """
+        groups: Dict[DedupStorage, List[str]] = defaultdict(list)
+        for fingerprint, event_data in rows:
+            groups[self.policies.resolve(event_data).storage].append(fingerprint)
+            if self.local_cache is not None:
+                self.local_cache.discard(fingerprint)
+        for storage, fingerprints in groups.items():
+            storage.forget_many(fingerprints)
+        if self.near_duplicates is not None:
+            self.near_duplicates.forget_many([fingerprint for fingerprint, _ in rows])
+
+    def _record_duplicate(self, fingerprint: str, policy: Optional[DedupPolicy]) -> None:
+        if self.duplicate_hits is not None:
+            self.duplicate_hits.record(fingerprint, policy.storage if policy is not None else None)
+
+    def _record_duplicates(self, events: List[Dict[str, Any]], results: List[Tuple[bool, Optional[str]]],
+                           similar: Optional[Dict[int, str]] = None) -> None:
+        """
+        Повторы пакета - в duplicate_hits (включая повторы внутри пакета и попадания в L1-кэш).
+        Почти-дубль засчитывается похожему событию (similar: индекс -> его отпечаток), окно не продлевается.
+        """
+        if self.duplicate_hits is None:
+            return
+        resolve = self.policies.resolve
+        similar = similar or {}
+        self.duplicate_hits.record_many([
+            (similar[index], None) if index in similar else (fingerprint, resolve(event_data).storage)
+            for index, (event_data, (is_duplicate, fingerprint)) in enumerate(zip(events, results))
+            if is_duplicate
+        ])
+
+    def _near_duplicate(self, fingerprint: str, similar: str) -> Tuple[bool, str]:
+        logger.debug("Обнаружен почти-дубль события: %s (похоже на %s)", fingerprint, similar)
+        metrics.EVENTS_CHECKED.inc(label_value='near_duplicate')
+        self._record_duplicate(similar, None)
+        return True, fingerprint
+
+    def _near_probes(self, items: List[Tuple[int, Dict[str, Any], str, DedupPolicy]]):
+        probes, indexes = [], []
+        for index, event_data, fingerprint, policy in items:
+            probe = self.near_duplicates.probe(event_data, fingerprint, policy)
+            if probe is not None:
+                probes.append(probe)
+                indexes.append(index)
+        return probes, indexes
+
+    def _find_near_duplicates(self, items: List[Tuple[int, Dict[str, Any], str, DedupPolicy]]) -> Dict[int, str]:
+        """
+        Ищет почти-дубли среди событий, новых для точной проверки. items -
+        (индекс, событие, отпечаток, политика). Возвращает индекс -> отпечаток
+        похожего события. Ошибка Redis не пробрасывается даже без fail-open:
+        отпечатки уже записаны, и повтор проверки принял бы события за точные
+        дубли - поэтому события остаются новыми.
+        """
+        probes, indexes = self._near_probes(items)
+        if not probes:
+            return {}
+        try:
+            replies = self._redis_call(self.near_duplicates.find_or_add_many, probes)
+        except redis.RedisError as e:
+            self._log_redis_error(f"Ошибка Redis при поиске почти-дублей ({len(probes)} событий)", e)
+            return {}
+        return {index: similar for index, similar in zip(indexes, replies) if similar}
+
+    async def _find_near_duplicates_async(self, items: List[Tuple[int, Dict[str, Any], str, DedupPolicy]]
+                                          ) -> Dict[int, str]:
+        probes, indexes = self._near_probes(items)
+        if not probes:
+            return {}
+        try:
+            replies = await self._redis_call_async(self.near_duplicates.find_or_add_many_async, probes)
+        except redis.RedisError as e:
+            self._log_redis_error(f"Ошибка Redis при поиске почти-дублей ({len(probes)} событий)", e)
+            return {}
+        return {index: similar for index, similar in zip(indexes, replies) if similar}
+
+    def _add_many(self, first_seen: Dict[str, Tuple[int, DedupPolicy]]) -> List[bool]:
+        """
+        Проверка-и-запись отпечатков пакета в хранилищах их политик: один
+        add_many на хранилище. Ответы - в порядке first_seen.
+        """
+        groups: Dict[DedupStorage, List[str]] = defaultdict(list)
+        for fingerprint, (_, policy) in first_seen.items():
+            groups[policy.storage].append(fingerprint)
+        if len(groups) == 1:
+            storage, fingerprints = next(iter(groups.items()))
+            return self._redis_call(storage.add_many, fingerprints)
+
+        is_new: Dict[str, bool] = {}
+        for storage, fingerprints in groups.items():
+            is_new.update(zip(fingerprints, self._redis_call(storage.add_many, fingerprints)))
+        return [is_new[fingerprint] for fingerprint in first_seen]
+
+    def _prepare_batch(self, events: List[Dict[str, Any]]
+                       ) -> Tuple[List[Tuple[bool, Optional[str]]], Dict[str, Tuple[int, DedupPolicy]]]:
+        """
+        Общая часть пакетных проверок: отпечатки, повторы внутри пакета и L1-кэш.
+        Возвращает предварительные результаты и отпечатки, которые нужно
+        проверить в Redis (отпечаток -> индекс первого вхождения и его политика).
+        """
+        results: List[Tuple[bool, Optional[str]]] = [(False, None)] * len(events)
+        # отпечаток -> (индекс первого вхождения в пакете, политика); порядок вставки сохраняется
+        first_seen: Dict[str, Tuple[int, DedupPolicy]] = {}
+        resolve = self.policies.resolve
+
+        started = time.perf_counter()
+        for index, event_data in enumerate(events):
+            if not isinstance(event_data, dict):
+                logger.warning("Получены невалидные данные события (не словарь)")
+                continue
+
+            policy = resolve(event_data)
+            fingerprint = self._generate_fingerprint(event_data, policy)
+            if fingerprint is None:
+                logger.warning("Не удалось сгенерировать отпечаток для: %s", event_data)
+                continue
+
+            if fingerprint in first_seen:
+                results[index] = (True, fingerprint)
+            elif self._cached(fingerprint):
+                results[index] = (True, fingerprint)
+            else:
+                first_seen[fingerprint] = (index, policy)
+                results[index] = (False, fingerprint)
+        metrics.FINGERPRINT_SECONDS.observe(time.perf_counter() - started)
+
+        return results, first_seen
+
+
+def _record_redis_error(error: redis.RedisError, started: float) -> None:
+    if isinstance(error, CircuitOpenError):
+        # До Redis вызов не дошел: в гистограмму задержек его не пишем
+        metrics.REDIS_ERRORS.inc(label_value='circuit_open')
+        return
+    metrics.REDIS_CHECK_SECONDS.observe(time.perf_counter() - started)
+    if isinstance(error, redis.TimeoutError):
+        kind = 'timeout'
+    elif isinstance(error, redis.ConnectionError):
+        kind = 'connection'
+    else:
+        kind = 'response'
+    metrics.REDIS_ERRORS.inc(label_value=kind)
+
+
+def _count_checked(results: List[Tuple[bool, Optional[str]]], new_label: str = 'unique', near: int = 0) -> None:
+    """Счетчики пакета: дубли, почти-дубли (near из числа дублей) и новые (или непроверенные при ошибке Redis) события."""
+    duplicates = checked = 0
+    for is_duplicate, fingerprint in results:
+        if fingerprint is not None:
+            checked += 1
+            duplicates += is_duplicate
+    metrics.EVENTS_CHECKED.inc(duplicates - near, 'duplicate')
+    if near:
+        metrics.EVENTS_CHECKED.inc(near, 'near_duplicate')
+    metrics.EVENTS_CHECKED.inc(checked - duplicates, new_label)
@@ -0,0 +1,137 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from deduplicator import partitions
+from deduplicator.archive import ARCHIVE_COMPRESSIONS, ArchiveWriter
+from deduplicator.management.commands.cleanup_old_events import DAYS_TO_KEEP
+from deduplicator.models import UniqueEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Streams unique events older than the retention cutoff into compressed JSONL files and removes them '
+            'from the database once each chunk is durably on disk. Run it before cleanup_old_events.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output-dir',
+            required=True,
+            help='Directory for archive files (created if missing).',
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=DAYS_TO_KEEP,
+            help=f'Archive events older than this many days (default: {DAYS_TO_KEEP}).',
+        )
+        parser.add_argument(
+            '--compression',
+            choices=sorted(ARCHIVE_COMPRESSIONS),
+            default='gzip',
+            help='Archive compression (default: gzip; zstd needs the zstandard package).',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10_000,
+            help='Rows fetched, written and deleted per step (default: 10000).',
+        )
+        parser.add_argument(
+            '--rows-per-file',
+            type=int,
+            default=1_000_000,
+            help='Start a new archive file after this many rows (default: 1000000).',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Only write the archive, do not delete anything from the database.',
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("--days and --chunk-size must be positive integers.")
+
+        cutoff_date = timezone.now() - timedelta(days=options['days'])
+        self.options = options
+        self.stdout.write(f"Archiving events received before {cutoff_date:%Y-%m-%d %H:%M:%S %Z} "
+                          f"to {options['output_dir']} ({options['compression']})...")
+
+        started = time.monotonic()
+        total = 0
+        try:
+            if partitions.is_partitioned():
+                # Секции целиком старше cutoff архивируются полностью и удаляются через DROP
+                for name, _, _ in partitions.expired_partitions(cutoff_date):
+                    total += self._archive_table(name, cutoff=None, delete_chunks=False)
+                    if not options['keep']:
+                        partitions.drop_partition(name)
+                        self.stdout.write(f"  partition {name} archived and dropped")
+                # В секции по умолчанию старые строки удаляются по чанкам
+                total += self._archive_table(partitions.DEFAULT_PARTITION, cutoff_date, not options['keep'])
+            else:
+                total += self._archive_table(UniqueEvent._meta.db_table, cutoff_date, not options['keep'])
+        except (OSError, ValueError) as e:
+            logger.exception("Ошибка при архивации событий: %s", e)
+            raise CommandError(f"Failed to archive old events: {e}")
+
+        elapsed = time.monotonic() - started
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total} events in {elapsed:.1f}s ({rate:,.0f} rows/s)"
+            f"{'' if options['keep'] else ', removed from the database'}."
+        ))
+        logger.info("Архивировано %d событий старше %s за %.1f с (%.0f строк/с)", total, cutoff_date, elapsed, rate)
+
+    def _archive_table(self, table, cutoff, delete_chunks):
+        """
+        Выгружает строки таблицы (или секции) по ключу id: каждый запрос
+        берет следующие chunk_size строк после последнего выгруженного id,
+        поэтому в памяти не больше одного чанка, а запрос не замедляется
+        к концу таблицы, как OFFSET. Если delete_chunks, строки чанка
+        удаляются сразу после того, как чанк записан на диск.
+        """
+        chunk_size = self.options['chunk_size']
+        quoted = connection.ops.quote_name(table)
+        select_sql = (f"SELECT id, fingerprint, event_data, received_at FROM {quoted} WHERE id > %s"
+                      f"{' AND received_at < %s' if cutoff else ''} ORDER BY id LIMIT %s")
+        writer = ArchiveWriter(self.options['output_dir'], table, self.options['compression'],
+                               self.options['rows_per_file'])
+
+        archived, last_id = 0, 0
+        started = time.monotonic()
+        try:
+            while True:
+                params = [last_id, cutoff, chunk_size] if cutoff else [last_id, chunk_size]
+                with connection.cursor() as cursor:
+                    cursor.execute(select_sql, params)
+                    rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                writer.write_chunk(rows)
+                last_id = rows[-1][0]
+                if delete_chunks:
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"DELETE FROM {quoted} WHERE id IN ({', '.join(['%s'] * len(rows))})",
+                                       [row[0] for row in rows])
+
+                archived += len(rows)
+                if archived % (chunk_size * 10) == 0:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(f"  {table}: {archived} rows, {archived / elapsed:,.0f} rows/s")
+        finally:
+            writer.close()
+
+        if archived:
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"  {table}: {archived} rows in {len(writer.files)} files, "
+                              f"{archived / elapsed:,.0f} rows/s")
+        return archived
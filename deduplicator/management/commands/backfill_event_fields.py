@@ -0,0 +1,101 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from deduplicator.models import PROMOTED_FIELDS, UniqueEvent
+
+
+logger = logging.getLogger(__name__)
+
+# Как часто выводить прогресс, секунд
+REPORT_INTERVAL = 10
+
+
+class Command(BaseCommand):
+    help = ('Fills the event_name, user_id and client_id columns of events stored before they existed, '
+            'copying the values from event_data in batches of consecutive ids.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10_000,
+            help='Ids covered by one UPDATE (default: 10000). Each batch is its own transaction.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.0,
+            help='Pause between batches in seconds, to leave I/O for the live workload (default: 0).',
+        )
+        parser.add_argument(
+            '--start-id',
+            type=int,
+            default=None,
+            help='Resume from this id (printed in the progress lines) instead of the smallest one.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+        pause = options['sleep']
+        if pause < 0:
+            raise CommandError("--sleep cannot be negative.")
+
+        table = connection.ops.quote_name(UniqueEvent._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT min(id), max(id) FROM {table}")
+            min_id, max_id = cursor.fetchone()
+        if max_id is None:
+            self.stdout.write(self.style.SUCCESS("The table is empty, nothing to backfill."))
+            return
+        # Строки новее max_id пишет уже новый код, с заполненными колонками
+        start_id = options['start_id'] if options['start_id'] is not None else min_id
+
+        # Значение колонки - как у models.promoted_value: ->> дает строки как есть, а числа и
+        # булевы - в записи JSON; вложенные объекты и массивы не переносятся
+        assignments, params = [], []
+        for column, field in PROMOTED_FIELDS.items():
+            assignments.append(
+                f"{connection.ops.quote_name(column)} = CASE WHEN jsonb_typeof(event_data -> %s) IN ('object', 'array') "
+                f"THEN NULL ELSE event_data ->> %s END"
+            )
+            params += [field, field]
+        # Только строки, где все колонки пусты, а в event_data есть хотя бы одно из полей:
+        # UPDATE без изменений тоже оставил бы мертвую версию строки
+        empty = ' AND '.join(f"{connection.ops.quote_name(column)} IS NULL" for column in PROMOTED_FIELDS)
+        update_sql = (f"UPDATE {table} SET {', '.join(assignments)} "
+                      f"WHERE id >= %s AND id < %s AND {empty} AND event_data ?| %s")
+        fields = list(PROMOTED_FIELDS.values())
+
+        self.stdout.write(f"Backfilling ids {start_id}..{max_id} in batches of {batch_size}...")
+        started = last_report = time.monotonic()
+        updated = 0
+        lower = start_id
+        while lower <= max_id:
+            upper = lower + batch_size
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(update_sql, params + [lower, upper, fields])
+                    updated += cursor.rowcount
+            except Exception as e:
+                logger.exception("Ошибка заполнения колонок для id %s..%s: %s", lower, upper - 1, e)
+                raise CommandError(f"Backfill failed at id {lower}; rerun with --start-id {lower}: {e}")
+            lower = upper
+
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                done = min(lower, max_id + 1) - start_id
+                total = max_id + 1 - start_id
+                self.stdout.write(f"  next id {lower}: {done / total:.0%} of the id range, {updated} rows updated, "
+                                  f"{done / (now - started):,.0f} ids/s")
+            if pause:
+                time.sleep(pause)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} rows in {elapsed:.1f} s."))
+        logger.info("Колонки %s заполнены у %s строк за %.1f с", ', '.join(PROMOTED_FIELDS), updated, elapsed)
@@ -1,8 +1,11 @@
 
 import logging
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from django.utils import timezone
 from datetime import timedelta
+from deduplicator import partitions
 from deduplicator.models import UniqueEvent
 
 
@@ -12,7 +15,8 @@ logger = logging.getLogger(__name__)
 DAYS_TO_KEEP = 7
 
 class Command(BaseCommand):
-    help = f'Deletes unique events older than {DAYS_TO_KEEP} days from the database.'
+    help = (f'Deletes unique events older than {DAYS_TO_KEEP} days from the database. '
+            'On the partitioned table, drops whole daily partitions and creates upcoming ones.')
 
     def add_arguments(self, parser):
         # Добавляем опциональный аргумент, чтобы можно было запустить "вхолостую"
@@ -42,6 +46,10 @@ class Command(BaseCommand):
 
         self.stdout.write(f"Looking for events received before {formatted_cutoff_date} (older than {days_to_keep} days)...")
 
+        if partitions.is_partitioned():
+            self._cleanup_partitions(cutoff_date, dry_run)
+            return
+
         # Формируем запрос на удаление
         events_to_delete = UniqueEvent.objects.filter(received_at__lt=cutoff_date)
 
@@ -66,4 +74,49 @@ class Command(BaseCommand):
                 logger.info(f"Successfully deleted {deleted_count} events older than {formatted_cutoff_date}")
             except Exception as e:
                 logger.exception(f"An error occurred during event deletion: {e}")
-                raise CommandError(f"Failed to delete old events: {e}")
\ No newline at end of file
+                raise CommandError(f"Failed to delete old events: {e}")
+
+    def _cleanup_partitions(self, cutoff_date, dry_run):
+        """
+        Секционированная таблица: секции, целиком старше cutoff_date,
+        отсоединяются и удаляются (DROP TABLE вместо построчного DELETE).
+        Из секции по умолчанию старые строки удаляются обычным DELETE - там
+        только то, что не попало в дневные секции. Заодно создаются секции
+        на DEDUPLICATOR_PARTITION_DAYS_AHEAD дней вперед.
+        """
+        expired = partitions.expired_partitions(cutoff_date)
+        default_table = connection.ops.quote_name(partitions.DEFAULT_PARTITION)
+
+        if dry_run:
+            for name, _, upper in expired:
+                self.stdout.write(self.style.WARNING(f"DRY RUN: would drop partition {name} (rows before {upper:%Y-%m-%d})."))
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT count(*) FROM {default_table} WHERE received_at < %s", [cutoff_date])
+                stale = cursor.fetchone()[0]
+            self.stdout.write(self.style.WARNING(f"DRY RUN: would delete {stale} old events from the default partition."))
+            logger.warning("[Dry Run] Would drop %d partitions and delete %s rows from the default partition",
+                           len(expired), stale)
+            return
+
+        try:
+            created = partitions.ensure_partitions(settings.DEDUPLICATOR_PARTITION_DAYS_AHEAD)
+            if created:
+                self.stdout.write(f"Created {len(created)} partitions: {', '.join(created)}.")
+
+            dropped = partitions.drop_expired_partitions(cutoff_date)
+            with connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {default_table} WHERE received_at < %s", [cutoff_date])
+                stale = cursor.rowcount
+        except Exception as e:
+            logger.exception("An error occurred during partition cleanup: %s", e)
+            raise CommandError(f"Failed to drop old partitions: {e}")
+
+        if not dropped and not stale:
+            self.stdout.write(self.style.SUCCESS("No expired partitions or old events found."))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Dropped {len(dropped)} partitions{': ' + ', '.join(dropped) if dropped else ''}; "
+            f"deleted {stale} old events from the default partition."
+        ))
+        logger.info("Dropped %d partitions and %s default-partition rows older than %s",
+                    len(dropped), stale, cutoff_date)
@@ -0,0 +1,201 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from deduplicator import metrics
+from deduplicator.eventlog import event_log
+from deduplicator.writer import write_unique_events
+
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повтором записи пачки, если БД недоступна
+DB_RETRY_SECONDS = 2.0
+
+
+class Command(BaseCommand):
+    help = ('Reads events from the Redis Stream (DEDUPLICATOR_TRANSPORT=stream) with a consumer group, '
+            'deduplicates them in batches, bulk-inserts unique events and acknowledges the batch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--consumer',
+            default=f"{socket.gethostname()}-{os.getpid()}",
+            help='Consumer name inside the group (default: <hostname>-<pid>).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.DEDUPLICATOR_STREAM_BATCH_SIZE,
+            help=f'Entries read per XREADGROUP call (default: {settings.DEDUPLICATOR_STREAM_BATCH_SIZE}).',
+        )
+        parser.add_argument(
+            '--block-ms',
+            type=int,
+            default=settings.DEDUPLICATOR_STREAM_BLOCK_MS,
+            help=f'How long to wait for new entries, ms (default: {settings.DEDUPLICATOR_STREAM_BLOCK_MS}).',
+        )
+        parser.add_argument(
+            '--claim-idle-ms',
+            type=int,
+            default=settings.DEDUPLICATOR_STREAM_CLAIM_IDLE_MS,
+            help='Reclaim entries left unacknowledged by other consumers for this long, ms '
+                 f'(default: {settings.DEDUPLICATOR_STREAM_CLAIM_IDLE_MS}).',
+        )
+        parser.add_argument(
+            '--exit-when-empty',
+            action='store_true',
+            help='Stop once the stream has no new or reclaimable entries (drain mode).',
+        )
+
+    def handle(self, *args, **options):
+        self.deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+        self.stream = settings.EVENT_STREAM_INSTANCE
+        if self.deduplicator is None or self.stream is None:
+            raise CommandError("Event deduplicator or Redis Stream is not configured.")
+
+        consumer = options['consumer']
+        batch_size = options['batch_size']
+        block_ms = options['block_ms']
+        claim_idle_ms = options['claim_idle_ms']
+        if batch_size < 1 or block_ms < 0 or claim_idle_ms < 1:
+            raise CommandError("--batch-size and --claim-idle-ms must be positive, --block-ms must not be negative.")
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        self.stream.ensure_group()
+        self.stdout.write(f"Consumer {consumer} reading {self.stream.key} as group {self.stream.group}...")
+
+        processed = unique = 0
+        started = time.monotonic()
+        next_claim_at = 0.0
+        while not self.stopping:
+            try:
+                entries, redelivered = [], False
+                if time.monotonic() >= next_claim_at:
+                    # Записи упавших потребителей: прочитаны, но не подтверждены
+                    entries = self.stream.claim_stale(consumer, claim_idle_ms, batch_size)
+                    redelivered = bool(entries)
+                    if not entries:
+                        next_claim_at = time.monotonic() + claim_idle_ms / 1000
+                if not entries:
+                    entries = self.stream.read(consumer, batch_size, block_ms)
+            except redis.RedisError as e:
+                logger.error("Ошибка Redis при чтении потока %s: %s", self.stream.key, e)
+                time.sleep(1)
+                continue
+
+            if not entries:
+                if options['exit_when_empty']:
+                    break
+                continue
+
+            if not redelivered:
+                # id записи потока - момент XADD в миллисекундах
+                now = time.time()
+                for entry_id, _, _ in entries:
+                    metrics.QUEUE_LAG_SECONDS.observe(max(0.0, now - int(entry_id.split('-', 1)[0]) / 1000), 'stream')
+
+            close_old_connections()
+            written = self._process(entries, redelivered)
+            if written is None:
+                # Остановка во время ожидания БД: записи остаются неподтвержденными
+                break
+            processed += len(entries)
+            unique += written
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Consumer {consumer} stopped: {processed} entries processed, {unique} unique events written "
+            f"in {elapsed:.1f}s."
+        ))
+
+    def _request_stop(self, signum, frame):
+        logger.info("Получен сигнал %s, потребитель остановится после текущей пачки.", signum)
+        self.stopping = True
+
+    def _process(self, entries, redelivered):
+        """
+        Дедуплицирует пачку записей, пишет уникальные события в БД и
+        подтверждает пачку. Возвращает количество записанных событий или
+        None, если пачка осталась неподтвержденной.
+
+        Отпечаток попадает в Redis до записи в БД. Если потребитель упал
+        между этими шагами, при повторной доставке (redelivered) Redis уже
+        считает событие дублем, поэтому такие записи пишутся в БД в любом
+        случае, но с проверкой отпечатков, уже сохраненных в окне
+        дедупликации (recheck в writer.save_unique_events).
+        Записи с отпечатком уже проверены при приеме и только сохраняются.
+        """
+        # События с отпечатком уже проверены при приеме (DEDUPLICATOR_INGEST_DEDUP)
+        checked = [(fingerprint, event_data) for _, event_data, fingerprint in entries
+                   if event_data is not None and fingerprint]
+        unchecked = [event_data for _, event_data, fingerprint in entries
+                     if event_data is not None and not fingerprint]
+        results = self._check(unchecked) if unchecked else []
+        if results is None:
+            return None
+
+        rows, seen = [], set()
+        for fingerprint, event_data in checked:
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                rows.append((fingerprint, event_data))
+        for event_data, (is_duplicate, fingerprint) in zip(unchecked, results):
+            if fingerprint is None or fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            if is_duplicate and not redelivered:
+                continue
+            rows.append((fingerprint, event_data))
+
+        written, recheck = 0, redelivered
+        while rows:
+            count, rows = write_unique_events(rows, recheck)
+            written += count
+            if rows:
+                # Сбой мог случиться после COMMIT
+                recheck = True
+                # БД недоступна: пачку нельзя подтверждать, ждем и повторяем хвост
+                if self.stopping:
+                    return None
+                time.sleep(DB_RETRY_SECONDS)
+
+        try:
+            self.stream.ack([entry_id for entry_id, _, _ in entries])
+        except redis.RedisError as e:
+            # Записи будут доставлены повторно и записаны идемпотентно
+            logger.error("Ошибка Redis при подтверждении %d записей: %s", len(entries), e)
+
+        event_log.count('stream.entries', len(entries))
+        event_log.event(logger, logging.INFO, "Пачка из %d записей обработана: записано %d уникальных событий%s.",
+                        len(entries), written, ' (повторная доставка)' if redelivered else '')
+        return written
+
+    def _check(self, events):
+        """
+        check_duplication_many с учетом DEDUPLICATOR_DEGRADED_MODE. В режиме
+        'retry' при недоступном Redis ждет его восстановления, не подтверждая
+        пачку; None - остановка во время ожидания.
+        """
+        if settings.DEDUPLICATOR_DEGRADED_MODE != 'retry':
+            return self.deduplicator.check_duplication_many(events)
+        while True:
+            try:
+                return self.deduplicator.check_duplication_many(events, fail_open=False)
+            except redis.RedisError as e:
+                if self.stopping:
+                    return None
+                delay = self.deduplicator.redis_retry_after(DB_RETRY_SECONDS)
+                logger.warning("Redis недоступен, проверка пачки из %d событий повторится через %.1f с: %s",
+                               len(events), delay, e)
+                time.sleep(delay)
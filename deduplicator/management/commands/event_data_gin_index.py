@@ -0,0 +1,50 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from deduplicator import partitions
+from deduplicator.models import UniqueEvent
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'uniqueevent_event_data_gin'
+# jsonb_path_ops: индекс меньше и быстрее jsonb_ops, но обслуживает только @> (фильтр contains в API)
+INDEX_DEFINITION = 'USING gin (event_data jsonb_path_ops)'
+
+
+class Command(BaseCommand):
+    help = (f'Creates (or with --drop removes) the GIN index {INDEX_NAME} on event_data, used by the '
+            'contains filter of /api/v1/events/. Built partition by partition without blocking writes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            help='Drop the index instead of creating it.',
+        )
+
+    def handle(self, *args, **options):
+        table = connection.ops.quote_name(UniqueEvent._meta.db_table)
+        try:
+            if options['drop']:
+                partitions.drop_partitioned_index(INDEX_NAME)
+                self.stdout.write(self.style.SUCCESS(f"Dropped index {INDEX_NAME}."))
+                return
+
+            if not partitions.is_partitioned():
+                with connection.cursor() as cursor:
+                    cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{INDEX_NAME}" ON {table} {INDEX_DEFINITION}')
+                self.stdout.write(self.style.SUCCESS(f"Index {INDEX_NAME} is in place."))
+                return
+
+            # Повторный запуск (например, после прерывания) досоздает индексы недостающих секций
+            created = partitions.create_partitioned_index(INDEX_NAME, INDEX_DEFINITION)
+        except Exception as e:
+            logger.exception("Ошибка при работе с индексом %s: %s", INDEX_NAME, e)
+            raise CommandError(f"Failed to manage index {INDEX_NAME}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Index {INDEX_NAME} is in place; built {len(created)} partition indexes."
+        ))
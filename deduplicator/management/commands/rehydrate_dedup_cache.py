@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from deduplicator.models import UniqueEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the Redis dedup state from UniqueEvent rows received within the dedup window, '
+            'with each fingerprint expiring as if it had been written when the event was received.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10_000,
+            help='Rows fetched from PostgreSQL and written to Redis per pipeline (default: 10000).',
+        )
+        parser.add_argument(
+            '--checkpoint-file',
+            default='rehydrate_dedup_cache.checkpoint.json',
+            help='Progress file used to resume an interrupted run (removed on success).',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and start from the beginning of the window.',
+        )
+
+    def handle(self, *args, **options):
+        deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+        if deduplicator is None:
+            raise CommandError("Event deduplicator is not configured.")
+        policies = deduplicator.policies
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+
+        checkpoint_file = options['checkpoint_file']
+        checkpoint = None if options['restart'] else self._load_checkpoint(checkpoint_file)
+        if checkpoint:
+            # Окно то же, что у прерванного запуска: иначе пропустим строки между запусками
+            window_start = datetime.fromisoformat(checkpoint['window_start'])
+            last_id, restored, scanned = checkpoint['last_id'], checkpoint['restored'], checkpoint['scanned']
+            self.stdout.write(f"Resuming from id > {last_id} ({scanned} rows already scanned).")
+        else:
+            # Окно - по самой долгой политике; отпечатки с истекшим TTL своей политики restore_many пропустит
+            window_start = timezone.now() - timedelta(seconds=policies.max_ttl)
+            last_id, restored, scanned = 0, 0, 0
+
+        storages = ', '.join(f"{policy.name}: {type(policy.storage).__name__}" for policy in policies)
+        self.stdout.write(f"Restoring fingerprints of events received since {window_start:%Y-%m-%d %H:%M:%S %Z} "
+                          f"into {storages}...")
+
+        # Поле выбора политики читается из event_data, только если политик больше одной
+        table = connection.ops.quote_name(UniqueEvent._meta.db_table)
+        policy_column = "event_data ->> %s" if len(policies) > 1 else "NULL"
+        select_params = [policies.field] if len(policies) > 1 else []
+        if deduplicator.duplicate_hits is not None and deduplicator.duplicate_hits.sliding:
+            # Скользящее окно отсчитывается от последнего повтора (last_seen_at отстает от
+            # Redis на период переноса flush_duplicate_hits); старые секции тоже просматриваются
+            select_sql = (f"SELECT id, fingerprint, GREATEST(received_at, last_seen_at), {policy_column} FROM {table} "
+                          f"WHERE id > %s AND (received_at >= %s OR last_seen_at >= %s) ORDER BY id LIMIT %s")
+            window_params = [window_start, window_start]
+        else:
+            select_sql = (f"SELECT id, fingerprint, received_at, {policy_column} FROM {table} "
+                          f"WHERE id > %s AND received_at >= %s ORDER BY id LIMIT %s")
+            window_params = [window_start]
+
+        started = time.monotonic()
+        run_rows = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(select_sql, select_params + [last_id, *window_params, batch_size])
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            # хранилище политики -> пары (отпечаток, момент получения или последнего повтора)
+            groups = defaultdict(list)
+            for _, fingerprint, seen_at, policy_value in rows:
+                policy = policies.resolve({policies.field: policy_value})
+                groups[policy.storage].append((fingerprint, seen_at.timestamp()))
+            try:
+                for storage, items in groups.items():
+                    restored += storage.restore_many(items)
+            except redis.RedisError as e:
+                logger.error("Ошибка Redis при восстановлении отпечатков после id %s: %s", last_id, e)
+                raise CommandError(f"Redis error, progress saved to {checkpoint_file}: {e}")
+
+            last_id = rows[-1][0]
+            scanned += len(rows)
+            run_rows += len(rows)
+            self._save_checkpoint(checkpoint_file, {
+                'window_start': window_start.isoformat(),
+                'last_id': last_id,
+                'scanned': scanned,
+                'restored': restored,
+            })
+            if run_rows % (batch_size * 10) == 0:
+                elapsed = time.monotonic() - started
+                self.stdout.write(f"  {scanned} rows scanned, {restored} fingerprints restored, "
+                                  f"{run_rows / elapsed:,.0f} rows/s")
+
+        elapsed = time.monotonic() - started
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        self.stdout.write(self.style.SUCCESS(
+            f"Restored {restored} fingerprints from {scanned} rows in {elapsed:.1f}s "
+            f"({run_rows / elapsed if elapsed else 0:,.0f} rows/s)."
+        ))
+        logger.info("Восстановлено %s отпечатков из %s строк за %.1fс", restored, scanned, elapsed)
+
+    def _load_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read checkpoint {path}: {e}. Use --restart to start over.")
+
+    def _save_checkpoint(self, path, state):
+        # Через временный файл: прерывание посреди записи не портит checkpoint
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,302 @@
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from deduplicator import metrics
+from deduplicator.serialization import EventJSON, loads
+from deduplicator.writer import write_unique_events
+
+
+logger = logging.getLogger(__name__)
+
+# Как часто выводить прогресс, секунд
+REPORT_INTERVAL = 10
+# Сколько байт читается за раз при пропуске уже обработанной части потока без seek (stdin)
+SKIP_CHUNK_BYTES = 1 << 20
+
+
+def _init_worker():
+    # Ctrl+C получает вся группа процессов: останавливается только главный, дочерние дорабатывают пачки
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Дочерние процессы multiprocessing завершаются без atexit, но с финализаторами
+    Finalize(None, _finish_worker, exitpriority=10)
+
+
+def _finish_worker():
+    deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+    if deduplicator is not None and deduplicator.duplicate_hits is not None:
+        deduplicator.duplicate_hits.flush()
+    if metrics.flusher is not None:
+        metrics.flusher.stop()
+    connections.close_all()
+
+
+def _replay_chunk(lines, replayed):
+    """
+    Разбирает строки JSONL, дедуплицирует события одним пакетом и пишет
+    уникальные в БД. Возвращает (событий, отправлено строк в БД - включая
+    конфликты, дублей, невалидных строк, незаписанных из-за недоступной
+    БД). Пустые строки не считаются.
+
+    replayed - пачка могла быть обработана до прерванного запуска: ее
+    отпечатки, возможно, уже в Redis, а строки - нет. Такие события пишутся
+    в БД, даже если Redis считает их дублями, как при повторной доставке в
+    consume_events, - с проверкой отпечатков, уже сохраненных в окне
+    дедупликации (recheck в writer.save_unique_events).
+    """
+    events, invalid = [], 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            text = line.decode('utf-8')
+            event_data = loads(text)
+        except ValueError:
+            invalid += 1
+            continue
+        if not isinstance(event_data, dict):
+            invalid += 1
+            continue
+        # Текст строки пишется в БД как есть, без повторной сериализации
+        events.append(EventJSON(event_data, text))
+    total = len(events) + invalid
+
+    results = settings.EVENT_DEDUPLICATOR_INSTANCE.check_duplication_many(events, fail_open=False)
+    rows, seen, duplicates = [], set(), 0
+    for event_data, (is_duplicate, fingerprint) in zip(events, results):
+        if fingerprint is None:
+            invalid += 1
+            continue
+        if fingerprint in seen or (is_duplicate and not replayed):
+            duplicates += 1
+            continue
+        seen.add(fingerprint)
+        rows.append((fingerprint, event_data))
+
+    written, failed = write_unique_events(rows, recheck=replayed)
+    return total, written, duplicates, invalid, len(failed)
+
+
+def _completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class Command(BaseCommand):
+    help = ('Streams historical events from JSONL files (plain or gzip, "-" for stdin) through the deduplicator '
+            'into UniqueEvent, bypassing HTTP and Celery. Lines are processed in batches by a pool of worker '
+            'processes; progress is checkpointed so an interrupted run can be resumed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            default=['-'],
+            help='JSONL files, one event object per line; gzip is detected by content (default: stdin).',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Worker processes (default: number of CPUs). 0 processes batches in the command itself.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Lines per batch: one Redis pipeline and one INSERT (default: 5000).',
+        )
+        parser.add_argument(
+            '--max-pending',
+            type=int,
+            default=None,
+            help='Batches read ahead of the slowest one; bounds memory (default: 2 per worker).',
+        )
+        parser.add_argument(
+            '--checkpoint-file',
+            default='replay_events.checkpoint.json',
+            help='Progress file used to resume an interrupted run (removed on success).',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and start from the beginning of every input.',
+        )
+
+    def handle(self, *args, **options):
+        if settings.EVENT_DEDUPLICATOR_INSTANCE is None:
+            raise CommandError("Event deduplicator is not configured.")
+        workers, batch_size = options['workers'], options['batch_size']
+        if workers < 0 or batch_size < 1:
+            raise CommandError("--workers cannot be negative, --batch-size must be a positive integer.")
+        max_pending = options['max_pending'] or 2 * max(workers, 1)
+        if max_pending < 1:
+            raise CommandError("--max-pending must be a positive integer.")
+        paths = [path if path == '-' else os.path.abspath(path) for path in options['paths']]
+        if paths.count('-') > 1:
+            raise CommandError("stdin can be given only once.")
+
+        self.checkpoint_file = options['checkpoint_file']
+        checkpoint = None if options['restart'] else self._load_checkpoint(self.checkpoint_file)
+        # путь -> {'offset': обработано байт, 'horizon': прочитано байт, 'eof': размер, когда дочитан}
+        self.inputs = checkpoint['inputs'] if checkpoint else {}
+        self.totals = checkpoint['totals'] if checkpoint else dict.fromkeys(('events', 'unique', 'duplicates', 'invalid'), 0)
+        if checkpoint:
+            self.stdout.write(f"Resuming: {self.totals['events']} events already processed.")
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        # Соединения родителя не должны достаться дочерним процессам
+        connections.close_all()
+        executor = None
+        if workers:
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                           initializer=_init_worker)
+        self.pending = deque()
+        self.started = self.last_report = time.monotonic()
+        self.run_events = 0
+        self.stdout.write(f"Replaying {len(paths)} input(s) with {workers or 'no'} worker process(es), "
+                          f"batches of {batch_size} lines...")
+        try:
+            for path in paths:
+                if self.stopping:
+                    break
+                self._replay(path, executor, batch_size, max_pending)
+            while self.pending:
+                self._complete()
+        except (redis.RedisError, OSError, EOFError, BrokenProcessPool) as e:
+            logger.error("Воспроизведение событий прервано: %s", e)
+            raise CommandError(f"Replay failed, progress saved to {self.checkpoint_file}: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        elapsed = time.monotonic() - self.started
+        summary = (f"{self.totals['events']} events: {self.totals['unique']} unique written, "
+                   f"{self.totals['duplicates']} duplicates, {self.totals['invalid']} invalid lines; "
+                   f"{self.run_events / elapsed if elapsed else 0:,.0f} events/s in this run ({elapsed:.1f}s).")
+        if self.stopping:
+            self.stdout.write(self.style.WARNING(f"Stopped, progress saved to {self.checkpoint_file}. {summary}"))
+            return
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        self.stdout.write(self.style.SUCCESS(f"Replay finished. {summary}"))
+        logger.info("Воспроизведено %s событий, записано %s уникальных за %.1fс",
+                    self.totals['events'], self.totals['unique'], elapsed)
+
+    def _request_stop(self, signum, frame):
+        logger.info("Получен сигнал %s, воспроизведение остановится после отправленных пачек.", signum)
+        self.stopping = True
+
+    def _replay(self, path, executor, batch_size, max_pending):
+        progress = self.inputs.setdefault(path, {'offset': 0, 'horizon': 0})
+        if progress.get('eof') is not None and progress['offset'] >= progress['eof']:
+            self.stdout.write(f"  {path}: already replayed, skipped.")
+            return
+        # Пачки после offset могли быть отправлены прерванным запуском (до horizon)
+        horizon = progress['horizon']
+        progress.pop('eof', None)
+        raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        try:
+            stream = gzip.GzipFile(fileobj=raw, mode='rb') if raw.peek(2)[:2] == b'\x1f\x8b' else raw
+            self._skip(stream, progress['offset'], seekable=path != '-')
+            offset = progress['offset']
+            for lines, end in self._batches(stream, offset, batch_size):
+                while len(self.pending) >= max_pending:
+                    self._complete()
+                replayed = offset < horizon
+                # Граница отправленного пишется до отправки: после падения пачки до нее - replayed
+                progress['horizon'] = max(progress['horizon'], end)
+                self._save_checkpoint()
+                future = (executor.submit(_replay_chunk, lines, replayed) if executor is not None
+                          else _completed(_replay_chunk(lines, replayed)))
+                self.pending.append((path, end, future))
+                offset = end
+                if self.stopping:
+                    return
+            progress['eof'] = offset
+            self._save_checkpoint()
+        finally:
+            if raw is not sys.stdin.buffer:
+                raw.close()
+
+    def _skip(self, stream, offset, seekable):
+        """Пропускает уже обработанные offset байт (для gzip - распакованных)."""
+        if not offset:
+            return
+        if seekable:
+            stream.seek(offset)
+            return
+        remaining = offset
+        while remaining:
+            skipped = len(stream.read(min(remaining, SKIP_CHUNK_BYTES)))
+            if not skipped:
+                raise CommandError(f"Input is shorter than the checkpoint offset {offset}; use --restart.")
+            remaining -= skipped
+
+    @staticmethod
+    def _batches(stream, offset, batch_size):
+        """Пачки по batch_size строк и смещение после каждой."""
+        lines = []
+        for line in stream:
+            offset += len(line)
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield lines, offset
+                lines = []
+        if lines:
+            yield lines, offset
+
+    def _complete(self):
+        """Ждет самую старую отправленную пачку и сдвигает checkpoint ее входа."""
+        path, end, future = self.pending.popleft()
+        events, unique, duplicates, invalid, failed = future.result()
+        if failed:
+            raise CommandError(f"Database unavailable, {failed} events not written; "
+                               f"progress saved to {self.checkpoint_file}, rerun to resume.")
+        self.inputs[path]['offset'] = end
+        for name, value in (('events', events), ('unique', unique), ('duplicates', duplicates), ('invalid', invalid)):
+            self.totals[name] += value
+        self.run_events += events
+        self._save_checkpoint()
+
+        now = time.monotonic()
+        if now - self.last_report >= REPORT_INTERVAL:
+            self.last_report = now
+            self.stdout.write(f"  {self.totals['events']} events, {self.totals['unique']} unique, "
+                              f"{self.totals['duplicates']} duplicates, {self.totals['invalid']} invalid, "
+                              f"{self.run_events / (now - self.started):,.0f} events/s")
+
+    def _load_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read checkpoint {path}: {e}. Use --restart to start over.")
+
+    def _save_checkpoint(self):
+        # Через временный файл: прерывание посреди записи не портит checkpoint
+        tmp_path = f"{self.checkpoint_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'inputs': self.inputs, 'totals': self.totals}, f)
+        os.replace(tmp_path, self.checkpoint_file)
@@ -0,0 +1,299 @@
+
+import atexit
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Разделитель частей поля в хэше Redis: <метрика>|<значение метки>|<суффикс>
+_SEP = '|'
+
+
+class Metric:
+    """
+    Метрика процесса. Значения - приращения с последнего сброса в Redis:
+    каждый процесс (API, воркер Celery, consume_events) копит свои, а
+    MetricsFlusher периодически складывает их в общий хэш Redis
+    (HINCRBYFLOAT), так что /metrics видит сумму по всем процессам.
+    """
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._lock = threading.Lock()
+
+    def drain(self) -> Dict[str, float]:
+        """Забирает накопленные приращения: поле хэша -> приращение."""
+        raise NotImplementedError
+
+    def field(self, label_value: Optional[str], suffix: str = '') -> str:
+        return f"{self.name}{_SEP}{label_value or ''}{_SEP}{suffix}"
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None):
+        super().__init__(name, documentation, label)
+        self._values: Dict[Optional[str], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, label_value: Optional[str] = None) -> None:
+        with self._lock:
+            self._values[label_value] += amount
+
+    def drain(self) -> Dict[str, float]:
+        with self._lock:
+            values, self._values = self._values, defaultdict(float)
+        return {self.field(label_value): value for label_value, value in values.items() if value}
+
+
+class Histogram(Metric):
+    """
+    Гистограмма с фиксированными корзинами. observe - bisect по границам
+    и два сложения под блокировкой, без выделения памяти на событие.
+    Корзины хранятся не накопленными: так их можно складывать между
+    процессами, накопленные счетчики le считаются при выдаче /metrics.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None,
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label)
+        self.buckets = tuple(sorted(buckets))
+        # метка -> (счетчики корзин, последняя - +Inf; сумма наблюдений)
+        self._values: Dict[Optional[str], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label_value: Optional[str] = None) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(label_value) or self._new(label_value)
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, label_value: Optional[str] = None) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, label_value)
+
+    def drain(self) -> Dict[str, float]:
+        with self._lock:
+            values, self._values = self._values, {}
+        deltas = {}
+        for label_value, (counts, total) in values.items():
+            for index, count in enumerate(counts):
+                if count:
+                    deltas[self.field(label_value, str(index))] = count
+            deltas[self.field(label_value, 'sum')] = total[0]
+        return deltas
+
+    def _new(self, label_value: Optional[str]) -> Tuple[List[int], List[float]]:
+        value = ([0] * (len(self.buckets) + 1), [0.0])
+        self._values[label_value] = value
+        return value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, documentation: str, label: Optional[str] = None) -> Counter:
+        return self._register(Counter(name, documentation, label))
+
+    def histogram(self, name: str, documentation: str, label: Optional[str] = None,
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label, buckets))
+
+    def drain(self) -> Dict[str, float]:
+        deltas = {}
+        for metric in self.metrics.values():
+            deltas.update(metric.drain())
+        return deltas
+
+    def render(self, totals: Dict[str, float]) -> str:
+        """
+        Prometheus text format (0.0.4) по суммам из хэша Redis
+        (поле -> значение, как их пишет MetricsFlusher).
+        """
+        # метрика -> значение метки -> суффикс -> значение
+        samples: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(lambda: defaultdict(dict))
+        for field, value in totals.items():
+            name, _, rest = field.partition(_SEP)
+            label_value, _, suffix = rest.partition(_SEP)
+            if name in self.metrics:
+                samples[name][label_value][suffix] = float(value)
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for label_value, values in sorted(samples[name].items()):
+                labels = [f'{metric.label}="{_escape(label_value)}"'] if metric.label else []
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    bounds = [_format_number(bound) for bound in metric.buckets] + ['+Inf']
+                    for index, bound in enumerate(bounds):
+                        cumulative += values.get(str(index), 0)
+                        bucket_labels = _labels(labels + [f'le="{bound}"'])
+                        lines.append(f"{name}_bucket{bucket_labels} {_format_number(cumulative)}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_format_number(values.get('sum', 0))}")
+                    lines.append(f"{name}_count{_labels(labels)} {_format_number(cumulative)}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {_format_number(values.get('', 0))}")
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+        return metric
+
+
+def _labels(labels: List[str]) -> str:
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsFlusher:
+    """
+    Фоновый поток процесса: раз в interval секунд складывает приращения
+    всех метрик реестра в хэш Redis одним pipeline (HINCRBYFLOAT). Если
+    Redis недоступен, приращения не теряются, а копятся до следующей попытки.
+    """
+
+    def __init__(self, registry: MetricsRegistry, redis_client: redis.Redis, key: str, interval: float):
+        if interval <= 0:
+            raise ValueError("interval должен быть положительным числом")
+        self.registry = registry
+        self.redis = redis_client
+        self.key = key
+        self.interval = interval
+        self._unsent: Dict[str, float] = defaultdict(float)
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-flusher", daemon=True)
+        self._thread.start()
+
+    def restart_after_fork(self) -> None:
+        # Потоки не переживают fork; приращения родителя в дочернем процессе не нужны
+        self._thread = None
+        self._flush_lock = threading.Lock()
+        self._unsent = defaultdict(float)
+        self.registry.drain()
+        self.start()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            for field, delta in self.registry.drain().items():
+                self._unsent[field] += delta
+            if not self._unsent:
+                return
+            pipe = self.redis.pipeline(transaction=False)
+            for field, delta in self._unsent.items():
+                pipe.hincrbyfloat(self.key, field, delta)
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning("Не удалось сбросить метрики в Redis (%d полей), повторим позже: %s",
+                               len(self._unsent), e)
+                return
+            self._unsent = defaultdict(float)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Ошибка фонового сброса метрик: %s", e)
+
+
+def read_totals(redis_client: redis.Redis, key: str) -> Dict[str, float]:
+    return {field: float(value) for field, value in redis_client.hgetall(key).items()}
+
+
+registry = MetricsRegistry()
+
+# --- Метрики конвейера. Доля дублей: rate(dedup_events_checked_total{result="duplicate"}) / rate(сумма по result) ---
+EVENTS_RECEIVED = registry.counter(
+    'dedup_events_received_total', 'Events received by the API, by outcome.', 'status')
+ENQUEUE_SECONDS = registry.histogram(
+    'dedup_enqueue_seconds', 'Time the API spends handing a request or batch chunk to the transport.', 'transport')
+FINGERPRINT_SECONDS = registry.histogram(
+    'dedup_fingerprint_seconds', 'Time spent computing fingerprints per call (one event or one batch).')
+REDIS_CHECK_SECONDS = registry.histogram(
+    'dedup_redis_check_seconds', 'Latency of Redis dedup calls (one event or one pipelined batch).')
+REDIS_ERRORS = registry.counter(
+    'dedup_redis_errors_total', 'Failed Redis dedup calls, by kind (circuit_open: rejected by the breaker).', 'kind')
+EVENTS_CHECKED = registry.counter(
+    'dedup_events_checked_total', 'Events checked for duplicates, by result.', 'result')
+L1_CACHE_HITS = registry.counter(
+    'dedup_l1_cache_hits_total', 'Fingerprints found in the in-process L1 cache (duplicates answered without Redis).')
+L1_CACHE_MISSES = registry.counter(
+    'dedup_l1_cache_misses_total', 'Fingerprints not found in the in-process L1 cache.')
+L1_CACHE_EVICTIONS = registry.counter(
+    'dedup_l1_cache_evictions_total', 'Fingerprints evicted from the full in-process L1 cache (LRU).')
+DB_WRITE_SECONDS = registry.histogram(
+    'dedup_db_write_seconds', 'Latency of bulk inserts of unique events.')
+DB_ROWS_WRITTEN = registry.counter(
+    'dedup_db_rows_written_total', 'Unique event rows sent to PostgreSQL (conflicts included).')
+ADMISSION_SHED = registry.counter(
+    'dedup_admission_shed_total', 'Events refused by admission control, by reason (queue_full: 503, rate_limit: 429).',
+    'reason')
+DUPLICATE_HITS_SAVED = registry.counter(
+    'dedup_duplicate_hits_saved_total',
+    'Duplicate hits moved from Redis to UniqueEvent.duplicate_count, by outcome '
+    '(dropped: no stored event within the grace period).', 'outcome')
+QUEUE_LAG_SECONDS = registry.histogram(
+    'dedup_queue_lag_seconds', 'Time from enqueue by the API to the start of processing.', 'transport',
+    buckets=LAG_BUCKETS)
+
+flusher: Optional[MetricsFlusher] = None
+
+
+def start_flusher(redis_client: redis.Redis, key: str, interval: float) -> MetricsFlusher:
+    """Запускает сброс метрик процесса в Redis (один раз на процесс, в т.ч. после fork)."""
+    global flusher
+    if flusher is None:
+        flusher = MetricsFlusher(registry, redis_client, key, interval)
+        os.register_at_fork(after_in_child=flusher.restart_after_fork)
+        atexit.register(flusher.stop)
+    flusher.start()
+    return flusher
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deduplicator', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uniqueevent',
+            name='fingerprint',
+            field=models.CharField(db_index=True, help_text="Fingerprint of the unique event's key fields (hex digest with optional version tag).", max_length=80, unique=True),
+        ),
+    ]
@@ -0,0 +1,93 @@
+"""
+Переводит UniqueEvent на таблицу, секционированную по дням (RANGE по received_at).
+
+Существующая таблица не копируется: она переименовывается в
+deduplicator_uniqueevent_legacy и присоединяется к новой родительской таблице
+секцией от MINVALUE до полуночи UTC следующего дня. Новые строки идут в дневные
+секции (deduplicator/partitions.py), а legacy удаляется целиком, когда все ее
+строки станут старше срока хранения (cleanup_old_events).
+
+Ограничения секционированной таблицы:
+  * первичный ключ - (id, received_at); id по-прежнему уникален (общая последовательность);
+  * уникальность fingerprint проверяется внутри секции (сутки), а не по всей
+    таблице. Основная дедупликация - в Redis; индекс лишь страхует от повторной
+    вставки при повторной доставке события.
+
+Новый первичный ключ legacy-таблицы строится заново, а ATTACH PARTITION
+проверяет все ее строки, поэтому на большой таблице миграцию лучше запускать
+при низкой нагрузке.
+
+Миграция необратима, и пути отката нет: до нее fingerprint уникален во всей
+таблице, после - только в пределах суток, и строки с одним отпечатком из
+разных секций в прежнюю схему не помещаются. Откатиться можно только из
+резервной копии, снятой перед миграцией.
+"""
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_partitions(apps, schema_editor):
+    from deduplicator.partitions import ensure_partitions
+
+    ensure_partitions(settings.DEDUPLICATOR_PARTITION_DAYS_AHEAD)
+
+
+PARTITION_SQL = """
+ALTER TABLE deduplicator_uniqueevent RENAME TO deduplicator_uniqueevent_legacy;
+-- Первичный ключ секции должен совпадать с ключом родителя: (id, received_at)
+ALTER TABLE deduplicator_uniqueevent_legacy
+    DROP CONSTRAINT deduplicator_uniqueevent_pkey,
+    ADD CONSTRAINT deduplicator_uniqueevent_legacy_pkey PRIMARY KEY (id, received_at);
+ALTER TABLE deduplicator_uniqueevent_legacy RENAME CONSTRAINT deduplicator_uniqueevent_fingerprint_key TO deduplicator_uniqueevent_legacy_fingerprint_key;
+ALTER TABLE deduplicator_uniqueevent_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+ALTER TABLE deduplicator_uniqueevent_legacy ALTER COLUMN id DROP DEFAULT;
+
+CREATE SEQUENCE deduplicator_uniqueevent_id_seq;
+SELECT setval('deduplicator_uniqueevent_id_seq', COALESCE((SELECT max(id) FROM deduplicator_uniqueevent_legacy), 0) + 1, false);
+
+CREATE TABLE deduplicator_uniqueevent (
+    id bigint NOT NULL DEFAULT nextval('deduplicator_uniqueevent_id_seq'),
+    fingerprint varchar(80) NOT NULL,
+    event_data jsonb NOT NULL,
+    received_at timestamp with time zone NOT NULL,
+    CONSTRAINT deduplicator_uniqueevent_pkey PRIMARY KEY (id, received_at)
+) PARTITION BY RANGE (received_at);
+ALTER SEQUENCE deduplicator_uniqueevent_id_seq OWNED BY deduplicator_uniqueevent.id;
+CREATE INDEX deduplicator_uniqueevent_received_at_idx ON deduplicator_uniqueevent (received_at);
+
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE deduplicator_uniqueevent ATTACH PARTITION deduplicator_uniqueevent_legacy '
+        'FOR VALUES FROM (MINVALUE) TO (%L)',
+        (date_trunc('day', now() AT TIME ZONE 'UTC') + interval '1 day') AT TIME ZONE 'UTC'
+    );
+END $$;
+
+CREATE TABLE deduplicator_uniqueevent_default PARTITION OF deduplicator_uniqueevent DEFAULT;
+CREATE UNIQUE INDEX deduplicator_uniqueevent_default_fingerprint_key ON deduplicator_uniqueevent_default (fingerprint);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deduplicator', '0002_fingerprint_max_length'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(PARTITION_SQL),
+                migrations.RunPython(create_partitions),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='uniqueevent',
+                    name='fingerprint',
+                    field=models.CharField(db_index=True, help_text="Fingerprint of the unique event's key fields (hex digest with optional version tag). Unique within a daily partition.", max_length=80),
+                ),
+            ],
+        ),
+    ]
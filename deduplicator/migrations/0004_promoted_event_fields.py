@@ -0,0 +1,82 @@
+"""
+Колонки event_name, user_id и client_id (копии полей event_data, заполняются
+при записи) и индексы (колонка, received_at, id) под API /api/v1/events/.
+
+Колонки добавляются без значения по умолчанию - это изменение метаданных,
+существующие строки не переписываются; у них колонки пустые, пока не
+отработает команда backfill_event_fields.
+
+Индексы строятся посекционно через CREATE INDEX CONCURRENTLY
+(см. partitions.create_partitioned_index): запись в таблицу во время
+построения не блокируется, поэтому миграция не атомарная.
+"""
+
+from django.db import migrations, models
+
+
+KEYSET_INDEXES = {
+    'uniqueevent_event_name_keyset': '(event_name, received_at, id)',
+    'uniqueevent_user_id_keyset': '(user_id, received_at, id)',
+    'uniqueevent_client_id_keyset': '(client_id, received_at, id)',
+}
+
+
+def create_indexes(apps, schema_editor):
+    from deduplicator.partitions import create_partitioned_index, is_partitioned
+
+    for name, definition in KEYSET_INDEXES.items():
+        if is_partitioned():
+            create_partitioned_index(name, definition)
+        else:
+            schema_editor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "deduplicator_uniqueevent" {definition}')
+
+
+def drop_indexes(apps, schema_editor):
+    for name in KEYSET_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('deduplicator', '0003_partition_uniqueevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uniqueevent',
+            name='event_name',
+            field=models.TextField(blank=True, help_text='event_name of the event (copied from event_data).', null=True),
+        ),
+        migrations.AddField(
+            model_name='uniqueevent',
+            name='user_id',
+            field=models.TextField(blank=True, help_text='userId of the event (copied from event_data).', null=True),
+        ),
+        migrations.AddField(
+            model_name='uniqueevent',
+            name='client_id',
+            field=models.TextField(blank=True, help_text='client_id of the event as text (copied from event_data).', null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='uniqueevent',
+                    index=models.Index(fields=['event_name', 'received_at', 'id'], name='uniqueevent_event_name_keyset'),
+                ),
+                migrations.AddIndex(
+                    model_name='uniqueevent',
+                    index=models.Index(fields=['user_id', 'received_at', 'id'], name='uniqueevent_user_id_keyset'),
+                ),
+                migrations.AddIndex(
+                    model_name='uniqueevent',
+                    index=models.Index(fields=['client_id', 'received_at', 'id'], name='uniqueevent_client_id_keyset'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:47
+
+import deduplicator.serialization
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deduplicator', '0004_promoted_event_fields'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uniqueevent',
+            name='event_data',
+            field=models.JSONField(encoder=deduplicator.serialization.EventJSONEncoder, help_text='The full JSON payload of the unique event.'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:03
+"""
+Колонки duplicate_count и last_seen_at (повторы события, переносятся из
+Redis задачей flush_duplicate_hits).
+
+duplicate_count добавляется с DEFAULT 0 на уровне БД: в PostgreSQL 11+ это
+изменение метаданных, существующие строки не переписываются, а старый код
+при поэтапном обновлении может писать строки без этой колонки.
+"""
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deduplicator', '0005_event_data_encoder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uniqueevent',
+            name='duplicate_count',
+            field=models.BigIntegerField(db_default=0, default=0, help_text='How many times the event was seen again and dropped as a duplicate (updated periodically).'),
+        ),
+        migrations.AddField(
+            model_name='uniqueevent',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, help_text='Timestamp of the latest duplicate of the event (updated periodically).', null=True),
+        ),
+    ]
@@ -0,0 +1,65 @@
+"""
+Индекс (received_at, id) вместо индекса received_at, который 0003 создала у
+родительской таблицы (и который при ATTACH PARTITION забрал себе индекс
+received_at legacy-таблицы из 0001).
+
+Выборка новых событий без фильтра (/api/v1/events/) идет по ключу
+(received_at, id), и одного received_at ей мало; запись в дневные секции
+обслуживает один индекс вместо двух. Новый индекс строится посекционно
+через CREATE INDEX CONCURRENTLY (partitions.create_partitioned_index), старый
+удаляется после него, поэтому миграция не атомарная. Откат строит индекс
+received_at заново и удаляет (received_at, id).
+"""
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+KEYSET_INDEX = 'uniqueevent_received_at_keyset'
+RECEIVED_AT_INDEX = 'deduplicator_uniqueevent_received_at_idx'
+
+
+def replace_index(apps, schema_editor):
+    from deduplicator.partitions import create_partitioned_index, is_partitioned
+
+    if not is_partitioned():
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS "{KEYSET_INDEX}" ON "deduplicator_uniqueevent" (received_at, id)')
+        return
+    create_partitioned_index(KEYSET_INDEX, '(received_at, id)')
+    schema_editor.execute(f'DROP INDEX IF EXISTS "{RECEIVED_AT_INDEX}"')
+
+
+def restore_index(apps, schema_editor):
+    from deduplicator.partitions import create_partitioned_index, drop_partitioned_index, is_partitioned
+
+    if is_partitioned():
+        create_partitioned_index(RECEIVED_AT_INDEX, '(received_at)')
+    drop_partitioned_index(KEYSET_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('deduplicator', '0006_duplicate_hits'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(replace_index, restore_index),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='uniqueevent',
+                    name='received_at',
+                    field=models.DateTimeField(default=django.utils.timezone.now, help_text='Timestamp when the event was processed and saved.'),
+                ),
+                migrations.AddIndex(
+                    model_name='uniqueevent',
+                    index=models.Index(fields=['received_at', 'id'], name='uniqueevent_received_at_keyset'),
+                ),
+            ],
+        ),
+    ]
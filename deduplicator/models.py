@@ -2,30 +2,87 @@
 from django.db import models
 from django.utils import timezone
 
+from .serialization import EventJSONEncoder
+
+
+# Поля события, продублированные в отдельные индексируемые колонки: колонка -> поле event_data.
+# Запросы по ним (API /api/v1/events/) идут по индексам (колонка, received_at, id),
+# а не сканом JSONB. Значения хранятся текстом (см. promoted_values).
+PROMOTED_FIELDS = {
+    'event_name': 'event_name',
+    'user_id': 'userId',
+    'client_id': 'client_id',
+}
+
+
+def promoted_value(value):
+    """
+    Текстовое значение колонки из значения поля события: строки - как есть,
+    числа и булевы - как в JSON (42, true), вложенные структуры не переносятся.
+    """
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def promoted_values(event_data):
+    """Значения PROMOTED_FIELDS для записи события (колонка -> значение)."""
+    get = event_data.get
+    return {column: promoted_value(get(field)) for column, field in PROMOTED_FIELDS.items()}
+
+
 class UniqueEvent(models.Model):
     """
     Модель для хранения уникальных событий, прошедших дедупликацию.
     """
-    # Отпечаток события, который мы генерируем. Должен быть уникальным.
+    # Отпечаток события, который мы генерируем.
+    # 64 символа - hex SHA-256 исходного формата, запас - под тег версии ("v2-sha256:...")
+    # Таблица секционирована по дням received_at (миграция 0003), поэтому уникальность
+    # обеспечивает индекс каждой секции, а не ограничение всей таблицы: повтор за другие
+    # сутки отсекает только проверка при записи (recheck в writer.save_unique_events).
     fingerprint = models.CharField(
-        max_length=64,
-        unique=True,
+        max_length=80,
         db_index=True,
-        help_text="SHA256 fingerprint of the unique event's key fields."
+        help_text="Fingerprint of the unique event's key fields (hex digest with optional version tag). Unique within a daily partition."
     )
 
     # Само тело события в формате JSON.
+    # EventJSONEncoder пишет исходный текст события, если он сохранился (serialization.EventJSON)
     event_data = models.JSONField(
+        encoder=EventJSONEncoder,
         help_text="The full JSON payload of the unique event."
     )
 
     # Время, когда событие было получено и обработано воркером/консьюмером.
+    # Индекс - (received_at, id) в Meta.indexes
     received_at = models.DateTimeField(
         default=timezone.now,
-        db_index=True,
         help_text="Timestamp when the event was processed and saved."
     )
 
+    # Ключевые поля события, вынесенные из event_data при записи (см. PROMOTED_FIELDS).
+    # У строк, записанных до их появления, - NULL до запуска backfill_event_fields
+    event_name = models.TextField(null=True, blank=True, help_text="event_name of the event (copied from event_data).")
+    user_id = models.TextField(null=True, blank=True, help_text="userId of the event (copied from event_data).")
+    client_id = models.TextField(null=True, blank=True, help_text="client_id of the event as text (copied from event_data).")
+
+    # Повторы события, отсеянные как дубли, и время последнего из них. Копятся в Redis и
+    # переносятся сюда пачками задачей flush_duplicate_hits (см. deduplicator/hits.py)
+    duplicate_count = models.BigIntegerField(
+        default=0,
+        db_default=0,
+        help_text="How many times the event was seen again and dropped as a duplicate (updated periodically)."
+    )
+    last_seen_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Timestamp of the latest duplicate of the event (updated periodically)."
+    )
+
     def __str__(self):
         return f"Event {self.fingerprint[:8]}... received at {self.received_at.strftime('%Y-%m-%d %H:%M')}"
 
@@ -33,3 +90,11 @@ class UniqueEvent(models.Model):
         ordering = ['-received_at']
         verbose_name = "Unique Event"
         verbose_name_plural = "Unique Events"
+        # Индексы под выборку "по полю, новые первыми" с пагинацией по (received_at, id).
+        # На секционированной таблице создаются посекционно (миграция 0004)
+        indexes = [
+            models.Index(fields=['event_name', 'received_at', 'id'], name='uniqueevent_event_name_keyset'),
+            models.Index(fields=['user_id', 'received_at', 'id'], name='uniqueevent_user_id_keyset'),
+            models.Index(fields=['client_id', 'received_at', 'id'], name='uniqueevent_client_id_keyset'),
+            models.Index(fields=['received_at', 'id'], name='uniqueevent_received_at_keyset'),
+        ]
@@ -0,0 +1,64 @@
+import io
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.parsers import JSONParser, get_encoding
+from rest_framework.utils.json import strict_constant
+
+from .serialization import EventJSON, loads
+
+
+# Тело читается кусками такого размера, пока не кончится или не превысит лимит
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class RequestBodyTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Request body too large.'
+    default_code = 'request_too_large'
+
+
+def read_limited(stream, limit: int) -> bytes:
+    """
+    Читает тело запроса, но не больше limit байт: без Content-Length
+    (chunked) его размер заранее неизвестен, и проверка заголовка во view
+    такое тело не остановит.
+    """
+    chunks, size = [], 0
+    while True:
+        chunk = stream.read(min(READ_CHUNK_BYTES, limit + 1 - size))
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            raise RequestBodyTooLarge(f"Request body too large (max {limit} bytes).")
+
+
+class BoundedJSONParser(JSONParser):
+    """JSONParser, читающий не больше DEDUPLICATOR_BATCH_MAX_BODY_BYTES (иначе 413)."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        body = read_limited(stream, settings.DEDUPLICATOR_BATCH_MAX_BODY_BYTES)
+        return super().parse(io.BytesIO(body), media_type, parser_context)
+
+
+class FastJSONParser(BoundedJSONParser):
+    """
+    JSONParser на orjson (serialization.loads; без orjson - на json).
+    Объект верхнего уровня возвращается как EventJSON с исходным текстом
+    тела: дальше по конвейеру событие не сериализуется заново.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = get_encoding(parser_context or {})
+        body = read_limited(stream, settings.DEDUPLICATOR_BATCH_MAX_BODY_BYTES)
+        try:
+            text = body.decode(encoding)
+            data = loads(text, parse_constant=strict_constant if self.strict else None)
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+        if isinstance(data, dict):
+            return EventJSON(data, text)
+        return data
@@ -0,0 +1,180 @@
+
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import List, Optional, Tuple
+
+from django.db import connection, transaction
+
+
+logger = logging.getLogger(__name__)
+
+# Таблица UniqueEvent секционирована по дням (RANGE по received_at, границы - полночь UTC).
+# Секции: <таблица>_pYYYYMMDD на сутки, <таблица>_default для всего, что не попало
+# в дневные секции, и <таблица>_legacy - таблица до миграции 0003 (от MINVALUE до
+# дня миграции). См. migrations/0003_partition_uniqueevent.py.
+PARENT_TABLE = 'deduplicator_uniqueevent'
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+
+# Секция: (имя, нижняя граница или None для MINVALUE, верхняя граница или None для DEFAULT)
+Partition = Tuple[str, Optional[datetime], Optional[datetime]]
+
+_PARTITIONS_SQL = """
+    SELECT child.relname,
+           (regexp_match(pg_get_expr(child.relpartbound, child.oid), 'FROM \\(''([^'']+)''\\)'))[1]::timestamptz,
+           (regexp_match(pg_get_expr(child.relpartbound, child.oid), 'TO \\(''([^'']+)''\\)'))[1]::timestamptz
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = %s
+    ORDER BY 3 NULLS LAST
+"""
+
+
+def is_partitioned() -> bool:
+    """True, если таблица UniqueEvent уже секционирована (PostgreSQL, миграция 0003)."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                       "WHERE c.relname = %s", [PARENT_TABLE])
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> List[Partition]:
+    with connection.cursor() as cursor:
+        cursor.execute(_PARTITIONS_SQL, [PARENT_TABLE])
+        return [(name, lower, upper) for name, lower, upper in cursor.fetchall()]
+
+
+def partition_name(day: datetime) -> str:
+    return f"{PARENT_TABLE}_p{day:%Y%m%d}"
+
+
+def day_start(moment: datetime) -> datetime:
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, moment.day, tzinfo=dt_timezone.utc)
+
+
+def ensure_partitions(days_ahead: int, now: Optional[datetime] = None) -> List[str]:
+    """
+    Создает дневные секции с сегодняшнего дня до now + days_ahead дней
+    включительно, если этих дней еще не покрывает другая секция.
+    Возвращает имена созданных секций.
+
+    Секция создается отдельной таблицей и присоединяется через ATTACH
+    PARTITION. Строки этого дня, уже попавшие в секцию по умолчанию
+    (например, секцию вовремя не создали), переносятся в новую секцию в
+    той же транзакции - иначе PostgreSQL не даст ее присоединить.
+    """
+    today = day_start(now or datetime.now(dt_timezone.utc))
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Воркеры и beat могут вызвать это одновременно: секции создает один
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [PARENT_TABLE])
+        existing = [(lower, upper) for _, lower, upper in list_partitions() if upper is not None]
+
+        for offset in range(days_ahead + 1):
+            start = today + timedelta(days=offset)
+            end = start + timedelta(days=1)
+            if any((lower is None or lower < end) and start < upper for lower, upper in existing):
+                continue
+            name = partition_name(start)
+            cursor.execute(f'CREATE TABLE "{name}" (LIKE "{PARENT_TABLE}" INCLUDING DEFAULTS)')
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE received_at >= %s AND received_at < %s '
+                f'RETURNING *) INSERT INTO "{name}" SELECT * FROM moved',
+                [start, end],
+            )
+            moved = cursor.rowcount
+            # Дубли внутри секции отсекает ее уникальный индекс (ON CONFLICT DO NOTHING при вставке)
+            cursor.execute(f'CREATE UNIQUE INDEX "{name}_fingerprint_key" ON "{name}" (fingerprint)')
+            cursor.execute(
+                f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)',
+                [start, end],
+            )
+            existing.append((start, end))
+            created.append(name)
+            if moved:
+                logger.info("Создана секция %s, перенесено %d строк из секции по умолчанию", name, moved)
+            else:
+                logger.info("Создана секция %s", name)
+    return created
+
+
+def expired_partitions(cutoff: datetime) -> List[Partition]:
+    """Секции, все строки которых старше cutoff (верхняя граница не позже cutoff)."""
+    return [
+        (name, lower, upper)
+        for name, lower, upper in list_partitions()
+        if upper is not None and upper <= cutoff
+    ]
+
+
+def drop_expired_partitions(cutoff: datetime) -> List[str]:
+    """
+    Отсоединяет и удаляет секции, целиком старше cutoff. Это операции
+    над метаданными: время не зависит от числа строк, и нет мертвых строк,
+    которые потом пришлось бы вычищать VACUUM. Возвращает имена удаленных.
+    """
+    dropped = []
+    for name, _, upper in expired_partitions(cutoff):
+        drop_partition(name)
+        dropped.append(name)
+        logger.info("Удалена секция %s (строки до %s)", name, upper)
+    return dropped
+
+
+def drop_partition(name: str) -> None:
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+        cursor.execute(f'DROP TABLE "{name}"')
+
+
+def create_partitioned_index(name: str, definition: str, concurrently: bool = True) -> List[str]:
+    """
+    Индекс на секционированной таблице без блокировки записи на все время
+    построения: сначала индекс только родителя (CREATE INDEX ... ON ONLY,
+    пока невалидный), затем индекс каждой секции - CONCURRENTLY, если можно,
+    - и ALTER INDEX ... ATTACH PARTITION. Когда присоединены индексы всех
+    секций, индекс родителя становится валидным; новые секции
+    (ensure_partitions) получают его сами при ATTACH PARTITION.
+
+    definition - часть после имени таблицы: "(event_name, received_at, id)"
+    или "USING gin (event_data jsonb_path_ops)". CONCURRENTLY нельзя внутри
+    транзакции (в миграции нужен atomic = False). Повторный вызов
+    досоздает недостающие индексы секций. Возвращает имена созданных.
+    """
+    # Имя индекса секции: <секция>_<имя без префикса модели>, в пределах 63 символов PostgreSQL
+    suffix = name.removeprefix('uniqueevent_')
+    created = []
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON ONLY "{PARENT_TABLE}" {definition}')
+        for partition, _, _ in list_partitions():
+            # Секции, созданные после индекса родителя, получили свой индекс при ATTACH PARTITION
+            cursor.execute(
+                "SELECT 1 FROM pg_inherits JOIN pg_index ON pg_index.indexrelid = pg_inherits.inhrelid "
+                "WHERE pg_inherits.inhparent = to_regclass(%s) AND pg_index.indrelid = to_regclass(%s)",
+                [name, partition],
+            )
+            if cursor.fetchone() is not None:
+                continue
+            child = f"{partition}_{suffix}"
+            cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [child])
+            row = cursor.fetchone()
+            if row is not None and not row[0]:
+                # Остаток прерванного CREATE INDEX CONCURRENTLY
+                cursor.execute(f'DROP INDEX "{child}"')
+                row = None
+            if row is None:
+                cursor.execute(f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}"{child}" '
+                               f'ON "{partition}" {definition}')
+                created.append(child)
+                logger.info("Создан индекс %s", child)
+            cursor.execute(f'ALTER INDEX "{name}" ATTACH PARTITION "{child}"')
+    return created
+
+
+def drop_partitioned_index(name: str) -> None:
+    """Удаляет индекс родителя вместе с индексами всех секций."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
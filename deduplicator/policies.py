@@ -0,0 +1,139 @@
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+from .fingerprint import Fingerprinter, build_fingerprinter
+from .storage import DedupStorage
+
+
+DEFAULT_POLICY = 'default'
+
+# Параметры политики в DEDUPLICATOR_POLICIES; не заданные берутся из общих настроек.
+# bucket_seconds - длина корзины раскладок 'bucketed'/'bloom': при коротком TTL корзина
+# тоже должна быть короткой, иначе отпечатки живут до ttl + bucket_seconds
+POLICY_OPTIONS = ('key_fields', 'ttl_seconds', 'layout', 'bucket_seconds')
+
+# (раскладка, TTL, префикс ключей, **параметры раскладки) -> хранилище; собирается в settings.py
+StorageFactory = Callable[..., DedupStorage]
+
+
+class DedupPolicy:
+    """
+    Правила дедупликации одного типа событий: по каким полям считается
+    отпечаток, сколько он живет и в каком хранилище. Функция отпечатка
+    собирается один раз, при создании политики.
+    """
+
+    def __init__(self, name: str, key_fields: List[str], ttl_seconds: int, storage: DedupStorage,
+                 fingerprint: Fingerprinter):
+        if not isinstance(ttl_seconds, int) or ttl_seconds <= 0:
+            raise ValueError(f"Политика {name}: ttl_seconds должен быть положительным целым числом")
+        if not isinstance(key_fields, list) or not all(isinstance(f, str) for f in key_fields):
+            raise ValueError(f"Политика {name}: key_fields должен быть списком строк")
+        if not key_fields:
+            raise ValueError(f"Политика {name}: key_fields не должен быть пустым")
+        if storage.ttl != ttl_seconds:
+            raise ValueError(f"Политика {name}: TTL хранилища ({storage.ttl}) не совпадает с ttl_seconds ({ttl_seconds})")
+
+        self.name = name
+        self.key_fields = sorted(key_fields)
+        self.ttl = ttl_seconds
+        self.storage = storage
+        self.fingerprint = fingerprint
+
+    def __repr__(self) -> str:
+        return (f"DedupPolicy({self.name!r}, ttl={self.ttl}, key_fields={self.key_fields}, "
+                f"storage={type(self.storage).__name__})")
+
+
+class PolicyRegistry:
+    """
+    Политики по значению поля события (по умолчанию event_name). Событие,
+    для значения которого своей политики нет (или без этого поля), идет
+    по политике по умолчанию. Выбор политики - один dict.get на событие.
+    """
+
+    def __init__(self, default: DedupPolicy, policies: Sequence[DedupPolicy] = (), field: str = 'event_name'):
+        self.default = default
+        self.field = field
+        self._by_value: Dict[Any, DedupPolicy] = {}
+        for policy in policies:
+            if policy.name in self._by_value:
+                raise ValueError(f"Политика {policy.name} задана дважды")
+            self._by_value[policy.name] = policy
+
+    def resolve(self, event_data: Dict[str, Any]) -> DedupPolicy:
+        if not self._by_value:
+            return self.default
+        try:
+            return self._by_value.get(event_data.get(self.field), self.default)
+        except TypeError:
+            # Нехешируемое значение поля (список, словарь) - своей политики у него быть не может
+            return self.default
+
+    def __iter__(self) -> Iterator[DedupPolicy]:
+        yield self.default
+        yield from self._by_value.values()
+
+    def __len__(self) -> int:
+        return len(self._by_value) + 1
+
+    @property
+    def max_ttl(self) -> int:
+        return max(policy.ttl for policy in self)
+
+    @property
+    def min_ttl(self) -> int:
+        return min(policy.ttl for policy in self)
+
+    @property
+    def max_window(self) -> int:
+        """Наибольший срок, который отпечаток любой политики считается виденным (см. DedupStorage.window_seconds)."""
+        return max(policy.storage.window_seconds for policy in self)
+
+
+def build_policy(name: str, options: Dict[str, Any], field: str, default_key_fields: List[str],
+                 default_ttl: int, default_layout: str, storage_factory: StorageFactory,
+                 fingerprint_algorithm: str = 'sha256-json', digest_size: int = 16,
+                 prefix: str = 'event_dedup:p') -> DedupPolicy:
+    """
+    Политика из описания в DEDUPLICATOR_POLICIES.
+
+    Поле выбора политики (field) всегда входит в ключ: тогда отпечатки
+    разных политик не совпадают даже при одинаковых key_fields, и
+    уникальный индекс fingerprint в БД их не смешивает. Ключи Redis -
+    под своим префиксом <prefix>:<name>, чтобы корзины раскладок
+    'bucketed'/'bloom' с разным TTL не делили ключи.
+    """
+    if not isinstance(options, dict):
+        raise ValueError(f"Политика {name}: ожидается объект с параметрами {', '.join(POLICY_OPTIONS)}")
+    unknown = set(options) - set(POLICY_OPTIONS)
+    if unknown:
+        raise ValueError(f"Политика {name}: неизвестные параметры {', '.join(sorted(unknown))} "
+                         f"(допустимы {', '.join(POLICY_OPTIONS)})")
+
+    if 'key_fields' in options and not isinstance(options['key_fields'], list):
+        raise ValueError(f"Политика {name}: key_fields должен быть списком строк")
+    key_fields = list(options.get('key_fields', default_key_fields))
+    if field not in key_fields:
+        key_fields.append(field)
+    ttl_seconds = options.get('ttl_seconds', default_ttl)
+    if not isinstance(ttl_seconds, int) or ttl_seconds <= 0:
+        raise ValueError(f"Политика {name}: ttl_seconds должен быть положительным целым числом")
+    storage_options = {'bucket_seconds': options['bucket_seconds']} if 'bucket_seconds' in options else {}
+    storage = storage_factory(options.get('layout', default_layout), ttl_seconds, f"{prefix}:{name}", **storage_options)
+    return DedupPolicy(
+        name,
+        key_fields,
+        ttl_seconds,
+        storage,
+        build_fingerprinter(key_fields, fingerprint_algorithm, digest_size),
+    )
+
+
+def build_policies(config: Optional[Dict[str, Dict[str, Any]]], **defaults: Any) -> List[DedupPolicy]:
+    """Политики из DEDUPLICATOR_POLICIES ({значение поля: параметры}); defaults - как у build_policy."""
+    if not config:
+        return []
+    if not isinstance(config, dict):
+        raise ValueError("DEDUPLICATOR_POLICIES должен быть объектом {значение поля: параметры}")
+    return [build_policy(name, options, **defaults) for name, options in config.items()]
@@ -0,0 +1,120 @@
+import importlib.util
+import json
+from typing import Any
+
+from kombu import compression
+from kombu.serialization import register
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Сериализаторы сообщений Celery (DEDUPLICATOR_CELERY_SERIALIZER):
+#   'json'    - стандартный сериализатор Celery (исходный вариант)
+#   'orjson'  - тот же JSON, кодируется и разбирается orjson (нужен пакет orjson)
+#   'msgpack' - двоичный MessagePack, встроен в kombu (нужен пакет msgpack)
+CELERY_SERIALIZERS = ('json', 'orjson', 'msgpack')
+
+ORJSON_CONTENT_TYPE = 'application/x-orjson'
+
+# orjson разбирает целые длиннее 64 бит как float, а json - как int: такой документ
+# (как и любой с 20+ цифрами подряд, даже внутри строки) разбирается json'ом.
+# Поиск - translate цифр в нулевые байты и поиск подстроки: в разы быстрее регулярного выражения
+_DIGIT_MARKS = bytes.maketrans(b'0123456789', bytes(10))
+_LONG_NUMBER = bytes(20)
+
+
+def _has_long_number(data) -> bool:
+    if isinstance(data, str):
+        data = data.encode()
+    return _LONG_NUMBER in data.translate(_DIGIT_MARKS)
+
+
+def loads(data, **json_options) -> Any:
+    """
+    Разбор JSON (str или bytes) через orjson, если он установлен.
+    Результат - как у json.loads: документы, которые orjson разбирает
+    иначе (длинные целые) или не принимает (NaN, одиночные суррогаты),
+    разбирает json с json_options.
+    """
+    if orjson is None or _has_long_number(data):
+        return json.loads(data, **json_options)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data, **json_options)
+
+
+def dumps(obj: Any) -> str:
+    """Компактный JSON; через orjson, если он установлен и справляется со значением."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # Целые длиннее 64 бит, нестроковые ключи и т.п.
+            pass
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+class EventJSON(dict):
+    """
+    Разобранное событие вместе с исходным текстом JSON (raw). Пока
+    событие не меняется, в поток Redis и в БД пишется этот текст - без
+    повторной сериализации словаря. Для остального кода - обычный dict.
+    """
+
+    __slots__ = ('raw',)
+
+    def __init__(self, data, raw: str):
+        super().__init__(data)
+        self.raw = raw
+
+
+def event_json(event_data) -> str:
+    """Текст JSON события: исходный, если он есть (EventJSON), иначе dumps."""
+    raw = getattr(event_data, 'raw', None)
+    return raw if raw is not None else dumps(event_data)
+
+
+class EventJSONEncoder(json.JSONEncoder):
+    """
+    Кодировщик UniqueEvent.event_data: EventJSON пишется исходным текстом,
+    остальные значения кодируются через orjson (если он установлен).
+    """
+
+    def encode(self, o):
+        if type(o) is EventJSON:
+            return o.raw
+        if orjson is not None:
+            try:
+                return orjson.dumps(o).decode()
+            except orjson.JSONEncodeError:
+                pass
+        return super().encode(o)
+
+
+def register_celery_serializer(name: str) -> None:
+    """
+    Проверяет сериализатор из CELERY_SERIALIZERS и при необходимости
+    регистрирует его в kombu. Вызывается из settings.py, то есть в каждом
+    процессе, который отправляет или выполняет задачи.
+    """
+    if name not in CELERY_SERIALIZERS:
+        raise ValueError(f"Неизвестный сериализатор Celery: {name!r} (допустимы {', '.join(CELERY_SERIALIZERS)})")
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("Сериализатор Celery 'orjson' требует пакет orjson")
+        # Кортежи (args, kwargs, embed) протокола Celery orjson пишет массивами, как и json
+        register('orjson', orjson.dumps, orjson.loads, content_type=ORJSON_CONTENT_TYPE, content_encoding='binary')
+    elif name == 'msgpack' and importlib.util.find_spec('msgpack') is None:
+        raise ValueError("Сериализатор Celery 'msgpack' требует пакет msgpack")
+
+
+def check_compression(name: str) -> None:
+    """Проверяет, что kombu знает алгоритм сжатия сообщений name."""
+    try:
+        compression.get_encoder(name)
+    except KeyError:
+        raise ValueError(f"Неизвестный алгоритм сжатия сообщений Celery: {name!r}")
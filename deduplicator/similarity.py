@@ -0,0 +1,267 @@
+import hashlib
+import math
+import re
+import struct
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import redis
+import redis.asyncio
+
+from .fingerprint import _encode_value
+from .policies import DedupPolicy
+from .storage import make_async_client
+
+
+_MASK64 = (1 << 64) - 1
+# Нечетная константа золотого сечения: умножение разносит 32-битный crc32 по 64 битам
+_GOLDEN64 = 0x9E3779B97F4A7C15
+_WORD = re.compile(r'\w+')
+
+# Проверка кандидата в Redis: (отпечаток события, сигнатура, ключи корзин полос, TTL)
+Probe = Tuple[str, bytes, List[str], int]
+
+
+class MinHasher:
+    """
+    Сигнатура MinHash по полям события: n-граммы байтов каждого слова
+    значения (слово в рамке '#', без учета регистра), солью служит имя поля.
+    Одна хеш-функция на признак (one permutation hashing) с заполнением
+    пустых ячеек (densification): доля совпавших ячеек двух сигнатур -
+    оценка коэффициента Жаккара.
+    """
+
+    def __init__(self, fields: Sequence[str], num_hashes: int = 64, ngram: int = 2):
+        if not fields or not all(isinstance(field, str) for field in fields):
+            raise ValueError("fields должен быть непустым списком строк")
+        if not isinstance(num_hashes, int) or num_hashes < 8 or num_hashes & (num_hashes - 1):
+            raise ValueError("num_hashes должен быть степенью двойки не меньше 8")
+        if not isinstance(ngram, int) or ngram < 1:
+            raise ValueError("ngram должен быть положительным целым числом")
+        self.fields = tuple(sorted(fields))
+        self.num_hashes = num_hashes
+        self.ngram = ngram
+        self._shift = 64 - (num_hashes.bit_length() - 1)
+        self._pack = struct.Struct(f">{num_hashes}I").pack
+        # Соль поля - начальное значение crc32, чтобы одинаковые n-граммы разных полей не совпадали
+        self._seeds = {field: zlib.crc32(field.encode('utf-8')) for field in self.fields}
+
+    def features(self, event_data: Dict[str, Any]) -> List[Tuple[int, bytes]]:
+        """Признаки события: (соль поля, n-грамма). Повторы не убираются - минимум их не замечает."""
+        return [(seed, gram) for seed, word in self._words(event_data) for gram in self._grams(word)]
+
+    def signature(self, event_data: Dict[str, Any]) -> Optional[bytes]:
+        """Сигнатура - num_hashes 32-битных значений, упакованных в байты; None, если признаков нет."""
+        size, shift, ngram = self.num_hashes, self._shift, self.ngram
+        empty = 1 << 32
+        slots = [empty] * size
+        crc32 = zlib.crc32
+        seen = False
+        # Тот же перебор, что в features, но без промежуточного списка: это горячий путь
+        for seed, word in self._words(event_data):
+            seen = True
+            for start in range(max(1, len(word) - ngram + 1)):
+                h = (crc32(word[start:start + ngram], seed) * _GOLDEN64) & _MASK64
+                slot = h >> shift
+                value = (h >> 8) & 0xFFFFFFFF
+                if value < slots[slot]:
+                    slots[slot] = value
+        if not seen:
+            return None
+        if empty in slots:
+            self._densify(slots, empty)
+        return self._pack(*slots)
+
+    def _words(self, event_data: Dict[str, Any]):
+        """Пары (соль поля, слово в рамке '#...#' в UTF-8) по всем полям."""
+        for field in self.fields:
+            value = event_data.get(field)
+            if value is None:
+                continue
+            seed = self._seeds[field]
+            for word in _WORD.findall(value.lower() if isinstance(value, str) else str(value).lower()):
+                yield seed, f"#{word}#".encode('utf-8')
+
+    def _grams(self, word: bytes) -> List[bytes]:
+        ngram = self.ngram
+        return [word[start:start + ngram] for start in range(max(1, len(word) - ngram + 1))]
+
+    @staticmethod
+    def _densify(slots: List[int], empty: int) -> None:
+        size = len(slots)
+        donors = slots[:]
+        for slot in range(size):
+            if donors[slot] != empty:
+                continue
+            # Ближайшая непустая ячейка справа (по кругу); сдвиг на расстояние различает заимствования
+            distance = 1
+            while donors[(slot + distance) % size] == empty:
+                distance += 1
+            slots[slot] = (donors[(slot + distance) % size] + distance * 0x9E3779B1) & 0xFFFFFFFF
+
+
+def similarity(signature: bytes, other: bytes) -> float:
+    """Оценка коэффициента Жаккара: доля совпавших 32-битных ячеек сигнатур."""
+    if len(signature) != len(other):
+        return 0.0
+    count = len(signature) // 4
+    a, b = struct.unpack(f">{count}I", signature), struct.unpack(f">{count}I", other)
+    return sum(x == y for x, y in zip(a, b)) / count
+
+
+class NearDuplicateIndex:
+    """
+    Поиск почти-дублей: LSH по сигнатурам MinHash в Redis.
+
+    Сигнатура режется на bands полос; корзина полосы хранит последние
+    bucket_size отпечатков событий того же блока (политика и точные поля
+    ключа). Один Lua-скрипт сравнивает событие с кандидатами из его корзин
+    (не больше max_candidates) и возвращает отпечаток похожего не ниже
+    threshold, иначе записывает событие в корзины. Ключи живут TTL политики.
+    """
+
+    # KEYS: корзины полос. ARGV[1]: сигнатура, ARGV[2]: отпечаток, ARGV[3]: префикс ключей
+    # сигнатур, ARGV[4]: TTL, ARGV[5]: сколько ячеек должно совпасть, ARGV[6]: размер корзины,
+    # ARGV[7]: сколько кандидатов проверить. Ответ: отпечаток похожего события или nil.
+    SCRIPT = """
+local sig = ARGV[1]
+local need = tonumber(ARGV[5])
+local cap = tonumber(ARGV[6])
+local budget = tonumber(ARGV[7])
+local checked = {}
+for i = 1, #KEYS do
+    local members = redis.call('LRANGE', KEYS[i], 0, cap - 1)
+    for _, candidate in ipairs(members) do
+        if budget <= 0 then
+            break
+        end
+        if not checked[candidate] then
+            checked[candidate] = true
+            budget = budget - 1
+            local other = redis.call('GET', ARGV[3] .. candidate)
+            if other and #other == #sig then
+                local equal = 0
+                for j = 1, #sig, 4 do
+                    if string.sub(sig, j, j + 3) == string.sub(other, j, j + 3) then
+                        equal = equal + 1
+                    end
+                end
+                if equal >= need then
+                    return candidate
+                end
+            end
+        end
+    end
+end
+redis.call('SET', ARGV[3] .. ARGV[2], sig, 'EX', ARGV[4])
+for i = 1, #KEYS do
+    if redis.call('LPUSH', KEYS[i], ARGV[2]) > cap then
+        redis.call('LTRIM', KEYS[i], 0, cap - 1)
+    end
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+return false
+"""
+
+    async_max_connections = 100
+
+    def __init__(self, redis_client: redis.Redis, hasher: MinHasher, bands: int = 16, threshold: float = 0.7,
+                 bucket_size: int = 32, max_candidates: int = 64, prefix: str = "event_dedup:near"):
+        if not isinstance(bands, int) or bands <= 0 or hasher.num_hashes % bands:
+            raise ValueError("bands должен быть положительным делителем num_hashes")
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold должен быть в интервале (0, 1]")
+        if not isinstance(bucket_size, int) or bucket_size <= 0:
+            raise ValueError("bucket_size должен быть положительным целым числом")
+        if not isinstance(max_candidates, int) or max_candidates <= 0:
+            raise ValueError("max_candidates должен быть положительным целым числом")
+        self.redis = redis_client
+        self.hasher = hasher
+        self.bands = bands
+        self.rows = hasher.num_hashes // bands
+        self.threshold = threshold
+        self.bucket_size = bucket_size
+        self.max_candidates = max_candidates
+        self.prefix = prefix
+        # Сходство - доля совпавших ячеек: порог в ячейках, округленный вверх
+        self.min_equal = math.ceil(threshold * hasher.num_hashes - 1e-9)
+        self._script_sha = hashlib.sha1(self.SCRIPT.encode('utf-8')).hexdigest()
+        # политика -> поля, которые должны совпасть точно
+        self._exact_fields: Dict[str, Tuple[str, ...]] = {}
+        self._async_redis: Optional[redis.asyncio.Redis] = None
+
+    @property
+    def async_redis(self) -> redis.asyncio.Redis:
+        if self._async_redis is None:
+            self._async_redis = make_async_client(self.redis, self.async_max_connections)
+        return self._async_redis
+
+    def probe(self, event_data: Dict[str, Any], fingerprint: str, policy: DedupPolicy) -> Optional[Probe]:
+        """Данные проверки события; None, если у события нет ни одного признака (поля fields пусты)."""
+        signature = self.hasher.signature(event_data)
+        if signature is None:
+            return None
+        exact_fields = self._exact_fields.get(policy.name)
+        if exact_fields is None:
+            exact_fields = tuple(field for field in policy.key_fields if field not in self.hasher.fields)
+            self._exact_fields[policy.name] = exact_fields
+        get = event_data.get
+        block = hashlib.blake2b(
+            "".join([_encode_value(policy.name)] + [_encode_value(get(field)) for field in exact_fields]).encode('utf-8'),
+            digest_size=8,
+        ).digest()
+        width = self.rows * 4
+        keys = [
+            f"{self.prefix}:b:" + hashlib.blake2b(
+                block + bytes((band,)) + signature[band * width:(band + 1) * width], digest_size=8
+            ).hexdigest()
+            for band in range(self.bands)
+        ]
+        return fingerprint, signature, keys, policy.ttl
+
+    def find_or_add_many(self, probes: Sequence[Probe]) -> List[Optional[str]]:
+        """
+        Проверяет события одним pipeline (скрипты выполняются по порядку,
+        поэтому почти-дубли внутри пакета тоже находятся). Ответ для
+        каждого - отпечаток похожего события или None (событие записано).
+        """
+        if not probes:
+            return []
+        return self._execute(lambda pipe: self._queue(pipe, probes))
+
+    async def find_or_add_many_async(self, probes: Sequence[Probe]) -> List[Optional[str]]:
+        if not probes:
+            return []
+        try:
+            return await self._execute_once_async(probes)
+        except redis.exceptions.NoScriptError:
+            await self.async_redis.script_load(self.SCRIPT)
+            return await self._execute_once_async(probes)
+
+    def forget_many(self, fingerprints: Sequence[str]) -> None:
+        """Удаляет сигнатуры событий: записи в корзинах без сигнатуры при проверке пропускаются."""
+        if fingerprints:
+            self.redis.delete(*[f"{self.prefix}:s:{fingerprint}" for fingerprint in fingerprints])
+
+    def _queue(self, pipe: Any, probes: Sequence[Probe]) -> None:
+        for fingerprint, signature, keys, ttl in probes:
+            pipe.evalsha(self._script_sha, len(keys), *keys, signature, fingerprint, f"{self.prefix}:s:", ttl,
+                         self.min_equal, self.bucket_size, self.max_candidates)
+
+    def _execute(self, build: Callable[[Any], None]) -> List[Any]:
+        # Как DedupStorage.execute: при NOSCRIPT ни один скрипт пакета не выполнился
+        try:
+            return self._execute_once(build)
+        except redis.exceptions.NoScriptError:
+            self.redis.script_load(self.SCRIPT)
+            return self._execute_once(build)
+
+    def _execute_once(self, build: Callable[[Any], None]) -> List[Any]:
+        pipe = self.redis.pipeline(transaction=False)
+        build(pipe)
+        return pipe.execute()
+
+    async def _execute_once_async(self, probes: Sequence[Probe]) -> List[Any]:
+        pipe = self.async_redis.pipeline(transaction=False)
+        self._queue(pipe, probes)
+        return await pipe.execute()
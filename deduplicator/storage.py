@@ -0,0 +1,709 @@
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import redis
+import redis.asyncio
+
+
+logger = logging.getLogger(__name__)
+
+
+class DedupStorage:
+    """
+    Базовый класс хранилища отпечатков в Redis.
+
+    Хранилище умеет атомарно "проверить и записать" отпечаток: add()
+    возвращает True, если отпечаток новый (и теперь записан), и False,
+    если он уже был в окне дедупликации.
+
+    Подклассы описывают только команды для одного отпечатка
+    (queue_add/parse_add), а пакетная отправка одним pipeline и загрузка
+    Lua-скриптов сделаны здесь. Ошибки Redis пробрасываются наружу -
+    что с ними делать, решает EventDeduplicator.
+    """
+
+    # Lua-скрипт хранилища (если нужен); вызывается через EVALSHA
+    SCRIPT: Optional[str] = None
+
+    # Размер пула соединений асинхронного клиента (см. async_redis)
+    async_max_connections = 100
+
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int):
+        if not isinstance(ttl_seconds, int) or ttl_seconds <= 0:
+            raise ValueError("ttl_seconds должен быть положительным целым числом")
+        self.redis = redis_client
+        self.ttl = ttl_seconds
+        self._script_sha = hashlib.sha1(self.SCRIPT.encode('utf-8')).hexdigest() if self.SCRIPT else None
+        self._async_redis: Optional[redis.asyncio.Redis] = None
+
+    @property
+    def async_redis(self) -> redis.asyncio.Redis:
+        """
+        Асинхронный клиент к тому же Redis, что и self.redis, со своим пулом.
+        Создается лениво, при первом использовании в event loop (ASGI).
+        """
+        if self._async_redis is None:
+            self._async_redis = make_async_client(self.redis, self.async_max_connections)
+        return self._async_redis
+
+    def queue_add(self, pipe: Any, fingerprint: str) -> None:
+        """Кладет в pipeline ровно одну команду "проверить и записать"."""
+        raise NotImplementedError
+
+    def queue_mark(self, pipe: Any, fingerprint: str) -> None:
+        """
+        Кладет в pipeline ровно одну команду "записать без проверки"
+        (восстановление и продление окна).
+        """
+        self.queue_add(pipe, fingerprint)
+
+    def queue_add_fresh(self, pipe: Any, fingerprint: str) -> None:
+        """
+        Как queue_add, когда известно, что в прошлом окне отпечатка не было
+        (гибридный режим): проверка может быть дешевле, но остается атомарной.
+        """
+        self.queue_add(pipe, fingerprint)
+
+    def queue_restore(self, pipe: Any, fingerprint: str, seen_at: float, now: float) -> None:
+        """
+        Кладет в pipeline ровно одну команду "восстановить отпечаток", впервые
+        увиденный в seen_at (unix time): запись должна истечь так же, как
+        если бы отпечаток был добавлен тогда.
+        """
+        raise NotImplementedError
+
+    def queue_forget(self, pipe: Any, fingerprint: str) -> None:
+        """Кладет в pipeline удаление отпечатка (событие так и не сохранено в БД)."""
+        raise NotImplementedError
+
+    def parse_add(self, reply: Any) -> bool:
+        return bool(reply)
+
+    def add(self, fingerprint: str) -> bool:
+        return self.add_many([fingerprint])[0]
+
+    def add_many(self, fingerprints: Sequence[str]) -> List[bool]:
+        """Проверяет и записывает отпечатки одним pipeline. Порядок ответа = порядок входа."""
+        if not fingerprints:
+            return []
+
+        def build(pipe):
+            for fingerprint in fingerprints:
+                self.queue_add(pipe, fingerprint)
+
+        return [self.parse_add(reply) for reply in self.execute(build)]
+
+    def restore_many(self, items: Sequence[Tuple[str, float]], now: Optional[float] = None) -> int:
+        """
+        Восстанавливает отпечатки одним pipeline (например, из БД после потери
+        Redis). items - пары (fingerprint, seen_at). Отпечатки, чье окно уже
+        истекло, пропускаются. Возвращает количество записанных.
+        """
+        now = time.time() if now is None else now
+        live = [(fingerprint, seen_at) for fingerprint, seen_at in items if seen_at + self.ttl > now]
+        if not live:
+            return 0
+
+        def build(pipe):
+            for fingerprint, seen_at in live:
+                self.queue_restore(pipe, fingerprint, seen_at, now)
+
+        self.execute(build)
+        return len(live)
+
+    def touch_many(self, fingerprints: Sequence[str]) -> None:
+        """
+        Продлевает окно дедупликации отпечатков (скользящее окно, см.
+        hits.DuplicateHits): записывает их заново, как queue_mark, одним pipeline.
+        """
+        if not fingerprints:
+            return
+
+        def build(pipe):
+            for fingerprint in fingerprints:
+                self.queue_mark(pipe, fingerprint)
+
+        self.execute(build)
+
+    def forget_many(self, fingerprints: Sequence[str]) -> None:
+        """
+        Удаляет отпечатки одним pipeline: следующая копия события снова
+        будет новой. Нужна, когда событие не удалось сохранить в БД.
+        """
+        if not fingerprints:
+            return
+
+        def build(pipe):
+            for fingerprint in fingerprints:
+                self.queue_forget(pipe, fingerprint)
+
+        self.execute(build)
+
+    @property
+    def window_seconds(self) -> int:
+        """Наибольший срок, который отпечаток может считаться виденным после записи."""
+        return self.ttl
+
+    def execute(self, build: Callable[[Any], None]) -> List[Any]:
+        """
+        Создает pipeline, наполняет его через build(pipe) и выполняет.
+        Если Redis не знает Lua-скрипт (перезапуск, SCRIPT FLUSH), скрипт
+        загружается и пакет повторяется: при NOSCRIPT ни одна команда
+        пакета не выполнилась, повтор безопасен.
+        """
+        try:
+            return self._execute_once(build)
+        except redis.exceptions.NoScriptError:
+            self.redis.script_load(self.SCRIPT)
+            return self._execute_once(build)
+
+    def _execute_once(self, build: Callable[[Any], None]) -> List[Any]:
+        pipe = self.redis.pipeline(transaction=False)
+        build(pipe)
+        return pipe.execute()
+
+    async def add_many_async(self, fingerprints: Sequence[str]) -> List[bool]:
+        """Асинхронная версия add_many через async_redis (команды те же)."""
+        if not fingerprints:
+            return []
+
+        def build(pipe):
+            for fingerprint in fingerprints:
+                self.queue_add(pipe, fingerprint)
+
+        return [self.parse_add(reply) for reply in await self.execute_async(build)]
+
+    async def execute_async(self, build: Callable[[Any], None]) -> List[Any]:
+        try:
+            return await self._execute_once_async(build)
+        except redis.exceptions.NoScriptError:
+            await self.async_redis.script_load(self.SCRIPT)
+            return await self._execute_once_async(build)
+
+    async def _execute_once_async(self, build: Callable[[Any], None]) -> List[Any]:
+        pipe = self.async_redis.pipeline(transaction=False)
+        build(pipe)
+        return await pipe.execute()
+
+    def _queue_script(self, pipe: Any, keys: Sequence[str], args: Sequence[Any]) -> None:
+        pipe.evalsha(self._script_sha, len(keys), *keys, *args)
+
+
+# Параметры подключения, которые переносятся из синхронного клиента в асинхронный
+_ASYNC_CLIENT_KWARGS = (
+    'host', 'port', 'db', 'username', 'password', 'socket_timeout', 'socket_connect_timeout',
+    'encoding', 'encoding_errors', 'decode_responses', 'client_name',
+)
+
+
+def make_async_client(sync_client: redis.Redis, max_connections: int) -> redis.asyncio.Redis:
+    """redis.asyncio.Redis с теми же параметрами подключения, что и у sync_client."""
+    connection_kwargs = sync_client.connection_pool.connection_kwargs
+    kwargs = {name: connection_kwargs[name] for name in _ASYNC_CLIENT_KWARGS if name in connection_kwargs}
+    return redis.asyncio.Redis(max_connections=max_connections, **kwargs)
+
+
+def fingerprint_digest(fingerprint: str) -> bytes:
+    """Бинарный дайджест из hex-отпечатка (тег версии вида "v2-sha256:" отбрасывается)."""
+    return bytes.fromhex(fingerprint.rpartition(':')[2])
+
+
+class StringKeyStorage(DedupStorage):
+    """
+    Исходная раскладка: отдельный строковый ключ event_dedup:<fingerprint>
+    со значением "1" и собственным TTL. Точная, но самая затратная по памяти.
+    """
+
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int, prefix: str = "event_dedup"):
+        super().__init__(redis_client, ttl_seconds)
+        self.prefix = prefix
+
+    def key(self, fingerprint: str) -> str:
+        return f"{self.prefix}:{fingerprint}"
+
+    def queue_add(self, pipe: Any, fingerprint: str) -> None:
+        pipe.set(self.key(fingerprint), "1", ex=self.ttl, nx=True)
+
+    def queue_mark(self, pipe: Any, fingerprint: str) -> None:
+        pipe.set(self.key(fingerprint), "1", ex=self.ttl)
+
+    def queue_restore(self, pipe: Any, fingerprint: str, seen_at: float, now: float) -> None:
+        # Остаток TTL от момента первого появления; NX - не трогаем уже живые ключи
+        pipe.set(self.key(fingerprint), "1", ex=max(1, math.ceil(seen_at + self.ttl - now)), nx=True)
+
+    def queue_forget(self, pipe: Any, fingerprint: str) -> None:
+        pipe.delete(self.key(fingerprint))
+
+
+class BucketedHashStorage(DedupStorage):
+    """
+    Компактная раскладка: вместо ключа на событие - усеченный бинарный
+    дайджест в поле хэша. Хэши разбиты по временным корзинам (по умолчанию
+    сутки) и по shards шардам внутри корзины:
+
+        event_dedup:b:<номер корзины>:<шард>  ->  {<digest_bytes байт>: ""}
+
+    Корзина истекает целиком через ttl_seconds после своего конца, поэтому
+    нет TTL на каждый отпечаток. Проверка смотрит все корзины, покрывающие
+    окно TTL (ceil(ttl / bucket_seconds) + 1 штук), запись идет в текущую.
+    Фактическое окно дедупликации - от ttl до ttl + bucket_seconds.
+
+    Шардов должно быть столько, чтобы хэш корзины оставался меньше
+    hash-max-ziplist-entries полей (компактная кодировка listpack).
+    """
+
+    # KEYS: хэши корзин окна, текущая - первой. ARGV[1]: поле, ARGV[2]: EXPIREAT текущей корзины,
+    # ARGV[3]: '1' - записать без проверки (queue_mark).
+    SCRIPT = """
+if ARGV[3] ~= '1' then
+    for i = 1, #KEYS do
+        if redis.call('HEXISTS', KEYS[i], ARGV[1]) == 1 then
+            return 0
+        end
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], '')
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+return 1
+"""
+
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int, bucket_seconds: int = 86400,
+                 shards: int = 65536, digest_bytes: int = 10, prefix: str = "event_dedup:b",
+                 fingerprint_digest_size: int = 32):
+        super().__init__(redis_client, ttl_seconds)
+        if not isinstance(bucket_seconds, int) or bucket_seconds <= 0:
+            raise ValueError("bucket_seconds должен быть положительным целым числом")
+        if not isinstance(shards, int) or shards <= 0:
+            raise ValueError("shards должен быть положительным целым числом")
+        if not isinstance(digest_bytes, int) or not 4 <= digest_bytes <= 28:
+            raise ValueError("digest_bytes должен быть целым числом от 4 до 28")
+        # Первые 4 байта дайджеста отпечатка выбирают шард (см. split), остальные - поле
+        if digest_bytes > fingerprint_digest_size - 4:
+            raise ValueError(f"digest_bytes ({digest_bytes}) больше остатка дайджеста отпечатка "
+                             f"({fingerprint_digest_size} - 4 байта на шард)")
+
+        self.bucket_seconds = bucket_seconds
+        self.shards = shards
+        self.digest_bytes = digest_bytes
+        self.prefix = prefix
+        # Текущая корзина + все предыдущие, которые еще не истекли
+        self.window_buckets = math.ceil(ttl_seconds / bucket_seconds) + 1
+
+    def split(self, fingerprint: str):
+        """Отпечаток -> (номер шарда, бинарное поле хэша)."""
+        digest = fingerprint_digest(fingerprint)
+        # Первые 4 байта выбирают шард, следующие digest_bytes хранятся как поле
+        shard = int.from_bytes(digest[:4], 'big') % self.shards
+        return shard, digest[4:4 + self.digest_bytes]
+
+    def bucket_key(self, bucket: int, shard: int) -> str:
+        return f"{self.prefix}:{bucket}:{shard}"
+
+    def bucket_expire_at(self, bucket: int) -> int:
+        return (bucket + 1) * self.bucket_seconds + self.ttl
+
+    @property
+    def window_seconds(self) -> int:
+        return self.ttl + self.bucket_seconds
+
+    def queue_add(self, pipe: Any, fingerprint: str, now: Optional[float] = None) -> None:
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        shard, field = self.split(fingerprint)
+        keys = [self.bucket_key(current - offset, shard) for offset in range(self.window_buckets)]
+        self._queue_script(pipe, keys, [field, self.bucket_expire_at(current), '0'])
+
+    def queue_mark(self, pipe: Any, fingerprint: str, now: Optional[float] = None) -> None:
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        shard, field = self.split(fingerprint)
+        self._queue_script(pipe, [self.bucket_key(current, shard)], [field, self.bucket_expire_at(current), '1'])
+
+    def queue_add_fresh(self, pipe: Any, fingerprint: str) -> None:
+        # Прошлые корзины не проверяются, текущая - проверяется
+        current = int(time.time() // self.bucket_seconds)
+        shard, field = self.split(fingerprint)
+        self._queue_script(pipe, [self.bucket_key(current, shard)], [field, self.bucket_expire_at(current), '0'])
+
+    def queue_restore(self, pipe: Any, fingerprint: str, seen_at: float, now: float) -> None:
+        # Отпечаток ложится в корзину момента seen_at и истекает вместе с ней
+        self.queue_mark(pipe, fingerprint, now=seen_at)
+
+    def queue_forget(self, pipe: Any, fingerprint: str) -> None:
+        # Корзина записи неизвестна - поле удаляется из всех корзин окна
+        current = int(time.time() // self.bucket_seconds)
+        shard, field = self.split(fingerprint)
+        for offset in range(self.window_buckets):
+            pipe.hdel(self.bucket_key(current - offset, shard), field)
+
+
+class RotatingBloomStorage(DedupStorage):
+    """
+    Вероятностное хранилище: Bloom-фильтры в битмапах Redis, по одному на
+    временную корзину (по умолчанию сутки), с ротацией как у
+    BucketedHashStorage:
+
+        event_dedup:bloom:<номер корзины>  ->  битмап из m бит
+
+    Ответ "новый" всегда точен, ответ "дубль" ошибочен с вероятностью около
+    error_rate (ложные дубли). Фильтр рассчитывается на expected_items
+    отпечатков за корзину; если их будет больше, доля ложных дублей растет.
+    Проверка идет по всем корзинам окна, поэтому error_rate делится между
+    ними: каждый фильтр строится под error_rate / window_buckets.
+    """
+
+    # KEYS: битмапы корзин окна, текущая - первой. ARGV[1]: EXPIREAT текущей корзины,
+    # ARGV[2]: '1' - записать без проверки (queue_mark), ARGV[3..]: номера бит.
+    SCRIPT = """
+if ARGV[2] ~= '1' then
+    for i = 1, #KEYS do
+        local seen = 1
+        for j = 3, #ARGV do
+            if redis.call('GETBIT', KEYS[i], ARGV[j]) == 0 then
+                seen = 0
+                break
+            end
+        end
+        if seen == 1 then
+            return 0
+        end
+    end
+end
+for j = 3, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[j], 1)
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[1])
+return 1
+"""
+
+    # Максимальный размер битмапа в Redis - 512 МБ
+    MAX_BITS = 2 ** 32
+
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int, expected_items: int,
+                 error_rate: float = 0.001, bucket_seconds: int = 86400, prefix: str = "event_dedup:bloom"):
+        super().__init__(redis_client, ttl_seconds)
+        if not isinstance(expected_items, int) or expected_items <= 0:
+            raise ValueError("expected_items должен быть положительным целым числом")
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate должен быть в интервале (0, 1)")
+        if not isinstance(bucket_seconds, int) or bucket_seconds <= 0:
+            raise ValueError("bucket_seconds должен быть положительным целым числом")
+
+        self.bucket_seconds = bucket_seconds
+        self.prefix = prefix
+        self.window_buckets = math.ceil(ttl_seconds / bucket_seconds) + 1
+        self.expected_items = expected_items
+        self.error_rate = error_rate
+
+        # Классические формулы: m = -n ln p / (ln 2)^2, k = m / n * ln 2
+        bucket_error_rate = error_rate / self.window_buckets
+        self.bits = math.ceil(-expected_items * math.log(bucket_error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.bits / expected_items * math.log(2)))
+        if self.bits > self.MAX_BITS:
+            raise ValueError(f"Фильтр на {expected_items} элементов требует {self.bits} бит - больше лимита битмапа Redis")
+
+    def positions(self, fingerprint: str) -> List[int]:
+        # Двойное хеширование (Кирш-Митценмахер): h1 + i * h2 по модулю m
+        digest = fingerprint_digest(fingerprint)
+        if len(digest) < 16:
+            digest = hashlib.blake2b(digest, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def bucket_key(self, bucket: int) -> str:
+        return f"{self.prefix}:{bucket}"
+
+    def bucket_expire_at(self, bucket: int) -> int:
+        return (bucket + 1) * self.bucket_seconds + self.ttl
+
+    @property
+    def window_seconds(self) -> int:
+        return self.ttl + self.bucket_seconds
+
+    def queue_add(self, pipe: Any, fingerprint: str, now: Optional[float] = None) -> None:
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        keys = [self.bucket_key(current - offset) for offset in range(self.window_buckets)]
+        self._queue_script(pipe, keys, [self.bucket_expire_at(current), '0', *self.positions(fingerprint)])
+
+    def queue_mark(self, pipe: Any, fingerprint: str, now: Optional[float] = None) -> None:
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        self._queue_script(pipe, [self.bucket_key(current)], [self.bucket_expire_at(current), '1', *self.positions(fingerprint)])
+
+    def queue_restore(self, pipe: Any, fingerprint: str, seen_at: float, now: float) -> None:
+        self.queue_mark(pipe, fingerprint, now=seen_at)
+
+    def forget_many(self, fingerprints: Sequence[str]) -> None:
+        # Биты фильтра общие для многих отпечатков и не удаляются: забытое событие
+        # останется ложным дублем до конца окна
+        if fingerprints:
+            logger.warning("Bloom-хранилище не умеет удалять отпечатки (%d не забыты)", len(fingerprints))
+
+
+class HybridStorage(DedupStorage):
+    """
+    Гибрид: Bloom-фильтр перед точным хранилищем.
+
+    Ответ фильтра "точно новый" проверяется в точном хранилище только
+    по текущей корзине (queue_add_fresh), ответ "возможно, уже был" -
+    по всему окну, поэтому ложных дублей нет. Запись в точное хранилище
+    в обоих случаях условная: из двух одновременных копий нового события
+    новой окажется одна. Два round-trip на пакет: фильтр, затем точное
+    хранилище.
+
+    Оба хранилища должны быть восстановлены вместе: пустой фильтр при
+    заполненном точном хранилище пропустит дубли как новые.
+    """
+
+    def __init__(self, bloom: RotatingBloomStorage, exact: DedupStorage):
+        super().__init__(exact.redis, exact.ttl)
+        self.bloom = bloom
+        self.exact = exact
+
+    def add_many(self, fingerprints: Sequence[str]) -> List[bool]:
+        if not fingerprints:
+            return []
+        definitely_new = self.bloom.add_many(fingerprints)
+
+        def build(pipe):
+            for fingerprint, is_new in zip(fingerprints, definitely_new):
+                if is_new:
+                    self.exact.queue_add_fresh(pipe, fingerprint)
+                else:
+                    self.exact.queue_add(pipe, fingerprint)
+
+        replies = self.exact.execute(build)
+        return [self.exact.parse_add(reply) for reply in replies]
+
+    async def add_many_async(self, fingerprints: Sequence[str]) -> List[bool]:
+        if not fingerprints:
+            return []
+        definitely_new = await self.bloom.add_many_async(fingerprints)
+
+        def build(pipe):
+            for fingerprint, is_new in zip(fingerprints, definitely_new):
+                if is_new:
+                    self.exact.queue_add_fresh(pipe, fingerprint)
+                else:
+                    self.exact.queue_add(pipe, fingerprint)
+
+        replies = await self.exact.execute_async(build)
+        return [self.exact.parse_add(reply) for reply in replies]
+
+    def restore_many(self, items: Sequence[Tuple[str, float]], now: Optional[float] = None) -> int:
+        # Фильтр и точное хранилище восстанавливаются вместе (см. docstring класса)
+        self.bloom.restore_many(items, now)
+        return self.exact.restore_many(items, now)
+
+    def touch_many(self, fingerprints: Sequence[str]) -> None:
+        self.bloom.touch_many(fingerprints)
+        self.exact.touch_many(fingerprints)
+
+    def forget_many(self, fingerprints: Sequence[str]) -> None:
+        # Фильтр отвечает "возможно, уже был", решает точное хранилище
+        self.exact.forget_many(fingerprints)
+
+    @property
+    def window_seconds(self) -> int:
+        # Дубль подтверждает точное хранилище
+        return self.exact.window_seconds
+
+
+class HashRing:
+    """
+    Консистентное хеширование: каждый узел занимает vnodes точек на
+    кольце 2^64, ключ принадлежит первому узлу по часовой стрелке.
+    При добавлении узла к нему переезжает примерно 1/N ключей, остальные
+    остаются на своих узлах. Положение узла зависит только от его имени.
+    """
+
+    def __init__(self, nodes: Sequence[str], vnodes: int = 160):
+        if not nodes:
+            raise ValueError("Кольцо должно содержать хотя бы один узел")
+        if len(set(nodes)) != len(nodes):
+            raise ValueError("Имена узлов кольца должны быть уникальны")
+        if not isinstance(vnodes, int) or vnodes <= 0:
+            raise ValueError("vnodes должен быть положительным целым числом")
+        points = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(vnodes)
+        )
+        self.nodes = list(nodes)
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardedStorage(DedupStorage):
+    """
+    Хранилище, разнесенное по нескольким Redis: у каждого узла свое
+    хранилище (любой раскладки) со своим пулом соединений, отпечаток
+    попадает на узел по консистентному хешированию (HashRing).
+
+    Пакет делится по узлам, и узлы опрашиваются параллельно: в потоках
+    для add_many (под eventlet - green threads), через asyncio.gather для
+    add_many_async. Ошибка любого узла пробрасывается наружу, как и в
+    остальных хранилищах.
+
+    Узлы добавляются без полного переезда: переедет ~1/N отпечатков, и
+    только они в течение одного TTL не будут распознаны как дубли.
+    """
+
+    def __init__(self, shards: Dict[str, DedupStorage], vnodes: int = 160):
+        if not shards:
+            raise ValueError("Нужен хотя бы один узел")
+        first = next(iter(shards.values()))
+        super().__init__(first.redis, first.ttl)
+        self.shards = dict(shards)
+        self.ring = HashRing(list(self.shards), vnodes=vnodes)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def node_for(self, fingerprint: str) -> str:
+        return self.ring.node_for(fingerprint)
+
+    def _split(self, fingerprints: Sequence[str]) -> Dict[str, Tuple[List[int], List[str]]]:
+        # узел -> (позиции во входном пакете, отпечатки)
+        groups: Dict[str, Tuple[List[int], List[str]]] = {}
+        for index, fingerprint in enumerate(fingerprints):
+            positions, items = groups.setdefault(self.node_for(fingerprint), ([], []))
+            positions.append(index)
+            items.append(fingerprint)
+        return groups
+
+    @staticmethod
+    def _merge(size: int, groups, replies) -> List[bool]:
+        results: List[bool] = [False] * size
+        for (positions, _), node_replies in zip(groups.values(), replies):
+            for index, reply in zip(positions, node_replies):
+                results[index] = reply
+        return results
+
+    def add_many(self, fingerprints: Sequence[str]) -> List[bool]:
+        if not fingerprints:
+            return []
+        groups = self._split(fingerprints)
+        if len(groups) == 1:
+            (node, (_, items)), = groups.items()
+            return self.shards[node].add_many(items)
+
+        futures = [self._pool().submit(self.shards[node].add_many, items) for node, (_, items) in groups.items()]
+        return self._merge(len(fingerprints), groups, [future.result() for future in futures])
+
+    async def add_many_async(self, fingerprints: Sequence[str]) -> List[bool]:
+        if not fingerprints:
+            return []
+        groups = self._split(fingerprints)
+        replies = await asyncio.gather(
+            *[self.shards[node].add_many_async(items) for node, (_, items) in groups.items()]
+        )
+        return self._merge(len(fingerprints), groups, replies)
+
+    def restore_many(self, items: Sequence[Tuple[str, float]], now: Optional[float] = None) -> int:
+        if not items:
+            return 0
+        groups = self._split([fingerprint for fingerprint, _ in items])
+        futures = [
+            self._pool().submit(self.shards[node].restore_many, [items[index] for index in positions], now)
+            for node, (positions, _) in groups.items()
+        ]
+        return sum(future.result() for future in futures)
+
+    def touch_many(self, fingerprints: Sequence[str]) -> None:
+        self._each_node('touch_many', fingerprints)
+
+    def forget_many(self, fingerprints: Sequence[str]) -> None:
+        self._each_node('forget_many', fingerprints)
+
+    def _each_node(self, method: str, fingerprints: Sequence[str]) -> None:
+        groups = self._split(fingerprints)
+        futures = [self._pool().submit(getattr(self.shards[node], method), items) for node, (_, items) in groups.items()]
+        for future in futures:
+            future.result()
+
+    @property
+    def window_seconds(self) -> int:
+        return max(storage.window_seconds for storage in self.shards.values())
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="dedup-shard")
+        return self._executor
+
+
+def build_storage(layout: str, redis_client: redis.Redis, ttl_seconds: int, **options) -> DedupStorage:
+    """
+    Создает хранилище по имени раскладки ('string', 'bucketed', 'bloom', 'hybrid').
+    options - параметры раскладок, лишние игнорируются:
+    bucket_seconds, shards, digest_bytes, fingerprint_digest_size (длина дайджеста отпечатка в
+    байтах), bloom_expected_items, bloom_error_rate, exact_layout, async_max_connections,
+    prefix (префикс ключей, по умолчанию event_dedup).
+    """
+    storage = _build_layout(layout, redis_client, ttl_seconds, **options)
+    if 'async_max_connections' in options:
+        storage.async_max_connections = options['async_max_connections']
+    return storage
+
+
+def _build_layout(layout: str, redis_client: redis.Redis, ttl_seconds: int, **options) -> DedupStorage:
+    prefix = options.get('prefix', 'event_dedup')
+    if layout == 'string':
+        return StringKeyStorage(redis_client, ttl_seconds, prefix=prefix)
+    if layout == 'bucketed':
+        return BucketedHashStorage(
+            redis_client,
+            ttl_seconds,
+            bucket_seconds=options.get('bucket_seconds', 86400),
+            shards=options.get('shards', 65536),
+            digest_bytes=options.get('digest_bytes', 10),
+            prefix=f"{prefix}:b",
+            fingerprint_digest_size=options.get('fingerprint_digest_size', 32),
+        )
+    if layout == 'bloom':
+        return RotatingBloomStorage(
+            redis_client,
+            ttl_seconds,
+            expected_items=options['bloom_expected_items'],
+            error_rate=options.get('bloom_error_rate', 0.001),
+            bucket_seconds=options.get('bucket_seconds', 86400),
+            prefix=f"{prefix}:bloom",
+        )
+    if layout == 'hybrid':
+        exact_layout = options.get('exact_layout', 'string')
+        if exact_layout not in ('string', 'bucketed'):
+            raise ValueError(f"Точное хранилище гибрида должно быть 'string' или 'bucketed', а не {exact_layout!r}")
+        return HybridStorage(
+            bloom=build_storage('bloom', redis_client, ttl_seconds, **options),
+            exact=build_storage(exact_layout, redis_client, ttl_seconds, **options),
+        )
+    raise ValueError(f"Неизвестная раскладка хранилища: {layout!r}")
+
+
+def build_sharded_storage(layout: str, node_urls: Sequence[str], ttl_seconds: int,
+                          vnodes: int = 160, redis_options: Optional[Dict[str, Any]] = None,
+                          clients: Optional[Dict[str, redis.Redis]] = None, **options) -> ShardedStorage:
+    """
+    ShardedStorage поверх Redis-узлов из node_urls (redis://host:port/db).
+    На каждом узле - своя раскладка layout с теми же options. URL узла -
+    его имя на кольце: при смене адреса узла его отпечатки переедут.
+    redis_options - дополнительные параметры клиентов узлов (таймауты и т.п.).
+    clients - уже созданные клиенты узлов (URL -> клиент): так несколько
+    хранилищ (например, политик дедупликации) делят пулы соединений.
+    """
+    shards = {}
+    for url in node_urls:
+        client = (clients or {}).get(url) or redis.Redis.from_url(url, decode_responses=True, **(redis_options or {}))
+        shards[url] = build_storage(layout, client, ttl_seconds, **options)
+    return ShardedStorage(shards, vnodes=vnodes)
@@ -1,9 +1,18 @@
 
 import logging
+import random
+import time
+from datetime import timedelta
 from celery import shared_task
+from celery.exceptions import Retry
+from celery.signals import before_task_publish, worker_process_shutdown, worker_ready, worker_shutdown
 from django.conf import settings
 from django.utils import timezone
 from .models import UniqueEvent
+from . import metrics, partitions
+from .eventlog import event_log
+from .transport import send_task
+from .writer import UniqueEventWriter, drain_duplicate_hits
 try:
     import redis
 except ImportError:
@@ -18,8 +27,44 @@ if not event_deduplicator:
 else:
     logger.info("Воркер Celery: Event Deduplicator успешно получен из settings.")
 
+# Буфер уникальных событий: пишет в БД пачками вместо INSERT на каждое событие
+unique_event_writer = UniqueEventWriter(
+    batch_size=settings.DEDUPLICATOR_WRITER_BATCH_SIZE,
+    flush_interval=settings.DEDUPLICATOR_WRITER_FLUSH_INTERVAL,
+    linger=settings.DEDUPLICATOR_WRITER_LINGER,
+)
 
-@shared_task(bind=True, ignore_result=True)
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def flush_unique_event_writer(**kwargs):
+    # При остановке воркера дописываем все, что накопилось в буфере
+    logger.info("Остановка воркера: сброс буфера (%s событий)...", unique_event_writer.pending())
+    unique_event_writer.close()
+    # Дочерние процессы prefork завершаются без atexit: повторы сбрасываются здесь
+    if event_deduplicator and event_deduplicator.duplicate_hits is not None:
+        event_deduplicator.duplicate_hits.flush()
+
+
+# Заголовок сообщения Celery с моментом постановки в очередь (для dedup_queue_lag_seconds)
+ENQUEUED_AT_HEADER = 'dedup_enqueued_at'
+
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers[ENQUEUED_AT_HEADER] = time.time()
+
+
+def _observe_queue_lag(task):
+    enqueued_at = getattr(task.request, ENQUEUED_AT_HEADER, None)
+    if enqueued_at is not None:
+        metrics.QUEUE_LAG_SECONDS.observe(max(0.0, time.time() - enqueued_at), 'celery')
+
+
+# acks_late: сообщение подтверждается после записи уникальных событий в БД, поэтому при
+# падении воркера задача будет доставлена повторно (см. _redelivered)
+@shared_task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
 def process_event(self, event_data):
     """
     Задача Celery для обработки и дедупликации события.
@@ -27,50 +72,232 @@ def process_event(self, event_data):
     Выполняется синхронно, но конкурентно с помощью eventlet.
     """
     task_id = self.request.id
-    logger.info(f"[Task ID: {task_id}] Получено событие для обработки: {str(event_data)[:100]}...")
-
-    # --- ДОБАВИЛИ ЛОГ ПРОВЕРКИ НАСТРОЕК БД СЮДА ---
-    try:
-        db_settings = settings.DATABASES.get('default', {})
-        logger.info(
-            f"[Task ID: {task_id}] Задача видит настройки БД: ENGINE={db_settings.get('ENGINE')}, HOST={db_settings.get('HOST')}, NAME={db_settings.get('NAME')}")
-    except Exception as e:
-        logger.error(f"[Task ID: {task_id}] Задача не может получить настройки БД: {e}")
-    # ---------------------------------------------
+    _observe_queue_lag(self)
+    # Строки на событие - через event_log: в 'production' пишется только выборка,
+    # а %-аргументы форматируются, только если запись действительно выводится
+    event_log.event(logger, logging.INFO, "[Task ID: %s] Получено событие для обработки: %.100s...", task_id, event_data)
 
     if not event_deduplicator:
-        logger.error(f"[Task ID: {task_id}] Дедупликатор не доступен, обработка прервана.")
+        logger.error("[Task ID: %s] Дедупликатор не доступен, обработка прервана.", task_id)
         return
 
+    _handle_event(self, event_data)
+
+
+def _check_or_retry(task, check, payload):
+    """
+    Вызывает проверку на дубли (check_duplication или check_duplication_many)
+    с учетом DEDUPLICATOR_DEGRADED_MODE на случай недоступности Redis:
+      'db'    - fail-open: события считаются новыми;
+      'retry' - задача откладывается (Celery retry) до восстановления Redis,
+                после DEDUPLICATOR_DEGRADED_RETRY_MAX повторов - как 'db'.
+    """
+    if settings.DEDUPLICATOR_DEGRADED_MODE != 'retry' or task.request.retries >= settings.DEDUPLICATOR_DEGRADED_RETRY_MAX:
+        return check(payload)
+    try:
+        return check(payload, fail_open=False)
+    except redis.RedisError as e:
+        # Разброс, чтобы отложенные задачи не вернулись в Redis все разом
+        delay = event_deduplicator.redis_retry_after(settings.DEDUPLICATOR_BREAKER_RESET_TIMEOUT)
+        countdown = delay + random.uniform(0, delay)
+        logger.warning("[Task ID: %s] Redis недоступен, проверка отложена на %.1f с (повтор %s): %s",
+                       task.request.id, countdown, task.request.retries + 1, e)
+        # Повтор - в JSON: сериализатор задач может не закодировать аргументы (см. transport.send_task)
+        raise task.retry(exc=e, countdown=countdown, max_retries=settings.DEDUPLICATOR_DEGRADED_RETRY_MAX,
+                         serializer='json')
+
+
+def _handle_event(task, event_data):
+    """
+    Дедупликация одного события и сохранение его в БД, если оно уникально.
+    """
+    task_id = task.request.id
     if not isinstance(event_data, dict):
-        logger.warning(f"[Task ID: {task_id}] Получены некорректные данные (не словарь): {type(event_data)}. Задача пропущена.")
+        logger.warning("[Task ID: %s] Получены некорректные данные (не словарь): %s. Задача пропущена.",
+                       task_id, type(event_data))
         return
 
     try:
-        logger.debug(f"[Task ID: {task_id}] Вызов event_deduplicator.check_duplication...")
-        is_duplicate, fingerprint = event_deduplicator.check_duplication(event_data)
-        logger.debug(f"[Task ID: {task_id}] Вызов check_duplication завершен.")
+        is_duplicate, fingerprint = _check_or_retry(task, event_deduplicator.check_duplication, event_data)
 
-        if is_duplicate:
-            logger.info(f"[Task ID: {task_id}] Обнаружен дубль события. Fingerprint: {fingerprint}")
+        if is_duplicate and fingerprint is not None and _redelivered(task):
+            # Отпечаток мог записать сам упавший воркер, не успев сохранить событие
+            _persist(task_id, [(fingerprint, event_data)], recheck=True)
+        elif is_duplicate:
+            event_log.count('task.duplicate')
+            event_log.event(logger, logging.INFO, "[Task ID: %s] Обнаружен дубль события. Fingerprint: %s",
+                            task_id, fingerprint)
         else:
-            logger.info(f"[Task ID: {task_id}] Уникальное событие обработано. Fingerprint: {fingerprint}")
-
-            # --- БЛОК СОХРАНЕНИЯ В БД ---
-            try:
-                # Создаем и сохраняем объект в БД
-                UniqueEvent.objects.create(
-                    fingerprint=fingerprint,
-                    event_data=event_data
-                )
-                logger.info(f"[Task ID: {task_id}] Уникальное событие СОХРАНЕНО в БД. Fingerprint: {fingerprint}")
-            except Exception as db_err:
-                # Ловим возможные ошибки БД
-                logger.exception(f"[Task ID: {task_id}] Ошибка при сохранении события в БД (Fingerprint: {fingerprint}): {db_err}")
-
-            # -----------------------------------------
+            event_log.count('task.unique')
+            event_log.event(logger, logging.INFO, "[Task ID: %s] Уникальное событие обработано. Fingerprint: %s",
+                            task_id, fingerprint)
+            _persist(task_id, [(fingerprint, event_data)])
 
+    except Retry:
+        raise
     except redis.RedisError as redis_err:
-         logger.error(f"[Task ID: {task_id}] Ошибка Redis при обработке события: {redis_err}.")
+         logger.error("[Task ID: %s] Ошибка Redis при обработке события: %s.", task_id, redis_err)
+    except Exception as e:
+        logger.exception("[Task ID: %s] Непредвиденная ошибка при обработке события: %s", task_id, e)
+
+
+def _redelivered(task):
+    # Redis-брокер помечает так сообщения, возвращенные в очередь неподтвержденными
+    return bool((task.request.delivery_info or {}).get('redelivered'))
+
+
+def _persist(task_id, rows, recheck=False):
+    """
+    Записывает уникальные события пачкой с событиями других задач (см.
+    UniqueEventWriter) и ждет записи. Если БД недоступна, незаписанные
+    события уходят в persist_unique_events с задержкой, а если не удалось
+    и это - их отпечатки удаляются из Redis, чтобы следующая копия
+    события не считалась дублем. recheck - события могли быть записаны
+    раньше (см. writer.save_unique_events).
+    """
+    unwritten = unique_event_writer.write(rows, recheck)
+    if not unwritten:
+        event_log.event(logger, logging.DEBUG, "[Task ID: %s] Сохранено уникальных событий: %d", task_id, len(rows))
+        return
+    logger.warning("[Task ID: %s] БД недоступна, %d событий будут записаны повторно через %.1f с",
+                   task_id, len(unwritten), settings.DEDUPLICATOR_WRITER_RETRY_DELAY)
+    try:
+        # Сбой мог случиться после COMMIT: при повторе события проверяются по БД
+        send_task(persist_unique_events, {'events': unwritten, 'recheck': True}, countdown=settings.DEDUPLICATOR_WRITER_RETRY_DELAY,
+                  serializer='json')
+    except Exception as e:
+        logger.error("[Task ID: %s] Не удалось отложить запись %d событий: %s", task_id, len(unwritten), e)
+        _forget(task_id, unwritten)
+
+
+def _forget(task_id, rows):
+    try:
+        event_deduplicator.forget_many(rows)
+    except Exception as e:
+        logger.error("[Task ID: %s] Не удалось удалить из Redis отпечатки %d несохраненных событий: %s",
+                     task_id, len(rows), e)
+        return
+    logger.error("[Task ID: %s] %d событий не сохранены в БД, их отпечатки удалены из Redis", task_id, len(rows))
+
+
+@shared_task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def process_events_batch(self, events):
+    """
+    Задача Celery для обработки чанка событий, принятых пакетным запросом.
+    Одна задача (и одно сообщение брокеру) на чанк вместо одной на событие.
+    """
+    task_id = self.request.id
+    _observe_queue_lag(self)
+    event_log.event(logger, logging.INFO, "[Task ID: %s] Получен чанк из %d событий для обработки.", task_id, len(events))
+
+    if not event_deduplicator:
+        logger.error("[Task ID: %s] Дедупликатор не доступен, обработка чанка прервана.", task_id)
+        return
+
+    try:
+        # Все события чанка проверяются одним pipeline в Redis
+        results = _check_or_retry(self, event_deduplicator.check_duplication_many, events)
+    except Retry:
+        raise
+    except Exception as e:
+        logger.exception("[Task ID: %s] Непредвиденная ошибка при пакетной дедупликации: %s", task_id, e)
+        return
+
+    redelivered = _redelivered(self)
+    duplicates = unique = 0
+    rows, seen = [], set()
+    for event_data, (is_duplicate, fingerprint) in zip(events, results):
+        if fingerprint is None:
+            logger.warning("[Task ID: %s] Событие пропущено: не удалось получить отпечаток.", task_id)
+        elif is_duplicate and not (redelivered and fingerprint not in seen):
+            duplicates += 1
+            event_log.event(logger, logging.DEBUG, "[Task ID: %s] Обнаружен дубль события. Fingerprint: %s",
+                            task_id, fingerprint)
+        else:
+            unique += 1
+            seen.add(fingerprint)
+            rows.append((fingerprint, event_data))
+    _persist(task_id, rows, recheck=redelivered)
+
+    event_log.count('task.duplicate', duplicates)
+    event_log.count('task.unique', unique)
+    event_log.event(logger, logging.INFO, "[Task ID: %s] Чанк обработан: %d событий, дублей %d.",
+                    task_id, len(events), duplicates)
+
+
+@shared_task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def persist_unique_events(self, events, recheck=False):
+    """
+    Задача Celery только для сохранения: события уже проверены на дубли
+    (синхронным эндпоинтом check_event_inline_api или задачей, которой не
+    удалось записать их в БД). events - список пар [fingerprint, event_data].
+    Пока БД недоступна, задача повторяется; после
+    DEDUPLICATOR_WRITER_RETRY_MAX повторов отпечатки удаляются из Redis.
+    recheck - события могли быть записаны раньше (повтор после сбоя).
+    """
+    task_id = self.request.id
+    _observe_queue_lag(self)
+    unwritten = unique_event_writer.write([(fingerprint, event_data) for fingerprint, event_data in events],
+                                          recheck or self.request.retries > 0 or _redelivered(self))
+    event_log.count('task.persisted', len(events) - len(unwritten))
+    if not unwritten:
+        event_log.event(logger, logging.DEBUG, "[Task ID: %s] Сохранено уникальных событий: %d", task_id, len(events))
+        return
+    if self.request.retries >= settings.DEDUPLICATOR_WRITER_RETRY_MAX:
+        _forget(task_id, unwritten)
+        return
+    logger.warning("[Task ID: %s] БД недоступна, запись %d событий повторится (повтор %d)",
+                   task_id, len(unwritten), self.request.retries + 1)
+    raise self.retry(kwargs={'events': unwritten, 'recheck': True}, countdown=settings.DEDUPLICATOR_WRITER_RETRY_DELAY,
+                     max_retries=settings.DEDUPLICATOR_WRITER_RETRY_MAX, serializer='json')
+
+
+@shared_task(ignore_result=True)
+def maintain_event_partitions():
+    """
+    Создает дневные секции таблицы UniqueEvent наперед (см. deduplicator/partitions.py).
+    Запускается по расписанию beat и при старте воркера. Старые секции
+    удаляет команда cleanup_old_events.
+    """
+    if not partitions.is_partitioned():
+        return
+    created = partitions.ensure_partitions(settings.DEDUPLICATOR_PARTITION_DAYS_AHEAD)
+    if created:
+        logger.info("Созданы секции UniqueEvent: %s", ', '.join(created))
+
+
+@shared_task(ignore_result=True)
+def flush_duplicate_hits():
+    """
+    Переносит счетчики повторов из Redis в UniqueEvent.duplicate_count и
+    last_seen_at (см. deduplicator/hits.py). Запускается по расписанию beat.
+    """
+    duplicate_hits = event_deduplicator.duplicate_hits if event_deduplicator else None
+    if duplicate_hits is None or not duplicate_hits.count:
+        return
+    grace = settings.DEDUPLICATOR_DUPLICATE_HITS_GRACE_SECONDS
+    since = None
+    if not duplicate_hits.sliding:
+        # Строка события не старше окна дедупликации на момент повтора, а повтор
+        # ждет переноса не дольше grace: более старые секции можно не смотреть
+        since = timezone.now() - timedelta(seconds=event_deduplicator.policies.max_window + grace)
+    saved, requeued, dropped = drain_duplicate_hits(duplicate_hits, since=since, grace_seconds=grace)
+    if saved or requeued or dropped:
+        logger.info("Повторы перенесены в БД: %s, ждут строку события: %s, отброшены: %s", saved, requeued, dropped)
+
+
+@worker_ready.connect
+def log_worker_database(**kwargs):
+    # Настройки БД выводятся один раз при старте воркера, а не в каждой задаче
+    db_settings = settings.DATABASES.get('default', {})
+    logger.info("Воркер пишет в БД: ENGINE=%s, HOST=%s, NAME=%s",
+                db_settings.get('ENGINE'), db_settings.get('HOST'), db_settings.get('NAME'))
+
+
+@worker_ready.connect
+def ensure_event_partitions(**kwargs):
+    # Секции создаются и без beat: при каждом старте воркера
+    try:
+        maintain_event_partitions()
     except Exception as e:
-        logger.exception(f"[Task ID: {task_id}] Непредвиденная ошибка при обработке события: {e}")
\ No newline at end of file
+        logger.exception("Не удалось создать секции UniqueEvent при старте воркера: %s", e)
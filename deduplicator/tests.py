@@ -1,3 +1,407 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import io
+import json
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import fakeredis
+import redis
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from .admission import TokenBucketLimiter
+from .cache import FingerprintCache
+from .circuit import CircuitBreaker, CircuitOpenError
+from .fingerprint import build_fingerprinter
+from .models import UniqueEvent
+from .partitions import drop_expired_partitions, ensure_partitions, list_partitions
+from .parsers import BoundedJSONParser, RequestBodyTooLarge
+from .policies import DedupPolicy, PolicyRegistry
+from .storage import HashRing, ShardedStorage, build_storage
+from .views import _check_event_batch, _decode_cursor, _encode_cursor
+from .writer import UniqueEventWriter
+
+
+FINGERPRINT = 'ab' * 32
+KEY_FIELDS = ['event_name', 'userId']
+
+
+class FingerprintCacheTests(SimpleTestCase):
+    def test_entry_expires_after_ttl(self):
+        cache = FingerprintCache(max_size=10, ttl_seconds=60)
+        with mock.patch('deduplicator.cache.time.monotonic', return_value=1000.0):
+            cache.add(FINGERPRINT)
+            self.assertTrue(cache.contains(FINGERPRINT))
+        with mock.patch('deduplicator.cache.time.monotonic', return_value=1060.0):
+            self.assertFalse(cache.contains(FINGERPRINT))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = FingerprintCache(max_size=2, ttl_seconds=60)
+        self.assertEqual(cache.add('a'), 0)
+        self.assertEqual(cache.add('b'), 0)
+        # Обращение к 'a' делает вытесняемым 'b'
+        self.assertTrue(cache.contains('a'))
+        self.assertEqual(cache.add('c'), 1)
+        self.assertTrue(cache.contains('a'))
+        self.assertFalse(cache.contains('b'))
+        self.assertTrue(cache.contains('c'))
+
+    def test_discard(self):
+        cache = FingerprintCache(max_size=2, ttl_seconds=60)
+        cache.add(FINGERPRINT)
+        cache.discard(FINGERPRINT)
+        cache.discard(FINGERPRINT)
+        self.assertFalse(cache.contains(FINGERPRINT))
+
+
+class ShardedStorageTests(SimpleTestCase):
+    def test_ring_is_stable_and_moves_few_keys(self):
+        keys = [f"key-{i}" for i in range(2000)]
+        ring = HashRing(['a', 'b', 'c'])
+        self.assertEqual([ring.node_for(key) for key in keys],
+                         [HashRing(['c', 'a', 'b']).node_for(key) for key in keys])
+
+        grown = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if ring.node_for(key) != grown.node_for(key)]
+        # Переезжают только ключи нового узла, примерно 1/4
+        self.assertTrue(all(grown.node_for(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+    def test_ring_rejects_bad_nodes(self):
+        with self.assertRaises(ValueError):
+            HashRing([])
+        with self.assertRaises(ValueError):
+            HashRing(['a', 'a'])
+
+    def test_fingerprints_routed_to_ring_node(self):
+        clients = {node: fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True) for node in 'abc'}
+        storage = ShardedStorage({node: build_storage('string', client, 3600) for node, client in clients.items()})
+        fingerprints = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(30)]
+
+        self.assertEqual(storage.add_many(fingerprints), [True] * 30)
+        self.assertEqual(storage.add_many(fingerprints[:5] + [FINGERPRINT]), [False] * 5 + [True])
+        for fingerprint in fingerprints:
+            owners = [node for node, client in clients.items() if client.exists(f"event_dedup:{fingerprint}")]
+            self.assertEqual(owners, [storage.node_for(fingerprint)])
+
+
+class UniqueEventWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        patcher = mock.patch('deduplicator.writer.write_unique_events',
+                             side_effect=lambda batch, recheck=False: (self.batches.append(batch) or len(batch), []))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_linger_collects_a_full_batch(self):
+        writer = UniqueEventWriter(batch_size=2, flush_interval=60, linger=30)
+        leader = threading.Thread(target=writer.write, args=([('a', {})],))
+        started = time.monotonic()
+        leader.start()
+        time.sleep(0.05)
+        # Вторая задача дополняет пачку до batch_size: ведущий не ждет весь linger
+        self.assertEqual(writer.write([('b', {})]), [])
+        leader.join()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.batches, [[('a', {}), ('b', {})]])
+
+    def test_linger_expires(self):
+        writer = UniqueEventWriter(batch_size=10, flush_interval=60, linger=0.05)
+        self.assertEqual(writer.write([('a', {})]), [])
+        self.assertEqual(self.batches, [[('a', {})]])
+
+    def test_without_linger_writes_at_once(self):
+        writer = UniqueEventWriter(batch_size=10, flush_interval=60)
+        writer.write([('a', {})])
+        writer.write([('b', {})])
+        self.assertEqual(self.batches, [[('a', {})], [('b', {})]])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'секционирование есть только в PostgreSQL')
+class PartitionMaintenanceTests(TestCase):
+    # Дни далеко впереди: секций на них нет ни после миграции 0003, ни от beat
+    NOW = datetime.datetime(2030, 1, 10, 12, tzinfo=datetime.timezone.utc)
+
+    def count_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM "{table}"')
+            return cursor.fetchone()[0]
+
+    def test_ensure_partitions_moves_rows_from_default(self):
+        UniqueEvent.objects.create(fingerprint=FINGERPRINT, event_data={},
+                                   received_at=self.NOW + datetime.timedelta(days=1))
+        self.assertEqual(self.count_rows('deduplicator_uniqueevent_default'), 1)
+
+        created = ensure_partitions(1, now=self.NOW)
+
+        self.assertEqual(created, ['deduplicator_uniqueevent_p20300110', 'deduplicator_uniqueevent_p20300111'])
+        self.assertEqual(ensure_partitions(1, now=self.NOW), [])
+        self.assertEqual(self.count_rows('deduplicator_uniqueevent_default'), 0)
+        self.assertEqual(self.count_rows('deduplicator_uniqueevent_p20300111'), 1)
+        self.assertTrue(UniqueEvent.objects.filter(fingerprint=FINGERPRINT).exists())
+
+    def test_drop_expired_partitions(self):
+        ensure_partitions(1, now=self.NOW)
+
+        dropped = drop_expired_partitions(self.NOW + datetime.timedelta(hours=12))
+
+        self.assertIn('deduplicator_uniqueevent_p20300110', dropped)
+        self.assertNotIn('deduplicator_uniqueevent_p20300111', dropped)
+        names = [name for name, _, _ in list_partitions()]
+        self.assertNotIn('deduplicator_uniqueevent_p20300110', names)
+        self.assertIn('deduplicator_uniqueevent_p20300111', names)
+        self.assertIn('deduplicator_uniqueevent_default', names)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('deduplicator.circuit.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, name='test')
+
+    def fail(self):
+        def broken():
+            raise redis.ConnectionError("down")
+        with self.assertRaises(redis.ConnectionError):
+            self.breaker.call(broken)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(lambda: 'ok')
+        self.assertEqual(self.breaker.rejected, 1)
+        self.assertEqual(self.breaker.retry_after(), 10)
+
+    def test_success_resets_failure_count(self):
+        self.fail()
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.fail()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_response_error_means_redis_is_alive(self):
+        def rejected():
+            raise redis.ResponseError("WRONGTYPE")
+        for _ in range(3):
+            with self.assertRaises(redis.ResponseError):
+                self.breaker.call(rejected)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe(self):
+        self.fail()
+        self.fail()
+        self.now += 10
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        # Пока пробный вызов не завершен, остальные отклоняются
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.trips, 2)
+
+        self.now += 10
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+class PolicyRegistryTests(SimpleTestCase):
+    def setUp(self):
+        client = fakeredis.FakeRedis(decode_responses=True)
+
+        def policy(name, ttl):
+            return DedupPolicy(name, KEY_FIELDS, ttl, build_storage('string', client, ttl, prefix=name),
+                               build_fingerprinter(KEY_FIELDS))
+
+        self.default = policy('default', 3600)
+        self.login = policy('login', 60)
+        self.registry = PolicyRegistry(self.default, [self.login])
+
+    def test_resolve_by_field_value(self):
+        self.assertIs(self.registry.resolve({'event_name': 'login'}), self.login)
+        self.assertIs(self.registry.resolve({'event_name': 'purchase'}), self.default)
+        self.assertIs(self.registry.resolve({'userId': 1}), self.default)
+        self.assertIs(self.registry.resolve({'event_name': ['login']}), self.default)
+        self.assertEqual((self.registry.min_ttl, self.registry.max_ttl), (60, 3600))
+
+    def test_duplicate_policy_name(self):
+        with self.assertRaises(ValueError):
+            PolicyRegistry(self.default, [self.login, self.login])
+
+
+class FingerprintTests(SimpleTestCase):
+    EVENT = {'event_name': 'login', 'userId': 42, 'client_id': 'web'}
+
+    def test_legacy_matches_sha256_of_sorted_json(self):
+        expected = hashlib.sha256(
+            json.dumps({'event_name': 'login', 'userId': 42}, sort_keys=True, separators=(',', ':')).encode()
+        ).hexdigest()
+        self.assertEqual(build_fingerprinter(KEY_FIELDS)(self.EVENT), expected)
+        self.assertEqual(build_fingerprinter(['userId', 'event_name'], 'sha256-json')(self.EVENT), expected)
+
+    def test_v2_is_stable(self):
+        # Смена кодировки v2 сбросит окно дедупликации: значения зафиксированы
+        self.assertEqual(build_fingerprinter(KEY_FIELDS, 'sha256')(self.EVENT),
+                         'v2-sha256:82a5faa6d722aabed5cd5a7f7c3eefb0dbfd81388b5ec90f2a015c663918b246')
+        self.assertEqual(build_fingerprinter(KEY_FIELDS, 'blake2b', 16)(self.EVENT),
+                         'v2-b2b16:00c5afafcac465ccacbe473aba5f8f5d')
+
+    def test_v2_separates_values(self):
+        fingerprint = build_fingerprinter(['a', 'b'], 'sha256')
+        self.assertNotEqual(fingerprint({'a': 'x', 'b': 'yz'}), fingerprint({'a': 'xy', 'b': 'z'}))
+        self.assertNotEqual(fingerprint({'a': 1}), fingerprint({'a': '1'}))
+        self.assertNotEqual(fingerprint({'a': 1}), fingerprint({'a': True}))
+
+
+@override_settings(ADMISSION_CONTROLLER=None, DEDUPLICATOR_INGEST_DEDUP=False, DEDUPLICATOR_BATCH_CHUNK_SIZE=2,
+                   DEDUPLICATOR_BATCH_MAX_ITEMS=10)
+class CheckEventBatchTests(SimpleTestCase):
+    def test_mixed_valid_and_invalid_events(self):
+        events = [{'event_name': 'a'}, 'text', {}, {'event_name': 'b'}, {'event_name': 'c'}, None]
+        with mock.patch('deduplicator.views.enqueue_events') as enqueue:
+            response = _check_event_batch(events)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual([call.args[0] for call in enqueue.call_args_list],
+                         [[{'event_name': 'a'}, {'event_name': 'b'}], [{'event_name': 'c'}]])
+        self.assertEqual((response.data['accepted'], response.data['rejected']), (3, 3))
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['accepted', 'rejected', 'rejected', 'accepted', 'accepted', 'rejected'])
+        self.assertEqual([result['index'] for result in response.data['results']], list(range(6)))
+
+    def test_failed_chunk_rejects_only_its_events(self):
+        events = [{'event_name': str(i)} for i in range(3)]
+        with mock.patch('deduplicator.views.enqueue_events', side_effect=[None, redis.ConnectionError()]):
+            response = _check_event_batch(events)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['accepted', 'accepted', 'rejected'])
+
+    def test_all_chunks_failed(self):
+        with mock.patch('deduplicator.views.enqueue_events', side_effect=redis.ConnectionError()):
+            response = _check_event_batch([{'event_name': 'a'}, 'text'])
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @override_settings(DEDUPLICATOR_INGEST_DEDUP=True)
+    def test_unfingerprintable_events(self):
+        with mock.patch('deduplicator.views.ingest_events', return_value=[(False, None)]):
+            response = _check_event_batch([{'event_name': 'a'}, 'text'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['results'][0]['error'], 'Failed to fingerprint event.')
+
+    def test_only_invalid_events(self):
+        with mock.patch('deduplicator.views.enqueue_events') as enqueue:
+            response = _check_event_batch([1, []])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        enqueue.assert_not_called()
+
+    def test_too_many_events(self):
+        response = _check_event_batch([{'event_name': 'a'}] * 11)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        received_at = datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc)
+        cursor = _encode_cursor(received_at, 12345)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(_decode_cursor(cursor), (received_at, 12345))
+
+    def test_invalid_cursor(self):
+        for cursor in ('', 'not base64!', 'WyJ4IiwxXQ', 'WyIyMDI0LTA1LTAxIiwiMSJd'):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    _decode_cursor(cursor)
+
+
+class ListEventsPaginationTests(TestCase):
+    def test_pages_cover_rows_with_equal_received_at(self):
+        received_at = datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone.utc)
+        ids = [
+            UniqueEvent.objects.create(fingerprint=f'{FINGERPRINT}{i}', event_data={'seq': i},
+                                       received_at=received_at + datetime.timedelta(seconds=i // 2)).id
+            for i in range(5)
+        ]
+        seen, cursor = [], ''
+        while cursor is not None:
+            response = self.client.get(reverse('events'), {'limit': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen += [row['id'] for row in response.json()['results']]
+            cursor = response.json()['next_cursor']
+        self.assertEqual(seen, [ids[4], ids[3], ids[2], ids[1], ids[0]])
+
+
+class TokenBucketLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        # fakeredis не знает redis.replicate_commands(); в Redis 5+ вызов ничего не делает
+        script = TokenBucketLimiter.SCRIPT.replace('redis.replicate_commands()\n', '')
+        patcher = mock.patch.object(TokenBucketLimiter, 'SCRIPT', script)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = TokenBucketLimiter(self.redis, rate=1, burst=3)
+
+    def test_burst_then_throttled(self):
+        granted = self.limiter.acquire({'web': 2, 'ios': 5})
+        self.assertEqual(granted['web'], (2, 0.0))
+        admitted, wait = granted['ios']
+        self.assertEqual(admitted, 3)
+        # Оставшимся двум событиям нужно два токена при скорости 1 в секунду
+        self.assertAlmostEqual(wait, 2, places=2)
+
+        admitted, wait = self.limiter.acquire({'web': 2})['web']
+        self.assertEqual(admitted, 1)
+        self.assertGreater(wait, 0)
+        self.assertGreater(self.redis.ttl('event_dedup:ratelimit:web'), 0)
+
+    def test_tokens_refill(self):
+        self.limiter.acquire({'web': 3})
+        state = self.redis.hgetall('event_dedup:ratelimit:web')
+        self.redis.hset('event_dedup:ratelimit:web', 'ts', str(float(state['ts']) - 2))
+        self.assertEqual(self.limiter.acquire({'web': 3})['web'][0], 2)
+
+
+@override_settings(DEDUPLICATOR_BATCH_MAX_BODY_BYTES=16)
+class BoundedJSONParserTests(SimpleTestCase):
+    def test_body_within_limit(self):
+        self.assertEqual(BoundedJSONParser().parse(io.BytesIO(b'{"a": 1}')), {'a': 1})
+
+    def test_body_over_limit(self):
+        with self.assertRaises(RequestBodyTooLarge):
+            BoundedJSONParser().parse(io.BytesIO(b'{"a": "' + b'x' * 32 + b'"}'))
+
+
+class HybridStorageTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+
+    def test_concurrent_copies_of_new_event(self):
+        # Копия A прошла фильтр первой, копия B целиком проверена между шагами A
+        for exact_layout in ('string', 'bucketed'):
+            with self.subTest(exact_layout=exact_layout):
+                self.redis.flushdb()
+                storage = build_storage('hybrid', self.redis, 3600, bloom_expected_items=1000,
+                                        exact_layout=exact_layout)
+                bloom_add_many = storage.bloom.add_many
+                replies = {}
+
+                def racing_bloom(fingerprints):
+                    result = bloom_add_many(fingerprints)
+                    storage.bloom.add_many = bloom_add_many
+                    replies['b'] = storage.add_many(fingerprints)
+                    return result
+
+                storage.bloom.add_many = racing_bloom
+                replies['a'] = storage.add_many([FINGERPRINT])
+
+                self.assertEqual(sorted(replies['a'] + replies['b']), [False, True])
+                self.assertEqual(storage.add_many([FINGERPRINT]), [False])
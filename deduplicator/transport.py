@@ -0,0 +1,335 @@
+
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from kombu.exceptions import EncodeError
+
+from .serialization import EventJSON, event_json, loads
+from .storage import make_async_client
+
+
+logger = logging.getLogger(__name__)
+
+# Транспорт событий от API до обработчика:
+#   'celery' - задача Celery на событие (или на чанк пакетного запроса)
+#   'stream' - запись в Redis Stream, обработка командой consume_events
+TRANSPORTS = ('celery', 'stream')
+
+# Запись потока: (id, событие или None, если запись битая, отпечаток или None).
+# Отпечаток есть у событий, уже проверенных на дубли при приеме.
+StreamEntry = Tuple[str, Optional[Dict[str, Any]], Optional[str]]
+
+
+class EventStream:
+    """
+    Redis Stream с событиями и группой потребителей.
+
+    Каждое событие - отдельная запись с полем 'event' (JSON) и, если
+    событие уже проверено на дубли при приеме, полем 'fingerprint'.
+    Событие из тела запроса (EventJSON) пишется исходным текстом, а
+    прочитанное возвращается как EventJSON: текст из потока без
+    повторной сериализации доходит до БД.
+    Длина потока ограничена приблизительным MAXLEN: Redis обрезает
+    старые записи целыми узлами, что почти ничего не стоит. Обрезка не
+    смотрит на группу: если потребители отстают больше чем на maxlen
+    записей, самые старые непрочитанные события теряются.
+    """
+
+    FIELD = 'event'
+    FINGERPRINT_FIELD = 'fingerprint'
+
+    # Размер пула соединений асинхронного клиента (см. async_redis)
+    async_max_connections = 100
+
+    # Проверка при приеме: SET NX EX ключа отпечатка и XADD только новых событий.
+    # KEYS[1]: поток, KEYS[2..]: ключи отпечатков. ARGV[1]: MAXLEN, далее тройки
+    # (событие JSON, отпечаток, TTL) в порядке ключей. Ответ: 1 - новое, 0 - дубль.
+    INGEST_SCRIPT = """
+redis.replicate_commands()
+local result = {}
+for i = 2, #KEYS do
+    local event_arg = 3 * i - 4
+    if redis.call('SET', KEYS[i], '1', 'NX', 'EX', ARGV[event_arg + 2]) then
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*',
+                   'event', ARGV[event_arg], 'fingerprint', ARGV[event_arg + 1])
+        result[i - 1] = 1
+    else
+        result[i - 1] = 0
+    end
+end
+return result
+"""
+
+    def __init__(self, redis_client: redis.Redis, key: str, group: str, maxlen: int):
+        if not isinstance(maxlen, int) or maxlen <= 0:
+            raise ValueError("maxlen должен быть положительным целым числом")
+        self.redis = redis_client
+        self.key = key
+        self.group = group
+        self.maxlen = maxlen
+        self._ingest_sha = hashlib.sha1(self.INGEST_SCRIPT.encode('utf-8')).hexdigest()
+        self._async_redis: Optional[redis.asyncio.Redis] = None
+
+    @property
+    def async_redis(self) -> redis.asyncio.Redis:
+        if self._async_redis is None:
+            self._async_redis = make_async_client(self.redis, self.async_max_connections)
+        return self._async_redis
+
+    def append(self, events: List[Dict[str, Any]], fingerprints: Optional[List[str]] = None) -> List[str]:
+        """
+        Добавляет события одним pipeline. Возвращает id записей.
+        fingerprints передаются для событий, уже проверенных на дубли.
+        """
+        return self._queue_append(self.redis.pipeline(transaction=False), events, fingerprints).execute()
+
+    async def append_async(self, events: List[Dict[str, Any]], fingerprints: Optional[List[str]] = None) -> List[str]:
+        """Асинхронная версия append через async_redis (для ASGI-эндпоинта)."""
+        return await self._queue_append(self.async_redis.pipeline(transaction=False), events, fingerprints).execute()
+
+    def _queue_append(self, pipe: Any, events: List[Dict[str, Any]], fingerprints: Optional[List[str]]) -> Any:
+        for index, event_data in enumerate(events):
+            fields = {self.FIELD: event_json(event_data)}
+            if fingerprints is not None:
+                fields[self.FINGERPRINT_FIELD] = fingerprints[index]
+            pipe.xadd(self.key, fields, maxlen=self.maxlen, approximate=True)
+        return pipe
+
+    def append_new(self, items: List[Tuple[str, str, Dict[str, Any], int]]) -> List[bool]:
+        """
+        Атомарно записывает отпечатки и ставит в поток только новые события.
+        items - четверки (ключ отпечатка в Redis, отпечаток, событие, TTL
+        отпечатка - у каждой политики свой). Возвращает True для новых
+        событий (поставлены в поток).
+        """
+        keys = [self.key] + [key for key, _, _, _ in items]
+        args = [self.maxlen]
+        for _, fingerprint, event_data, ttl_seconds in items:
+            args.extend((event_json(event_data), fingerprint, ttl_seconds))
+        try:
+            replies = self.redis.evalsha(self._ingest_sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            self.redis.script_load(self.INGEST_SCRIPT)
+            replies = self.redis.evalsha(self._ingest_sha, len(keys), *keys, *args)
+        return [bool(reply) for reply in replies]
+
+    def ensure_group(self) -> None:
+        """Создает группу (и сам поток), если их еще нет. Новая группа читает с начала потока."""
+        try:
+            self.redis.xgroup_create(self.key, self.group, id='0', mkstream=True)
+            logger.info("Создана группа потребителей %s для потока %s", self.group, self.key)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, consumer: str, count: int, block_ms: int) -> List[StreamEntry]:
+        """Новые записи для потребителя (XREADGROUP >). Ждет до block_ms, если поток пуст."""
+        response = self.redis.xreadgroup(self.group, consumer, {self.key: '>'}, count=count, block=block_ms)
+        if not response:
+            return []
+        _, messages = response[0]
+        return [self._decode(entry_id, fields) for entry_id, fields in messages]
+
+    def claim_stale(self, consumer: str, min_idle_ms: int, count: int) -> List[StreamEntry]:
+        """
+        Забирает себе записи, которые другие потребители прочитали, но не
+        подтвердили дольше min_idle_ms (упавший или зависший потребитель).
+        """
+        entries = []
+        start = '0-0'
+        while len(entries) < count:
+            start, messages, *_ = self.redis.xautoclaim(
+                self.key, self.group, consumer, min_idle_ms, start_id=start, count=count - len(entries)
+            )
+            # Записи, удаленные обрезкой MAXLEN, приходят как None
+            entries.extend(self._decode(entry_id, fields) for entry_id, fields in messages if fields is not None)
+            if start == '0-0':
+                break
+        return entries
+
+    def ack(self, entry_ids: List[str]) -> int:
+        if not entry_ids:
+            return 0
+        return self.redis.xack(self.key, self.group, *entry_ids)
+
+    def _decode(self, entry_id, fields) -> StreamEntry:
+        try:
+            raw = fields[self.FIELD]
+            event_data = loads(raw)
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Битая запись %s в потоке %s: %s", entry_id, self.key, str(fields)[:100])
+            return entry_id, None, None
+        if not isinstance(event_data, dict):
+            logger.warning("Запись %s в потоке %s не является объектом: %s", entry_id, self.key, type(event_data))
+            return entry_id, None, None
+        return entry_id, EventJSON(event_data, raw), fields.get(self.FINGERPRINT_FIELD)
+
+
+def send_task(task, kwargs: Dict[str, Any], compression: Optional[str] = None, **options: Any) -> None:
+    """
+    Отправляет задачу Celery с событиями (options - как у apply_async).
+
+    Заголовок kwargsrepr (его показывают мониторинг и логи воркера) -
+    краткое описание аргументов: по умолчанию Celery пишет туда saferepr
+    аргументов, то есть еще одну копию события в каждом сообщении, и
+    тратит на это больше, чем на всю сериализацию события.
+
+    Сообщение, которое сериализатор DEDUPLICATOR_CELERY_SERIALIZER не
+    может закодировать (msgpack и orjson не пишут целые длиннее 64 бит),
+    уходит в JSON - воркеры принимают его всегда.
+    """
+    options['kwargsrepr'] = repr({key: f"<{len(value)} events>" if isinstance(value, list) else '<event>'
+                                  for key, value in kwargs.items()})
+    try:
+        task.apply_async(kwargs=kwargs, compression=compression, **options)
+    except EncodeError:
+        if options.get('serializer', settings.CELERY_TASK_SERIALIZER) == 'json':
+            raise
+        options['serializer'] = 'json'
+        task.apply_async(kwargs=kwargs, compression=compression, **options)
+
+
+def enqueue_events(events: List[Dict[str, Any]]) -> None:
+    """
+    Отправляет принятые API события на обработку выбранным транспортом
+    (DEDUPLICATOR_TRANSPORT). Исключение означает, что события не приняты.
+    """
+    if settings.DEDUPLICATOR_TRANSPORT == 'stream':
+        stream = settings.EVENT_STREAM_INSTANCE
+        if stream is None:
+            raise RuntimeError("Redis Stream не настроен")
+        stream.append(events)
+        return
+
+    from .tasks import process_event, process_events_batch
+
+    if len(events) == 1:
+        send_task(process_event, {'event_data': events[0]})
+    else:
+        send_task(process_events_batch, {'events': events}, compression=settings.DEDUPLICATOR_CELERY_BATCH_COMPRESSION)
+
+
+def ingest_events(events: List[Dict[str, Any]]) -> List[Optional[Tuple[bool, Optional[str]]]]:
+    """
+    Проверка на дубли при приеме (DEDUPLICATOR_INGEST_DEDUP): дальше
+    транспорта уходят только новые события, уже с отпечатком, и обработчик
+    их только сохраняет. Возвращает (is_duplicate, fingerprint) по каждому
+    событию, как check_duplication_many. Исключение означает, что события
+    не приняты.
+
+    Если Redis недоступен и DEDUPLICATOR_DEGRADED_MODE = 'retry', события
+    отправляются в транспорт без проверки (enqueue_events) - их проверит
+    обработчик, когда Redis восстановится. Результат тогда - None по
+    каждому событию.
+
+    Транспорт 'stream' со строковой раскладкой (и без поиска почти-дублей):
+    проверка и постановка в поток атомарны (один Lua-скрипт). В остальных случаях это два шага:
+    пакетная проверка, затем отправка новых событий. Если отправка не
+    удалась, только что записанные отпечатки удаляются (forget_many), чтобы
+    повтор запроса клиентом не был принят за дубль.
+    """
+    deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+    if deduplicator is None:
+        raise RuntimeError("Дедупликатор не настроен")
+
+    stream = settings.EVENT_STREAM_INSTANCE
+    if settings.DEDUPLICATOR_TRANSPORT == 'stream' and stream is None:
+        raise RuntimeError("Redis Stream не настроен")
+
+    fail_open = settings.DEDUPLICATOR_DEGRADED_MODE != 'retry'
+    try:
+        if (settings.DEDUPLICATOR_TRANSPORT == 'stream' and deduplicator.string_keys_only
+                and deduplicator.near_duplicates is None):
+            return deduplicator.check_and_stream_many(events, stream)
+        results = deduplicator.check_duplication_many(events, fail_open=fail_open)
+    except redis.RedisError as e:
+        if fail_open:
+            raise
+        logger.warning("Redis недоступен, %d событий отправлены в очередь без проверки на дубли: %s", len(events), e)
+        enqueue_events(events)
+        return [None] * len(events)
+
+    unique = [(fingerprint, event_data) for event_data, (is_duplicate, fingerprint) in zip(events, results)
+              if fingerprint is not None and not is_duplicate]
+    if unique:
+        try:
+            if settings.DEDUPLICATOR_TRANSPORT == 'stream':
+                stream.append([event_data for _, event_data in unique], [fingerprint for fingerprint, _ in unique])
+            else:
+                from .tasks import persist_unique_events
+                send_task(
+                    persist_unique_events,
+                    {'events': [[fingerprint, event_data] for fingerprint, event_data in unique]},
+                    compression=settings.DEDUPLICATOR_CELERY_BATCH_COMPRESSION if len(unique) > 1 else None,
+                )
+        except Exception:
+            _forget_unsent(deduplicator, unique)
+            raise
+    return results
+
+
+def _forget_unsent(deduplicator, rows: List[Tuple[str, Dict[str, Any]]]) -> None:
+    # Компенсация: отпечатки событий, не попавших в транспорт, не должны отсеивать их повтор
+    try:
+        deduplicator.forget_many(rows)
+    except Exception as e:
+        logger.error("Не удалось удалить отпечатки %d неотправленных событий, их повтор будет принят за дубль: %s",
+                     len(rows), e)
+
+
+class PersistBatcher:
+    """
+    Отправка проверенных событий в persist_unique_events из event loop
+    (ASGI-эндпоинт) пачками. Публикация Celery блокирующая и идет в пуле
+    потоков; пока одна пачка отправляется, запросы копят следующую, и
+    на пачку - одна задача и один переход в поток вместо одного на
+    запрос. submit ждет отправки своей пачки, ошибка отправки
+    пробрасывается всем ее запросам.
+    """
+
+    def __init__(self, max_batch: int):
+        if not isinstance(max_batch, int) or max_batch <= 0:
+            raise ValueError("max_batch должен быть положительным целым числом")
+        self.max_batch = max_batch
+        self._pending: List[Tuple[List[Any], asyncio.Future]] = []
+        self._sender: Optional[asyncio.Task] = None
+        # Ссылки на задачи отправки: event loop держит их только слабо
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, fingerprint: str, event_data: Dict[str, Any]) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(([fingerprint, event_data], future))
+        if self._sender is None:
+            self._sender = asyncio.ensure_future(self._send_pending())
+            self._tasks.add(self._sender)
+            self._sender.add_done_callback(self._tasks.discard)
+        await future
+
+    async def _send_pending(self) -> None:
+        from .tasks import persist_unique_events
+
+        try:
+            while self._pending:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                try:
+                    await sync_to_async(send_task, thread_sensitive=False)(
+                        persist_unique_events,
+                        {'events': [row for row, _ in batch]},
+                        compression=settings.DEDUPLICATOR_CELERY_BATCH_COMPRESSION if len(batch) > 1 else None,
+                    )
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._sender = None
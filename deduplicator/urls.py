@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import check_event_api
+from .views import check_event_api, check_event_inline_api, list_events_api
 
 urlpatterns = [
     path('check_event/', check_event_api, name='check_event'),
+    path('check_event/inline/', check_event_inline_api, name='check_event_inline'),
+    path('events/', list_events_api, name='events'),
 ]
\ No newline at end of file
@@ -1,24 +1,188 @@
 
+import base64
+import binascii
 import json
 import logging
+import math
 
+import redis
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny
+from django.conf import settings
+from django.db.models import Q
 
 
-from .tasks import process_event
+from . import metrics
+from .eventlog import event_log
+from .models import PROMOTED_FIELDS, UniqueEvent
+from .serialization import loads
+from .transport import PersistBatcher, enqueue_events, ingest_events
 
 logger = logging.getLogger(__name__)
 
+# Уникальные события синхронного эндпоинта уходят в persist_unique_events пачками
+persist_batcher = PersistBatcher(settings.DEDUPLICATOR_INLINE_PERSIST_BATCH_SIZE)
+
+
+def _content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _count_received(outcome, amount=1):
+    # Исход приема - и в метрику, и в сводку лога (режим 'production')
+    metrics.EVENTS_RECEIVED.inc(amount, outcome)
+    event_log.count(f"api.{outcome}", amount)
+
+
+def _with_retry_after(response, seconds):
+    response['Retry-After'] = str(max(1, math.ceil(seconds)))
+    return response
+
+
+def _queue_full_response(admission, amount):
+    """503 без постановки в очередь: очередь транспорта выше порога (admission.py)."""
+    admission.shed(amount)
+    _count_received('throttled', amount)
+    return _with_retry_after(
+        Response({"error": "Event queue is overloaded, retry later."}, status=status.HTTP_503_SERVICE_UNAVAILABLE),
+        admission.retry_after,
+    )
+
+
+def _ingest_status(outcome):
+    """Статус элемента ответа по результату ingest_events (None - проверка при приеме выключена)."""
+    if outcome is None:
+        return {"status": "accepted"}
+    is_duplicate, fingerprint = outcome
+    if fingerprint is None:
+        return {"status": "rejected", "error": "Failed to fingerprint event."}
+    return {"status": "duplicate" if is_duplicate else "accepted", "fingerprint": fingerprint}
+
+
+def _check_event_batch(events):
+    """
+    Пакетный режим: валидирует весь массив за один проход, режет валидные
+    события на чанки и отправляет каждый чанк одним вызовом транспорта
+    (одна задача Celery или один pipeline XADD в Redis Stream).
+    Возвращает Response с результатом по каждому элементу.
+    """
+    max_items = settings.DEDUPLICATOR_BATCH_MAX_ITEMS
+    if len(events) > max_items:
+        logger.warning("Пакет отклонен: %d событий при лимите %s", len(events), max_items)
+        return Response(
+            {"error": f"Too many events in batch: {len(events)} (max {max_items})."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
+
+    results = [None] * len(events)
+    valid = []  # пары (индекс в запросе, событие)
+    for index, item in enumerate(events):
+        if isinstance(item, dict) and item:
+            valid.append((index, item))
+        else:
+            results[index] = {"index": index, "status": "rejected", "error": "Event must be a non-empty JSON object."}
+
+    throttled = 0
+    retry_after = None
+    admission = settings.ADMISSION_CONTROLLER
+    if admission is not None and valid:
+        if admission.queue_full():
+            return _queue_full_response(admission, len(valid))
+        waits = admission.admit([event for _, event in valid])
+        if any(waits):
+            admitted = []
+            for (index, event), wait in zip(valid, waits):
+                if wait:
+                    results[index] = {"index": index, "status": "rejected", "error": "Rate limit exceeded.",
+                                      "retry_after": round(wait, 3)}
+                    retry_after = wait if retry_after is None else min(retry_after, wait)
+                else:
+                    admitted.append((index, event))
+            throttled = len(valid) - len(admitted)
+            valid = admitted
+
+    queue_failed = 0
+    chunk_size = settings.DEDUPLICATOR_BATCH_CHUNK_SIZE
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        try:
+            with metrics.ENQUEUE_SECONDS.time(settings.DEDUPLICATOR_TRANSPORT):
+                if settings.DEDUPLICATOR_INGEST_DEDUP:
+                    outcomes = ingest_events([event for _, event in chunk])
+                else:
+                    enqueue_events([event for _, event in chunk])
+                    outcomes = None
+        except Exception as e:
+            # Брокер недоступен: отклоняем только этот чанк, остальные уже в очереди
+            logger.exception("Ошибка при отправке чанка из %d событий в очередь: %s", len(chunk), e)
+            for index, _ in chunk:
+                results[index] = {"index": index, "status": "rejected", "error": "Failed to queue event for processing."}
+            queue_failed += len(chunk)
+            continue
+        for position, (index, _) in enumerate(chunk):
+            results[index] = {"index": index, **_ingest_status(outcomes[position] if outcomes else None)}
+
+    accepted = sum(1 for r in results if r["status"] == "accepted")
+    duplicates = sum(1 for r in results if r["status"] == "duplicate")
+    rejected = len(results) - accepted - duplicates
+    _count_received('accepted', accepted)
+    _count_received('duplicate', duplicates)
+    _count_received('throttled', throttled)
+    _count_received('rejected', rejected - throttled)
+    event_log.event(logger, logging.INFO, "Пакет обработан: принято %d, дублей %d, отклонено %d из %d событий.",
+                    accepted, duplicates, rejected, len(events))
+
+    if accepted or duplicates:
+        response_status = status.HTTP_202_ACCEPTED
+    elif queue_failed:
+        # Ничего не принято, и хотя бы часть событий не удалось поставить в очередь
+        response_status = status.HTTP_500_INTERNAL_SERVER_ERROR
+    elif throttled:
+        # Все валидные события - сверх лимита частоты своих клиентов
+        response_status = status.HTTP_429_TOO_MANY_REQUESTS
+    else:
+        # Невалидные события, в том числе те, которым не удалось посчитать отпечаток
+        response_status = status.HTTP_400_BAD_REQUEST
+
+    response = Response(
+        {
+            "message": "Batch processed",
+            "accepted": accepted,
+            "duplicates": duplicates,
+            "rejected": rejected,
+            "results": results,
+        },
+        status=response_status
+    )
+    return response if retry_after is None else _with_retry_after(response, retry_after)
 
 
 @api_view(['POST'])
 @authentication_classes([])
 @permission_classes([AllowAny])
 def check_event_api(request):
-    logger.info("--- Вход в СИНХРОННУЮ API view (check_event_api) ---")
+    event_log.event(logger, logging.DEBUG, "--- Вход в СИНХРОННУЮ API view (check_event_api) ---")
+
+    # Проверяем размер тела до его чтения и парсинга
+    max_body = settings.DEDUPLICATOR_BATCH_MAX_BODY_BYTES
+    if _content_length(request) > max_body:
+        logger.warning("Тело запроса больше лимита %s байт, запрос отклонен.", max_body)
+        return Response(
+            {"error": f"Request body too large (max {max_body} bytes)."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
 
     event_data_raw = request.data
     event_data = None
@@ -26,11 +190,14 @@ def check_event_api(request):
     # Парсим данные
     if isinstance(event_data_raw, list) and len(event_data_raw) == 1 and isinstance(event_data_raw[0], dict):
         event_data = event_data_raw[0]
+    elif isinstance(event_data_raw, list) and len(event_data_raw) > 1:
+        logger.debug("Принят пакет из %d событий.", len(event_data_raw))
+        return _check_event_batch(event_data_raw)
     elif isinstance(event_data_raw, dict):
          event_data = event_data_raw
-         logger.debug("Принят одиночный объект JSON в теле запроса.")
+         event_log.event(logger, logging.DEBUG, "Принят одиночный объект JSON в теле запроса.")
     else:
-         logger.warning(f"Неожиданный формат JSON в теле: {type(event_data_raw)}")
+         logger.warning("Неожиданный формат JSON в теле: %s", type(event_data_raw))
          return Response(
             {"error": "Invalid JSON format in body."},
             status=status.HTTP_400_BAD_REQUEST
@@ -40,24 +207,286 @@ def check_event_api(request):
         logger.error("Не удалось извлечь event_data из запроса.")
         return Response({"error": "Failed to parse event data"}, status=status.HTTP_400_BAD_REQUEST)
 
+    admission = settings.ADMISSION_CONTROLLER
+    if admission is not None:
+        if admission.queue_full():
+            return _queue_full_response(admission, 1)
+        wait, = admission.admit([event_data])
+        if wait:
+            _count_received('throttled')
+            return _with_retry_after(
+                Response({"error": "Rate limit exceeded."}, status=status.HTTP_429_TOO_MANY_REQUESTS), wait
+            )
+
     try:
-        # --- Отправляем задачу в Celery ---
-        process_event.delay(event_data=event_data)
+        if settings.DEDUPLICATOR_INGEST_DEDUP:
+            # Дубль отбрасывается здесь же и в очередь не попадает
+            with metrics.ENQUEUE_SECONDS.time(settings.DEDUPLICATOR_TRANSPORT):
+                outcome = ingest_events([event_data])[0]
+            if outcome is None:
+                # Redis недоступен (режим 'retry'): событие проверит обработчик
+                _count_received('accepted')
+                return Response({"message": "Event accepted for processing"}, status=status.HTTP_202_ACCEPTED)
+            is_duplicate, fingerprint = outcome
+            if fingerprint is None:
+                _count_received('rejected')
+                return Response({"error": "Failed to fingerprint event."}, status=status.HTTP_400_BAD_REQUEST)
+            if is_duplicate:
+                event_log.event(logger, logging.INFO, "Дубль отброшен при приеме. Fingerprint: %s", fingerprint)
+                _count_received('duplicate')
+                return Response({"message": "Duplicate event", "fingerprint": fingerprint}, status=status.HTTP_200_OK)
+            event_log.event(logger, logging.INFO, "Новое событие отправлено в очередь на сохранение. Fingerprint: %s",
+                            fingerprint)
+            _count_received('accepted')
+            return Response({"message": "Event accepted for processing", "fingerprint": fingerprint},
+                            status=status.HTTP_202_ACCEPTED)
+
+        # --- Отправляем событие в очередь (Celery или Redis Stream) ---
+        with metrics.ENQUEUE_SECONDS.time(settings.DEDUPLICATOR_TRANSPORT):
+            enqueue_events([event_data])
         # ------------------------------------
-        logger.info(f"Событие отправлено в очередь для обработки: {str(event_data)[:100]}...")
+        event_log.event(logger, logging.INFO, "Событие отправлено в очередь для обработки: %.100s...", event_data)
+        _count_received('accepted')
 
         return Response({"message": "Event accepted for processing"}, status=status.HTTP_202_ACCEPTED)
 
     except Exception as e:
-         # Ошибка может возникнуть, если Celery брокер недоступен
-         logger.exception(f"Ошибка при отправке задачи в Celery: {e}")
+         # Ошибка может возникнуть, если брокер Celery или Redis недоступен
+         logger.exception("Ошибка при отправке события в очередь: %s", e)
+         _count_received('rejected')
          return Response(
              {"error": "Failed to queue event for processing"},
              status=status.HTTP_500_INTERNAL_SERVER_ERROR
          )
 
 
+@csrf_exempt
+@require_POST
+async def check_event_inline_api(request):
+    """
+    Нативный async-эндпоинт: дедупликация выполняется прямо в запросе через
+    redis.asyncio, ответ сразу содержит is_duplicate и fingerprint.
+    На сохранение уходят только уникальные события: XADD в Redis Stream
+    через redis.asyncio (транспорт 'stream') или задача
+    persist_unique_events на пачку запросов (PersistBatcher). Если
+    отправить событие не удалось, его отпечаток удаляется.
+    """
+    deduplicator = settings.EVENT_DEDUPLICATOR_INSTANCE
+    if deduplicator is None:
+        return JsonResponse({"error": "Deduplicator is not configured"}, status=503)
 
+    if len(request.body) > settings.DEDUPLICATOR_BATCH_MAX_BODY_BYTES:
+        return JsonResponse({"error": "Request body too large."}, status=413)
 
+    try:
+        event_data = loads(request.body.decode())
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON in body."}, status=400)
 
+    if isinstance(event_data, list) and len(event_data) == 1:
+        event_data = event_data[0]
+    if not isinstance(event_data, dict) or not event_data:
+        return JsonResponse({"error": "Event must be a non-empty JSON object."}, status=400)
+
+    admission = settings.ADMISSION_CONTROLLER
+    if admission is not None:
+        if await admission.queue_full_async():
+            admission.shed(1)
+            _count_received('throttled')
+            return _with_retry_after(
+                JsonResponse({"error": "Event queue is overloaded, retry later."}, status=503), admission.retry_after
+            )
+        wait, = await admission.admit_async([event_data])
+        if wait:
+            _count_received('throttled')
+            return _with_retry_after(JsonResponse({"error": "Rate limit exceeded."}, status=429), wait)
+
+    try:
+        is_duplicate, fingerprint = await deduplicator.check_duplication_async(
+            event_data, fail_open=settings.DEDUPLICATOR_DEGRADED_MODE != 'retry'
+        )
+    except redis.RedisError as e:
+        # Режим 'retry': ответ с is_duplicate сейчас дать нельзя, повторить запрос должен клиент
+        retry_after = deduplicator.redis_retry_after(settings.DEDUPLICATOR_BREAKER_RESET_TIMEOUT)
+        logger.warning("Redis недоступен, запрос отклонен на %.0f с: %s", retry_after, e)
+        response = JsonResponse({"error": "Deduplication is temporarily unavailable."}, status=503)
+        response['Retry-After'] = str(math.ceil(retry_after))
+        return response
+    if fingerprint is None:
+        return JsonResponse({"error": "Failed to fingerprint event."}, status=400)
+
+    if not is_duplicate:
+        stream = settings.EVENT_STREAM_INSTANCE
+        transport = 'stream' if settings.DEDUPLICATOR_TRANSPORT == 'stream' and stream is not None else 'celery'
+        try:
+            with metrics.ENQUEUE_SECONDS.time(transport):
+                if transport == 'stream':
+                    # Запись с отпечатком consume_events только сохраняет
+                    await stream.append_async([event_data], [fingerprint])
+                else:
+                    await persist_batcher.submit(fingerprint, event_data)
+        except Exception as e:
+            logger.exception("Ошибка при отправке уникального события в очередь (%s): %s", fingerprint, e)
+            try:
+                await sync_to_async(deduplicator.forget_many, thread_sensitive=False)([(fingerprint, event_data)])
+            except Exception as forget_error:
+                logger.error("Не удалось удалить отпечаток неотправленного события (%s): %s", fingerprint, forget_error)
+            _count_received('rejected')
+            return JsonResponse(
+                {"error": "Failed to queue event for storage", "fingerprint": fingerprint},
+                status=500
+            )
+
+    _count_received('duplicate' if is_duplicate else 'accepted')
+    return JsonResponse({"is_duplicate": is_duplicate, "fingerprint": fingerprint})
+
+
+def _encode_cursor(received_at, event_id):
+    raw = json.dumps([received_at.isoformat(), event_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """(received_at, id) последней строки предыдущей страницы; ValueError - курсор испорчен."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        received_at, event_id = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor.")
+    received_at = parse_datetime(received_at) if isinstance(received_at, str) else None
+    if received_at is None or not isinstance(event_id, int):
+        raise ValueError("Invalid cursor.")
+    return received_at, event_id
+
+
+def _parse_time(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid '{name}': expected an ISO 8601 datetime.")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def list_events_api(request):
+    """
+    Сохраненные события, новые первыми. Фильтры - по колонкам
+    PROMOTED_FIELDS (event_name, user_id, client_id; значения сравниваются
+    как текст), по времени (since <= received_at < until) и по содержимому
+    (contains - JSON-объект, event_data @> contains).
+
+    Пагинация - по ключу (received_at, id), без OFFSET: в next_cursor -
+    ключ последней строки страницы, следующая страница начинается строго
+    после него. С фильтром по колонке страница любой глубины читается
+    обратным проходом по индексу (колонка, received_at, id) - ровно limit
+    строк; since/until и курсор отсекают лишние секции еще при планировании.
+    """
+    params = request.query_params
+    queryset = UniqueEvent.objects.all()
+    try:
+        for column in PROMOTED_FIELDS:
+            if column in params:
+                queryset = queryset.filter(**{column: params[column]})
+
+        since, until = _parse_time(params, 'since'), _parse_time(params, 'until')
+        if since is not None:
+            queryset = queryset.filter(received_at__gte=since)
+        if until is not None:
+            queryset = queryset.filter(received_at__lt=until)
+
+        if 'contains' in params:
+            try:
+                contains = json.loads(params['contains'])
+            except ValueError:
+                contains = None
+            if not isinstance(contains, dict) or not contains:
+                raise ValueError("Invalid 'contains': expected a non-empty JSON object.")
+            queryset = queryset.filter(event_data__contains=contains)
+
+        max_limit = settings.DEDUPLICATOR_EVENTS_PAGE_MAX
+        try:
+            limit = int(params.get('limit', settings.DEDUPLICATOR_EVENTS_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= max_limit:
+            raise ValueError(f"Invalid 'limit': expected an integer from 1 to {max_limit}.")
+
+        if params.get('cursor'):
+            received_at, event_id = _decode_cursor(params['cursor'])
+            # (received_at, id) < (...): received_at <= ... - граница диапазона индекса,
+            # условие на id отсекает только строки с тем же received_at
+            queryset = queryset.filter(
+                Q(received_at__lte=received_at),
+                Q(received_at__lt=received_at) | Q(id__lt=event_id),
+            )
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    rows = list(
+        queryset.order_by('-received_at', '-id')
+        .values('id', 'fingerprint', 'received_at', 'duplicate_count', 'last_seen_at', 'event_data')[:limit + 1]
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]['received_at'], rows[-1]['id'])
+    return Response({"results": rows, "next_cursor": next_cursor})
+
+
+def metrics_view(request):
+    """
+    Метрики всех процессов (API, воркеры, consume_events) в формате
+    Prometheus. Каждый процесс сбрасывает свои приращения в Redis раз в
+    DEDUPLICATOR_METRICS_FLUSH_INTERVAL секунд, поэтому данные отстают на
+    этот интервал. Длина очереди считается в момент запроса.
+    """
+    redis_client = settings.REDIS_INSTANCE
+    if not settings.DEDUPLICATOR_METRICS_ENABLED or redis_client is None:
+        return HttpResponse("Metrics are disabled.\n", status=404, content_type='text/plain')
+    try:
+        totals = metrics.read_totals(redis_client, settings.DEDUPLICATOR_METRICS_KEY)
+        queue_gauges = _queue_gauges(redis_client)
+    except Exception as e:
+        logger.error("Не удалось прочитать метрики или длину очереди: %s", e)
+        return HttpResponse("Metrics storage is unavailable.\n", status=503, content_type='text/plain')
+    return HttpResponse(metrics.registry.render(totals) + queue_gauges, content_type=metrics.CONTENT_TYPE)
+
+
+def _queue_gauges(redis_client):
+    """Текущая глубина очереди выбранного транспорта (gauge: считается при запросе, в Redis не копится)."""
+    transport = settings.DEDUPLICATOR_TRANSPORT
+    pending = None
+    if transport == 'stream':
+        stream = settings.EVENT_STREAM_INSTANCE
+        length = redis_client.xlen(stream.key)
+        groups = redis_client.xinfo_groups(stream.key) if length else []
+        pending = next((group['pending'] for group in groups if group['name'] == stream.group), 0)
+    else:
+        from KN_practice.celery import app
+        with app.connection_for_read() as connection:
+            try:
+                length = connection.default_channel.queue_declare(
+                    queue=app.conf.task_default_queue, passive=True
+                ).message_count
+            except connection.channel_errors:
+                # Брокер на Redis удаляет пустую очередь: ее нет - значит, она пуста
+                length = 0
 
+    lines = [
+        "# HELP dedup_queue_length Entries waiting in the transport (stream length or Celery queue length).",
+        "# TYPE dedup_queue_length gauge",
+        f'dedup_queue_length{{transport="{transport}"}} {length}',
+    ]
+    if pending is not None:
+        lines += [
+            "# HELP dedup_queue_pending Stream entries delivered to consumers but not yet acknowledged.",
+            "# TYPE dedup_queue_pending gauge",
+            f'dedup_queue_pending{{transport="{transport}"}} {pending}',
+        ]
+    return '\n'.join(lines) + '\n'
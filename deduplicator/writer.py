@@ -0,0 +1,320 @@
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from . import metrics
+from .eventlog import event_log
+from .hits import DuplicateHits, Hit
+from .models import PROMOTED_FIELDS, UniqueEvent, promoted_values
+
+
+logger = logging.getLogger(__name__)
+
+# Пара (fingerprint, event_data), ожидающая записи в БД
+PendingEvent = Tuple[str, Dict[str, Any]]
+
+
+def save_unique_events(rows: List[PendingEvent], recheck: bool = False) -> int:
+    """
+    Записывает уникальные события одним INSERT ... ON CONFLICT DO NOTHING.
+    Ключевые поля события заодно пишутся в свои колонки (models.PROMOTED_FIELDS).
+    Возвращает количество переданных строк.
+
+    Уникальный индекс fingerprint есть только у каждой дневной секции
+    (миграция 0003): ON CONFLICT отсекает повтор события, записанного в тот
+    же день. recheck - события, которые могли быть записаны раньше
+    (повторная доставка, повтор после сбоя): INSERT пропускает еще и
+    отпечатки, уже сохраненные за последние
+    DEDUPLICATOR_DB_RECHECK_WINDOW_SECONDS в любой секции.
+    """
+    if not rows:
+        return 0
+    with metrics.DB_WRITE_SECONDS.time():
+        if recheck and connection.vendor == 'postgresql':
+            _insert_missing(rows)
+        else:
+            UniqueEvent.objects.bulk_create(
+                [
+                    UniqueEvent(fingerprint=fingerprint, event_data=event_data, **promoted_values(event_data))
+                    for fingerprint, event_data in rows
+                ],
+                ignore_conflicts=True,
+            )
+    metrics.DB_ROWS_WRITTEN.inc(len(rows))
+    event_log.count('db.written', len(rows))
+    return len(rows)
+
+
+def _insert_missing(rows: List[PendingEvent]) -> None:
+    columns = ['fingerprint', 'event_data', 'received_at', *PROMOTED_FIELDS]
+    event_data_field = UniqueEvent._meta.get_field('event_data')
+    received_at = timezone.now()
+    params = []
+    for fingerprint, event_data in rows:
+        promoted = promoted_values(event_data)
+        params += [fingerprint, event_data_field.get_db_prep_save(event_data, connection), received_at,
+                   *(promoted[column] for column in PROMOTED_FIELDS)]
+    values = ', '.join(['(%s, %s::jsonb, %s::timestamptz' + ', %s' * len(PROMOTED_FIELDS) + ')'] * len(rows))
+    table = UniqueEvent._meta.db_table
+    with connection.cursor() as cursor:
+        # Условие на received_at оставляет в проверке только секции окна
+        cursor.execute(
+            f'INSERT INTO "{table}" ({", ".join(columns)}) '
+            f'SELECT * FROM (VALUES {values}) AS new ({", ".join(columns)}) '
+            f'WHERE NOT EXISTS (SELECT 1 FROM "{table}" saved WHERE saved.fingerprint = new.fingerprint '
+            f'AND saved.received_at >= %s) ON CONFLICT DO NOTHING',
+            params + [received_at - timedelta(seconds=settings.DEDUPLICATOR_DB_RECHECK_WINDOW_SECONDS)],
+        )
+
+
+def write_unique_events(batch: List[PendingEvent], recheck: bool = False) -> Tuple[int, List[PendingEvent]]:
+    """
+    Пишет пачку. Возвращает (количество записанных, незаписанный хвост).
+    Хвост непустой, только если БД недоступна и пачку нужно повторить.
+    Если пачку отвергла сама БД (например, одно "битое" событие), она
+    пишется построчно и теряется только событие, которое БД не принимает.
+    recheck - как у save_unique_events; при построчной записи - всегда.
+    """
+    close_old_connections()
+    try:
+        written = save_unique_events(batch, recheck)
+        event_log.event(logger, logging.INFO, "Пачка из %d уникальных событий СОХРАНЕНА в БД.", written)
+        return written, []
+    except (OperationalError, InterfaceError) as e:
+        logger.error("БД недоступна, пачка из %d событий будет повторена: %s", len(batch), e)
+        return 0, batch
+    except Exception as e:
+        logger.exception("Ошибка при пакетном сохранении %d событий, пишем построчно: %s", len(batch), e)
+
+    written = 0
+    for index, (fingerprint, event_data) in enumerate(batch):
+        try:
+            written += save_unique_events([(fingerprint, event_data)], recheck=True)
+        except (OperationalError, InterfaceError) as e:
+            logger.error("БД недоступна, %d событий будут повторены: %s", len(batch) - index, e)
+            return written, batch[index:]
+        except Exception as e:
+            logger.exception("Событие не принято БД и пропущено (Fingerprint: %s): %s", fingerprint, e)
+    return written, []
+
+
+def save_duplicate_hits(hits: Sequence[Hit], since: Optional[datetime] = None) -> Set[str]:
+    """
+    Переносит повторы в БД одним UPDATE: duplicate_count последней строки с
+    отпечатком растет на число повторов, last_seen_at - максимум из
+    сохраненного и нового. since - нижняя граница received_at искомых строк
+    (отсекает старые секции). Возвращает отпечатки, для которых строка нашлась.
+    """
+    if not hits:
+        return set()
+    table = connection.ops.quote_name(UniqueEvent._meta.db_table)
+    values = ', '.join(['(%s, %s::bigint, to_timestamp(%s))'] * len(hits))
+    params: List[Any] = [value for hit in hits for value in hit]
+    bound = ''
+    if since is not None:
+        bound = 'AND event.received_at >= %s'
+        params.append(since)
+    # Отпечаток уникален только в пределах суточной секции: повторы достаются
+    # последней строке - той, чье окно дедупликации их отсеяло
+    sql = f"""
+        WITH hits (fingerprint, hits, last_seen) AS (VALUES {values}),
+        target AS (
+            SELECT DISTINCT ON (event.fingerprint) event.id, event.received_at, hits.hits, hits.last_seen
+            FROM {table} event JOIN hits ON event.fingerprint = hits.fingerprint
+            WHERE TRUE {bound}
+            ORDER BY event.fingerprint, event.received_at DESC
+        )
+        UPDATE {table} event
+        SET duplicate_count = event.duplicate_count + target.hits,
+            last_seen_at = GREATEST(event.last_seen_at, target.last_seen)
+        FROM target
+        WHERE event.id = target.id AND event.received_at = target.received_at
+        RETURNING event.fingerprint
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {fingerprint for fingerprint, in cursor.fetchall()}
+
+
+def drain_duplicate_hits(hits: DuplicateHits, since: Optional[datetime] = None, grace_seconds: float = 3600,
+                         chunk_size: int = 1000) -> Tuple[int, int, int]:
+    """
+    Переносит снимок счетчиков повторов из Redis в БД пачками по chunk_size
+    отпечатков (см. DuplicateHits.claim). Возвращает (перенесено повторов,
+    возвращено в Redis, отброшено).
+
+    Повторы события, строки которого в БД еще нет (оно в очереди или в
+    буфере UniqueEventWriter), возвращаются в Redis до следующего переноса,
+    пока последний повтор моложе grace_seconds; потом отбрасываются.
+
+    Пачка убирается из снимка после коммита UPDATE, поэтому при падении
+    между ними она будет перенесена повторно (одна пачка - не больше).
+    Параллельный перенос исключает advisory-блокировка.
+    """
+    close_old_connections()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", [hits.key])
+        if not cursor.fetchone()[0]:
+            logger.info("Перенос повторов уже идет в другом процессе, пропускаем.")
+            return 0, 0, 0
+    saved = requeued = dropped = 0
+    try:
+        if not hits.claim():
+            return 0, 0, 0
+        for chunk in hits.claimed(chunk_size):
+            matched = save_duplicate_hits(chunk, since)
+            recent_after = time.time() - grace_seconds
+            retry = [hit for hit in chunk if hit[0] not in matched and hit[2] >= recent_after]
+            saved += sum(count for fingerprint, count, _ in chunk if fingerprint in matched)
+            requeued += sum(count for _, count, _ in retry)
+            dropped += sum(count for fingerprint, count, last_seen in chunk
+                           if fingerprint not in matched and last_seen < recent_after)
+            hits.ack([fingerprint for fingerprint, _, _ in chunk], requeue=retry)
+        hits.release()
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", [hits.key])
+    metrics.DUPLICATE_HITS_SAVED.inc(saved, 'saved')
+    metrics.DUPLICATE_HITS_SAVED.inc(dropped, 'dropped')
+    return saved, requeued, dropped
+
+
+class _Waiter:
+    """Ожидание записи событий одного вызова UniqueEventWriter.write."""
+
+    __slots__ = ('remaining', 'recheck', 'unwritten', 'done')
+
+    def __init__(self, count: int, recheck: bool):
+        self.remaining = count
+        self.recheck = recheck
+        self.unwritten: List[PendingEvent] = []
+        self.done = threading.Event()
+
+
+class UniqueEventWriter:
+    """
+    Групповая запись уникальных событий в воркере.
+
+    write() кладет события в общий буфер и ждет, пока они будут записаны.
+    Если сброс не идет, вызывающий становится ведущим: ждет, пока в буфере
+    наберется batch_size событий, но не дольше linger секунд, и пишет
+    буфер пачками до batch_size. Остальные задачи ждут следующего сброса,
+    но не дольше flush_interval секунд, после чего сбрасывают буфер сами.
+    Задача завершается - и подтверждается брокеру (acks_late) - только
+    после записи своих событий.
+
+    С linger = 0 ведущий пишет сразу, и пачка больше одного вызова
+    собирается только из задач, пришедших во время предыдущего INSERT
+    (под eventlet psycopg2 уступает хаб на время запроса). Под prefork
+    (одна задача на процесс) пересечений нет, и ожидание только добавило
+    бы задержку; под eventlet linger окупается, когда конкурентных задач
+    заметно больше одной (см. benchmarks/bench_writer.py).
+
+    Если БД недоступна, пачка и весь буфер возвращаются вызывающим как
+    незаписанные: буфер не растет, решение о повторе принимает задача.
+    При прочих ошибках (например, одно "битое" событие) пачка пишется
+    построчно, чтобы потерялось только событие, которое БД не принимает.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, linger: float = 0.0):
+        if not isinstance(batch_size, int) or batch_size <= 0:
+            raise ValueError("batch_size должен быть положительным целым числом")
+        if flush_interval <= 0:
+            raise ValueError("flush_interval должен быть положительным числом")
+        if linger < 0:
+            raise ValueError("linger не может быть отрицательным")
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.linger = linger
+
+        self._buffer: List[Tuple[str, Dict[str, Any], _Waiter]] = []
+        # _lock защищает буфер, _flush_lock гарантирует один сброс за раз
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Взводится, когда в буфере набралась полная пачка: ведущий перестает ждать
+        self._full = threading.Event()
+
+    def write(self, rows: Sequence[PendingEvent], recheck: bool = False) -> List[PendingEvent]:
+        """
+        Записывает события пачкой вместе с событиями других задач. Возвращает
+        незаписанные. recheck - как у save_unique_events (для всей пачки).
+        """
+        if not rows:
+            return []
+        waiter = _Waiter(len(rows), recheck)
+        with self._lock:
+            self._buffer.extend((fingerprint, event_data, waiter) for fingerprint, event_data in rows)
+            if len(self._buffer) >= self.batch_size:
+                self._full.set()
+
+        if self._flush_lock.acquire(blocking=False):
+            if self.linger and not self._full.is_set():
+                self._full.wait(self.linger)
+            self._flush_locked()
+        elif not waiter.done.wait(self.flush_interval):
+            # Текущий сброс мог закончиться раньше, чем события попали в буфер
+            self.flush()
+        waiter.done.wait()
+        return waiter.unwritten
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self) -> int:
+        """Сбрасывает буфер в БД. Возвращает количество записанных событий."""
+        self._flush_lock.acquire()
+        return self._flush_locked()
+
+    def close(self) -> None:
+        """Сбрасывает буфер (при остановке воркера)."""
+        self.flush()
+
+    def _flush_locked(self) -> int:
+        self._full.clear()
+        try:
+            written = 0
+            while True:
+                with self._lock:
+                    batch = self._buffer[:self.batch_size]
+                    del self._buffer[:self.batch_size]
+                if not batch:
+                    return written
+
+                try:
+                    count, unwritten = write_unique_events(
+                        [(fingerprint, event_data) for fingerprint, event_data, _ in batch],
+                        recheck=any(waiter.recheck for _, _, waiter in batch),
+                    )
+                except Exception as e:
+                    # Ждущие задачи не должны зависнуть: пачка считается незаписанной
+                    logger.exception("Ошибка при записи пачки из %d событий: %s", len(batch), e)
+                    count, unwritten = 0, batch
+                written += count
+                # Незаписанный хвост - последние len(unwritten) событий пачки
+                self._finish(batch[:len(batch) - len(unwritten)], failed=False)
+                if unwritten:
+                    # БД недоступна: остаток буфера тоже не ждет, задачи повторят запись сами
+                    with self._lock:
+                        rest, self._buffer = self._buffer, []
+                    self._finish(batch[len(batch) - len(unwritten):] + rest, failed=True)
+                    return written
+        finally:
+            self._flush_lock.release()
+
+    @staticmethod
+    def _finish(entries: Sequence[Tuple[str, Dict[str, Any], _Waiter]], failed: bool) -> None:
+        for fingerprint, event_data, waiter in entries:
+            if failed:
+                waiter.unwritten.append((fingerprint, event_data))
+            waiter.remaining -= 1
+            if not waiter.remaining:
+                waiter.done.set()